@@ -17,9 +17,15 @@
 import os
 import sys
 
+import yaml
+
 sys.path.append('hooks/')
 
-from charmhelpers.core.hookenv import action_fail
+from charmhelpers.core.hookenv import (
+    action_fail,
+    action_set,
+)
+from charmhelpers.core import profiling
 from neutron_api_utils import (
     pause_unit_helper,
     resume_unit_helper,
@@ -40,9 +46,20 @@ def resume(args):
     resume_unit_helper(register_configs())
 
 
+def hook_stats(args):
+    """Report the timings recorded while profile-hooks is enabled."""
+    entries = profiling.ledger()
+    action_set({
+        'hooks': len(entries),
+        'summary': yaml.safe_dump(profiling.summary(entries),
+                                  default_flow_style=False),
+        'last': yaml.safe_dump(entries[-1:], default_flow_style=False),
+    })
+
+
 # A dictionary of all the defined actions to callables (which take
 # parsed arguments).
-ACTIONS = {"pause": pause, "resume": resume}
+ACTIONS = {"pause": pause, "resume": resume, "hook-stats": hook_stats}
 
 
 def main(args):
@@ -12,6 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import tempfile
+import time
+
 from . import cmdline
 from charmhelpers.core import unitdata
 
@@ -35,3 +40,61 @@ def unitdata_cmd(subparser):
             unitdata.kv().flush()
             return ''
     return _unitdata_cmd
+
+
+@cmdline.subcommand(command_name='unitdata-benchmark')
+def benchmark(keys=10000):
+    """Time writes and reads of a number of keys in a scratch kv store"""
+    keys = int(keys)
+    tmpdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        db = unitdata.Storage(os.path.join(tmpdir, 'bench.db'))
+
+        start = time.time()
+        for i in range(keys):
+            db.set('single.%d' % i, {'value': i})
+        db.flush()
+        results['set'] = time.time() - start
+
+        start = time.time()
+        db.set_many(('many.%d' % i, {'value': i}) for i in range(keys))
+        db.flush()
+        results['set_many'] = time.time() - start
+
+        start = time.time()
+        for i in range(keys):
+            db.get('single.%d' % i)
+        results['get'] = time.time() - start
+
+        start = time.time()
+        db.getrange('many.')
+        results['getrange'] = time.time() - start
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    return dict((k, '%.3fs' % v) for k, v in results.items())
+
+
+def compact(hooks=None, days=None, vacuum=True):
+    """Remove unit kv history beyond the retention limits"""
+    db = unitdata.Storage(history_hooks=hooks, history_days=days)
+    removed = db.compact()
+    db.flush(durable=True)
+    if vacuum:
+        db.vacuum()
+    db.close()
+    return 'Removed history of {} hooks'.format(removed)
+
+
+@cmdline.subcommand_builder('unitdata-compact')
+def compact_cmd(subparser):
+    subparser.add_argument('--hooks', type=int, default=None,
+                           help='Number of hooks of history to keep')
+    subparser.add_argument('--days', type=float, default=None,
+                           help='Number of days of history to keep')
+    subparser.add_argument('--no-vacuum', dest='vacuum',
+                           action='store_false',
+                           help='Do not return the freed space to the '
+                                'filesystem')
+    return compact
@@ -418,3 +418,32 @@ def add_haproxy_checks(nrpe, unit_name):
         shortname='haproxy_queue',
         description='Check HAProxy queue depth {%s}' % unit_name,
         check_cmd='check_haproxy_queue_depth.sh')
+
+
+def add_haproxy_stats_checks(nrpe, unit_name, backends):
+    """
+    Add checks reporting queue depth, session rate, response time and 5xx
+    counts for each backend read over the haproxy admin stats socket
+
+    :param NRPE nrpe: NRPE object to add check to
+    :param str unit_name: Unit name to use in check description
+    :param list backends: Backend name prefixes (service names) to check
+    """
+    # The stats socket is group owned by haproxy so nrpe can read it. The
+    # running nrpe daemon only picks up a new group when it restarts.
+    try:
+        pwd.getpwnam('nagios')
+        haproxy_group = grp.getgrnam('haproxy')
+    except KeyError:
+        log("Nagios or haproxy user not set up, skipping stats socket access")
+    else:
+        if 'nagios' not in haproxy_group.gr_mem:
+            host.add_user_to_group('nagios', 'haproxy')
+            service('restart', 'nagios-nrpe-server')
+
+    for backend in backends:
+        nrpe.add_check(
+            shortname='haproxy_{}_stats'.format(backend),
+            description='Check HAProxy {} backend stats {{{}}}'.format(
+                backend, unit_name),
+            check_cmd='check_haproxy_stats.py --backend {}'.format(backend))
@@ -22,6 +22,7 @@ from charmhelpers.core.hookenv import (
     DEBUG,
     WARNING,
 )
+from charmhelpers.core.profiling import phase
 from charmhelpers.contrib.hardening.host.checks import run_os_checks
 from charmhelpers.contrib.hardening.ssh.checks import run_ssh_checks
 from charmhelpers.contrib.hardening.mysql.checks import run_mysql_checks
@@ -72,7 +73,8 @@ def harden(overrides=None):
                 for hardener in modules_to_run:
                     log("Executing hardening module '%s'" %
                         (hardener.__name__), level=DEBUG)
-                    hardener()
+                    with phase('harden'):
+                        hardener()
             else:
                 log("No hardening applied to '%s'" % (f.__name__), level=DEBUG)
 
@@ -19,7 +19,7 @@ import os
 import re
 import time
 from base64 import b64decode
-from subprocess import check_call, CalledProcessError
+from subprocess import check_call, check_output, CalledProcessError
 
 import six
 
@@ -28,6 +28,7 @@ from charmhelpers.fetch import (
     filter_installed_packages,
 )
 from charmhelpers.core.hookenv import (
+    cached,
     config,
     is_relation_made,
     local_unit,
@@ -105,6 +106,8 @@ except ImportError:
 
 CA_CERT_PATH = '/usr/local/share/ca-certificates/keystone_juju_ca_cert.crt'
 ADDRESS_TYPES = ['admin', 'internal', 'public']
+HAPROXY_STAT_SOCKET = '/var/lib/haproxy/admin.sock'
+CGROUP_ROOT = '/sys/fs/cgroup'
 
 
 def ensure_packages(packages):
@@ -237,6 +240,12 @@ class SharedDBContext(OSContextGenerator):
                 }
                 if self.context_complete(ctxt):
                     db_ssl(rdata, ctxt, self.ssl_dir)
+                    # Read only replica advertised by the database charm,
+                    # used for the slave_connection of read heavy calls.
+                    slave_host = rdata.get('slave_db_host')
+                    slave_host = format_ipv6_addr(slave_host) or slave_host
+                    if slave_host and slave_host != host:
+                        ctxt['database_slave_host'] = slave_host
                     return ctxt
         return {}
 
@@ -392,37 +401,46 @@ class AMQPContext(OSContextGenerator):
         for rid in relation_ids(self.rel_name):
             ha_vip_only = False
             self.related = True
-            for unit in related_units(rid):
-                if relation_get('clustered', rid=rid, unit=unit):
+            units = related_units(rid)
+            # Each unit's settings are fetched in one relation-get, and only
+            # once, however many keys are read from them.
+            unit_data = {}
+
+            def settings(unit):
+                if unit not in unit_data:
+                    unit_data[unit] = relation_get(rid=rid, unit=unit) or {}
+                return unit_data[unit]
+
+            for unit in units:
+                rdata = settings(unit)
+                if rdata.get('clustered'):
                     ctxt['clustered'] = True
-                    vip = relation_get('vip', rid=rid, unit=unit)
+                    vip = rdata.get('vip')
                     vip = format_ipv6_addr(vip) or vip
                     ctxt['rabbitmq_host'] = vip
                 else:
-                    host = relation_get('private-address', rid=rid, unit=unit)
+                    host = rdata.get('private-address')
                     host = format_ipv6_addr(host) or host
                     ctxt['rabbitmq_host'] = host
 
                 ctxt.update({
                     'rabbitmq_user': username,
-                    'rabbitmq_password': relation_get('password', rid=rid,
-                                                      unit=unit),
+                    'rabbitmq_password': rdata.get('password'),
                     'rabbitmq_virtual_host': vhost,
                 })
 
-                ssl_port = relation_get('ssl_port', rid=rid, unit=unit)
+                ssl_port = rdata.get('ssl_port')
                 if ssl_port:
                     ctxt['rabbit_ssl_port'] = ssl_port
 
-                ssl_ca = relation_get('ssl_ca', rid=rid, unit=unit)
+                ssl_ca = rdata.get('ssl_ca')
                 if ssl_ca:
                     ctxt['rabbit_ssl_ca'] = ssl_ca
 
-                if relation_get('ha_queues', rid=rid, unit=unit) is not None:
+                if rdata.get('ha_queues') is not None:
                     ctxt['rabbitmq_ha_queues'] = True
 
-                ha_vip_only = relation_get('ha-vip-only',
-                                           rid=rid, unit=unit) is not None
+                ha_vip_only = rdata.get('ha-vip-only') is not None
 
                 if self.context_complete(ctxt):
                     if 'rabbit_ssl_ca' in ctxt:
@@ -441,11 +459,10 @@ class AMQPContext(OSContextGenerator):
                     break
 
             # Used for active/active rabbitmq >= grizzly
-            if (('clustered' not in ctxt or ha_vip_only) and
-                    len(related_units(rid)) > 1):
+            if ('clustered' not in ctxt or ha_vip_only) and len(units) > 1:
                 rabbitmq_hosts = []
-                for unit in related_units(rid):
-                    host = relation_get('private-address', rid=rid, unit=unit)
+                for unit in units:
+                    host = settings(unit).get('private-address')
                     host = format_ipv6_addr(host) or host
                     rabbitmq_hosts.append(host)
 
@@ -501,6 +518,24 @@ class CephContext(OSContextGenerator):
         return ctxt
 
 
+@cached
+def haproxy_seamless_reload():
+    """Determine whether the installed haproxy can pass its listening
+    sockets to the new process on reload (expose-fd, haproxy >= 1.8).
+    haproxy -v is run once per hook.
+
+    :returns: boolean
+    """
+    try:
+        version = check_output(['haproxy', '-v']).decode('UTF-8')
+    except (OSError, CalledProcessError):
+        return False
+    match = re.search(r'version (\d+)\.(\d+)', version)
+    if not match:
+        return False
+    return (int(match.group(1)), int(match.group(2))) >= (1, 8)
+
+
 class HAProxyContext(OSContextGenerator):
     """Provides half a context for the haproxy template, which describes
     all peers to be included in the cluster.  Each charm needs to include
@@ -582,6 +617,9 @@ class HAProxyContext(OSContextGenerator):
             ctxt['haproxy_host'] = '0.0.0.0'
 
         ctxt['stat_port'] = '8888'
+        ctxt['stat_socket'] = HAPROXY_STAT_SOCKET
+        if haproxy_seamless_reload():
+            ctxt['stat_socket_expose_fd'] = True
 
         db = kv()
         ctxt['stat_password'] = db.get('stat-password')
@@ -598,6 +636,11 @@ class HAProxyContext(OSContextGenerator):
                     level=DEBUG)
                 with open('/etc/default/haproxy', 'w') as out:
                     out.write('ENABLED=1\n')
+                    if ctxt.get('stat_socket_expose_fd'):
+                        # Fetch listening sockets from the old process
+                        # on reload so no connections are refused.
+                        out.write('EXTRAOPTS="-x {}"\n'.format(
+                            ctxt['stat_socket']))
 
                 return ctxt
 
@@ -1116,50 +1159,58 @@ class SubordinateConfigContext(OSContextGenerator):
         else:
             self.interfaces = [interface]
 
-    def __call__(self):
-        ctxt = {'sections': {}}
+    def subordinate_configs(self):
+        """
+        Yield (rid, subordinate_configuration) for each unit related over
+        the interfaces. Subclasses that already hold the relation data can
+        override this to avoid reading it again.
+        """
         rids = []
         for interface in self.interfaces:
             rids.extend(relation_ids(interface))
         for rid in rids:
             for unit in related_units(rid):
-                sub_config = relation_get('subordinate_configuration',
-                                          rid=rid, unit=unit)
-                if sub_config and sub_config != '':
-                    try:
-                        sub_config = json.loads(sub_config)
-                    except:
-                        log('Could not parse JSON from '
-                            'subordinate_configuration setting from %s'
-                            % rid, level=ERROR)
+                yield rid, relation_get('subordinate_configuration',
+                                        rid=rid, unit=unit)
+
+    def __call__(self):
+        ctxt = {'sections': {}}
+        for rid, sub_config in self.subordinate_configs():
+            if sub_config and sub_config != '':
+                try:
+                    sub_config = json.loads(sub_config)
+                except:
+                    log('Could not parse JSON from '
+                        'subordinate_configuration setting from %s'
+                        % rid, level=ERROR)
+                    continue
+
+                for service in self.services:
+                    if service not in sub_config:
+                        log('Found subordinate_configuration on %s but it '
+                            'contained nothing for %s service'
+                            % (rid, service), level=INFO)
                         continue
 
-                    for service in self.services:
-                        if service not in sub_config:
-                            log('Found subordinate_configuration on %s but it '
-                                'contained nothing for %s service'
-                                % (rid, service), level=INFO)
-                            continue
-
-                        sub_config = sub_config[service]
-                        if self.config_file not in sub_config:
-                            log('Found subordinate_configuration on %s but it '
-                                'contained nothing for %s'
-                                % (rid, self.config_file), level=INFO)
-                            continue
-
-                        sub_config = sub_config[self.config_file]
-                        for k, v in six.iteritems(sub_config):
-                            if k == 'sections':
-                                for section, config_list in six.iteritems(v):
-                                    log("adding section '%s'" % (section),
-                                        level=DEBUG)
-                                    if ctxt[k].get(section):
-                                        ctxt[k][section].extend(config_list)
-                                    else:
-                                        ctxt[k][section] = config_list
-                            else:
-                                ctxt[k] = v
+                    sub_config = sub_config[service]
+                    if self.config_file not in sub_config:
+                        log('Found subordinate_configuration on %s but it '
+                            'contained nothing for %s'
+                            % (rid, self.config_file), level=INFO)
+                        continue
+
+                    sub_config = sub_config[self.config_file]
+                    for k, v in six.iteritems(sub_config):
+                        if k == 'sections':
+                            for section, config_list in six.iteritems(v):
+                                log("adding section '%s'" % (section),
+                                    level=DEBUG)
+                                if ctxt[k].get(section):
+                                    ctxt[k][section].extend(config_list)
+                                else:
+                                    ctxt[k][section] = config_list
+                        else:
+                            ctxt[k] = v
         log("%d section(s) found" % (len(ctxt['sections'])), level=DEBUG)
         return ctxt
 
@@ -1192,22 +1243,192 @@ class BindHostContext(OSContextGenerator):
             return {'bind_host': '0.0.0.0'}
 
 
+def _read_cgroup_file(*path):
+    try:
+        with open(os.path.join(CGROUP_ROOT, *path)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def parse_cpu_list(cpus):
+    """Count the CPUs in a cpuset list such as '0-3,8,10-11'."""
+    count = 0
+    for cpu_range in cpus.split(','):
+        cpu_range = cpu_range.strip()
+        if not cpu_range:
+            continue
+        if '-' in cpu_range:
+            start, end = cpu_range.split('-')
+            count += int(end) - int(start) + 1
+        else:
+            count += 1
+    return count
+
+
+def cgroup_cpuset():
+    """Return the number of CPUs in the cgroup cpuset, or None."""
+    cpus = (_read_cgroup_file('cpuset.cpus.effective') or
+            _read_cgroup_file('cpuset', 'cpuset.effective_cpus') or
+            _read_cgroup_file('cpuset', 'cpuset.cpus'))
+    if cpus:
+        return parse_cpu_list(cpus) or None
+    return None
+
+
+def cgroup_cpu_quota():
+    """Return the cgroup CPU bandwidth quota as a number of CPUs, or None
+    if no quota is set.
+    """
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    cpu_max = _read_cgroup_file('cpu.max')
+    if cpu_max:
+        quota, _, period = cpu_max.partition(' ')
+        if quota != 'max' and period:
+            return float(quota) / float(period)
+        return None
+    # cgroup v1: quota is -1 if unlimited
+    for controller in ('cpu', 'cpu,cpuacct'):
+        quota = _read_cgroup_file(controller, 'cpu.cfs_quota_us')
+        period = _read_cgroup_file(controller, 'cpu.cfs_period_us')
+        if quota and period:
+            if int(quota) > 0:
+                return float(quota) / float(period)
+            return None
+    return None
+
+
+def cgroup_memory_limit():
+    """Return the cgroup memory limit in bytes, or None if unlimited."""
+    limit = (_read_cgroup_file('memory.max') or
+             _read_cgroup_file('memory', 'memory.limit_in_bytes'))
+    if not limit or limit == 'max':
+        return None
+    limit = int(limit)
+    # cgroup v1 reports an unlimited group as a huge page aligned value
+    if limit >= 2 ** 60:
+        return None
+    return limit
+
+
+@cached
+def process_rss_mb(name):
+    """Average resident memory in MB of the running processes called name,
+    or None if there are none. The /proc scan is done once per hook.
+    """
+    rss = []
+    for status in glob.glob('/proc/[0-9]*/status'):
+        fields = {}
+        try:
+            with open(status) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    fields[key] = value.strip()
+        except (IOError, OSError):
+            continue
+        if fields.get('Name') == name and 'VmRSS' in fields:
+            rss.append(int(fields['VmRSS'].split()[0]) / 1024.0)
+    if rss:
+        return sum(rss) / len(rss)
+    return None
+
+
+@cached
+def host_cpu_topology():
+    """Return the online CPU count and the cgroup cpuset and CPU quota
+    limits, read once per hook.
+    """
+    # NOTE: use cpu_count if present (16.04 support)
+    if hasattr(psutil, 'cpu_count'):
+        online = psutil.cpu_count()
+    else:
+        online = psutil.NUM_CPUS
+    return {
+        'online': online,
+        'cpuset': cgroup_cpuset(),
+        'quota': cgroup_cpu_quota(),
+    }
+
+
 class WorkerConfigContext(OSContextGenerator):
+    """Sizes service worker pools from the CPUs and memory actually
+    available to the unit.
+
+    The CPU count is limited by the cgroup cpuset and CPU quota so that
+    units in containers are sized from their allocation rather than the
+    host, and the resulting worker count is capped to what fits in the
+    unit's memory (physical or cgroup limit) at the RSS of a worker.
+    """
+    # Estimated resident memory of a worker in MB, used when no running
+    # process_name workers can be measured.
+    worker_rss_mb = 200
+    # Process name to measure worker resident memory from
+    process_name = None
+    # Number of worker pools sized from the same count, e.g. API and RPC
+    worker_pools = 1
+    # Share of the unit's memory that workers may consume
+    worker_memory_ratio = 0.75
+
+    def cpu_topology(self):
+        return host_cpu_topology()
 
     @property
     def num_cpus(self):
-        # NOTE: use cpu_count if present (16.04 support)
-        if hasattr(psutil, 'cpu_count'):
-            return psutil.cpu_count()
-        else:
-            return psutil.NUM_CPUS
+        topology = self.cpu_topology()
+        cpus = topology['online']
+        if topology['cpuset']:
+            cpus = min(cpus, topology['cpuset'])
+        if topology['quota']:
+            cpus = min(cpus, max(int(math.ceil(topology['quota'])), 1))
+        return cpus
 
-    def __call__(self):
-        multiplier = config('worker-multiplier') or 0
-        count = int(self.num_cpus * multiplier)
+    @property
+    def memory_limit(self):
+        """Memory in bytes available to the unit."""
+        limit = psutil.virtual_memory().total
+        cgroup_limit = cgroup_memory_limit()
+        if cgroup_limit:
+            limit = min(limit, cgroup_limit)
+        return limit
+
+    @property
+    def worker_rss(self):
+        """Estimated resident memory of one worker in MB."""
+        if self.process_name:
+            measured = process_rss_mb(self.process_name)
+            if measured:
+                return measured
+        return self.worker_rss_mb
+
+    def worker_count(self, multiplier):
+        """Number of workers for multiplier, limited by available CPUs and
+        memory. The reasoning is logged.
+        """
+        topology = self.cpu_topology()
+        cpus = self.num_cpus
+        count = int(cpus * multiplier)
         if multiplier > 0 and count == 0:
             count = 1
-        ctxt = {"workers": count}
+        reason = ('{} cpus (online {}, cpuset {}, quota {}) x {}'
+                  ''.format(cpus, topology['online'], topology['cpuset'],
+                            topology['quota'], multiplier))
+
+        memory_mb = self.memory_limit // (1024 * 1024)
+        rss = self.worker_rss
+        memory_cap = int(memory_mb * self.worker_memory_ratio /
+                         (rss * self.worker_pools))
+        memory_cap = max(memory_cap, 1)
+        if count > memory_cap:
+            reason += (', capped by {}MB memory at {:.0f}MB per worker '
+                       'across {} pool(s)'.format(memory_mb, rss,
+                                                  self.worker_pools))
+            count = memory_cap
+        log('Sizing workers: {} = {}'.format(count, reason), level=INFO)
+        return count
+
+    def __call__(self):
+        multiplier = config('worker-multiplier') or 0
+        ctxt = {"workers": self.worker_count(multiplier)}
         return ctxt
 
 
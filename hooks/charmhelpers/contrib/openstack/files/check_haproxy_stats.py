@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#--------------------------------------------
+# This file is managed by Juju
+#--------------------------------------------
+#
+# Copyright 2016 Canonical Ltd.
+#
+# Nagios check reading 'show stat' from the haproxy admin stats socket and
+# reporting per-backend queue depth, session rate, response time and 5xx
+# counts as perfdata.
+
+import argparse
+import csv
+import socket
+import sys
+
+OK = 0
+WARNING = 1
+CRITICAL = 2
+UNKNOWN = 3
+
+STATUS_NAMES = {
+    OK: 'OK',
+    WARNING: 'WARNING',
+    CRITICAL: 'CRITICAL',
+    UNKNOWN: 'UNKNOWN',
+}
+
+DEFAULT_SOCKET = '/var/lib/haproxy/admin.sock'
+
+
+def read_stats(path, timeout=10):
+    """Return the rows of 'show stat' as a list of dicts keyed by field."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(b'show stat\n')
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return parse_stats(b''.join(chunks).decode('utf-8'))
+
+
+def parse_stats(output):
+    lines = [l for l in output.splitlines() if l.strip()]
+    if not lines or not lines[0].startswith('# '):
+        raise ValueError('Unexpected output from haproxy stats socket')
+    lines[0] = lines[0][2:]
+    return list(csv.DictReader(lines))
+
+
+def _int(row, field):
+    try:
+        return int(row.get(field) or 0)
+    except ValueError:
+        return 0
+
+
+def check_backends(rows, prefixes, queue_warn, queue_crit,
+                   rtime_warn, rtime_crit):
+    """Evaluate backend rows whose proxy name starts with one of prefixes.
+
+    :returns: tuple of (status, [messages], [perfdata])
+    """
+    status = OK
+    messages = []
+    perfdata = []
+    backends = [r for r in rows
+                if r.get('svname') == 'BACKEND' and
+                any(r.get('pxname', '').startswith(p) for p in prefixes)]
+    if not backends:
+        return (UNKNOWN,
+                ['No backends matching {}'.format(','.join(prefixes))], [])
+
+    for row in backends:
+        name = row['pxname']
+        qcur = _int(row, 'qcur')
+        rate = _int(row, 'rate')
+        # rtime is only populated in http mode, fall back to the total
+        # session time for tcp backends.
+        rtime = _int(row, 'rtime') or _int(row, 'ttime')
+        hrsp_5xx = _int(row, 'hrsp_5xx')
+
+        row_status = OK
+        if row.get('status') == 'DOWN':
+            row_status = CRITICAL
+            messages.append('{} is DOWN'.format(name))
+        if qcur >= queue_crit or rtime >= rtime_crit:
+            row_status = CRITICAL
+        elif qcur >= queue_warn or rtime >= rtime_warn:
+            row_status = max(row_status, WARNING)
+        if row_status != OK:
+            messages.append('{} queue:{} rtime:{}ms'.format(name, qcur, rtime))
+        status = max(status, row_status)
+
+        perfdata.extend([
+            "'{}_qcur'={};{};{};0".format(name, qcur, queue_warn, queue_crit),
+            "'{}_rate'={};;;0".format(name, rate),
+            "'{}_rtime'={}ms;{};{};0".format(name, rtime, rtime_warn,
+                                              rtime_crit),
+            "'{}_hrsp_5xx'={}c;;;0".format(name, hrsp_5xx),
+        ])
+
+    if status == OK:
+        messages.append('{} haproxy backends looking good'.format(
+            len(backends)))
+    return status, messages, perfdata
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check haproxy backends via the stats socket')
+    parser.add_argument('-s', '--socket', default=DEFAULT_SOCKET,
+                        help='Path to the haproxy stats socket')
+    parser.add_argument('-b', '--backend', action='append', default=[],
+                        help='Backend name prefix to report on (repeatable)')
+    parser.add_argument('--queue-warn', type=int, default=10)
+    parser.add_argument('--queue-crit', type=int, default=100)
+    parser.add_argument('--rtime-warn', type=int, default=2000,
+                        help='Average response time warning level in ms')
+    parser.add_argument('--rtime-crit', type=int, default=10000,
+                        help='Average response time critical level in ms')
+    args = parser.parse_args(argv)
+
+    try:
+        rows = read_stats(args.socket)
+    except (socket.error, ValueError) as e:
+        print('UNKNOWN: unable to read {}: {}'.format(args.socket, e))
+        return UNKNOWN
+
+    status, messages, perfdata = check_backends(
+        rows, args.backend or [''], args.queue_warn, args.queue_crit,
+        args.rtime_warn, args.rtime_crit)
+    print('{}: {} | {}'.format(STATUS_NAMES[status], '; '.join(messages),
+                               ' '.join(perfdata)))
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
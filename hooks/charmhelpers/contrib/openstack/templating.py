@@ -22,6 +22,7 @@ from charmhelpers.core.hookenv import (
     ERROR,
     INFO
 )
+from charmhelpers.core.profiling import profiled
 from charmhelpers.contrib.openstack.utils import OPENSTACK_CODENAMES
 
 try:
@@ -229,6 +230,7 @@ class OSConfigRenderer(object):
         log('Loaded template from %s' % template.filename, level=INFO)
         return template
 
+    @profiled('render')
     def render(self, config_file):
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
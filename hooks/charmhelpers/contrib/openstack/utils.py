@@ -23,14 +23,19 @@ import sys
 import re
 import itertools
 import functools
+import hashlib
+import io
 import shutil
 
 import six
+import tarfile
 import tempfile
 import traceback
 import uuid
 import yaml
 
+from multiprocessing.pool import ThreadPool
+
 from charmhelpers.contrib.network import ip
 
 from charmhelpers.core import (
@@ -70,6 +75,7 @@ from charmhelpers.contrib.network.ip import (
 from charmhelpers.contrib.python.packages import (
     pip_create_virtualenv,
     pip_install,
+    pip_wheel,
 )
 
 from charmhelpers.core.host import (
@@ -571,17 +577,12 @@ def configure_installation_source(rel):
 
 def config_value_changed(option):
     """
-    Determine if config value changed since last call to this function.
+    Determine if config value changed since the previous hook.
+
+    Returns False if the option had no previous value.
     """
-    hook_data = unitdata.HookData()
-    with hook_data():
-        db = unitdata.kv()
-        current = config(option)
-        saved = db.get(option)
-        db.set(option, current)
-        if saved is None:
-            return False
-        return current != saved
+    cfg = config()
+    return cfg.previous(option) is not None and cfg.changed(option)
 
 
 def save_script_rc(script_path="scripts/scriptrc", **env_vars):
@@ -838,6 +839,16 @@ def _git_yaml_load(projects_yaml):
 
 
 requirements_dir = None
+# Repositories cloned concurrently by git_clone_and_install
+GIT_CLONE_WORKERS = 4
+# unitdata key of the commit and constraints each repository was installed
+# from, keyed by project name
+GIT_INSTALL_KEY = 'git-install'
+# unitdata key of the projects installed since the services running them
+# were restarted, see git_restart_pending
+GIT_RESTART_PENDING_KEY = 'git-restart-pending'
+# Member of a packed venv tarball holding the path the venv was built in
+GIT_VENV_PATH_FILE = '.venv-path'
 
 
 def git_clone_and_install(projects_yaml, core_project):
@@ -860,6 +871,18 @@ def git_clone_and_install(projects_yaml, core_project):
 
     The directory, http_proxy, and https_proxy keys are optional.
 
+    The repositories are cloned concurrently. The requirements of all
+    projects are then resolved together and built into a wheelhouse kept
+    in the directory, keyed by the upper-constraints in use, so reinstalls
+    only build wheels for requirements that changed. The projects are
+    installed in the order given, the core project last.
+
+    The commit and constraints each project was installed from are recorded
+    in unitdata, and projects whose commit and constraints are unchanged
+    are not installed again. Installed projects are recorded as pending a
+    restart with the same flush, until git_restart_done is called.
+
+    :returns: list of the names of the projects that were installed.
     """
     global requirements_dir
     parent_dir = '/mnt/openstack-git'
@@ -879,69 +902,107 @@ def git_clone_and_install(projects_yaml, core_project):
     if 'directory' in projects.keys():
         parent_dir = projects['directory']
 
-    pip_create_virtualenv(os.path.join(parent_dir, 'venv'))
-
-    # Upgrade setuptools and pip from default virtualenv versions. The default
-    # versions in trusty break master OpenStack branch deployments.
-    for p in ['pip', 'setuptools']:
-        pip_install(p, upgrade=True, proxy=http_proxy,
-                    venv=os.path.join(parent_dir, 'venv'))
+    venv = os.path.join(parent_dir, 'venv')
+    kv = unitdata.kv()
+    installed = kv.get(GIT_INSTALL_KEY, {})
+    if not os.path.exists(venv):
+        installed = {}
+        pip_create_virtualenv(venv)
+
+        # Upgrade setuptools and pip from default virtualenv versions. The
+        # default versions in trusty break master OpenStack branch
+        # deployments.
+        for p in ['pip', 'setuptools']:
+            pip_install(p, upgrade=True, proxy=http_proxy, venv=venv)
+
+    repositories = projects['repositories']
+    repo_dirs = _git_clone_all(repositories, parent_dir)
+
+    # The requirements repo is validated to be first
+    requirements_dir = repo_dirs[0]
+    constraints = os.path.join(requirements_dir, "upper-constraints.txt")
+    # upper-constraints didn't exist until after icehouse
+    if not os.path.isfile(constraints):
+        constraints = None
+    # use constraints unless project yaml sets use_constraints to false
+    if 'use_constraints' in projects.keys():
+        if not projects['use_constraints']:
+            constraints = None
+
+    constraints_key = _git_constraints_key(constraints)
+    states = [{'commit': _git_head(d), 'constraints': constraints_key}
+              for d in repo_dirs]
+    changed = [i for i, p in enumerate(repositories)
+               if installed.get(p['name']) != states[i]]
+    for i, p in enumerate(repositories):
+        if i not in changed:
+            juju_log('Git repo {} unchanged at {}, not '
+                     'reinstalling'.format(p['name'], states[i]['commit']))
+
+    changed_dirs = [repo_dirs[i] for i in changed if i]
+    for repo_dir in changed_dirs:
+        _git_update_requirements(venv, repo_dir, requirements_dir)
 
-    constraints = None
-    for p in projects['repositories']:
-        repo = p['repository']
-        branch = p['branch']
-        depth = '1'
-        if 'depth' in p.keys():
-            depth = p['depth']
-        if p['name'] == 'requirements':
-            repo_dir = _git_clone_and_install_single(repo, branch, depth,
-                                                     parent_dir, http_proxy,
-                                                     update_requirements=False)
-            requirements_dir = repo_dir
-            constraints = os.path.join(repo_dir, "upper-constraints.txt")
-            # upper-constraints didn't exist until after icehouse
-            if not os.path.isfile(constraints):
-                constraints = None
-            # use constraints unless project yaml sets use_constraints to false
-            if 'use_constraints' in projects.keys():
-                if not projects['use_constraints']:
-                    constraints = None
-        else:
-            repo_dir = _git_clone_and_install_single(repo, branch, depth,
-                                                     parent_dir, http_proxy,
-                                                     update_requirements=True,
-                                                     constraints=constraints)
+    wheelhouse = _git_build_wheelhouse(venv, changed_dirs, parent_dir,
+                                       constraints, constraints_key,
+                                       http_proxy)
+
+    for i in changed:
+        juju_log('Installing git repo from dir: {}'.format(repo_dirs[i]))
+        pip_install(repo_dirs[i], proxy=http_proxy, venv=venv,
+                    constraints=constraints if i else None,
+                    **{'find-links': wheelhouse})
+        installed[repositories[i]['name']] = states[i]
+        kv.set(GIT_INSTALL_KEY, installed)
+        kv.set(GIT_RESTART_PENDING_KEY, sorted(
+            set(kv.get(GIT_RESTART_PENDING_KEY, [])) |
+            set([repositories[i]['name']])))
+        kv.flush()
 
     os.environ = old_environ
+    return [repositories[i]['name'] for i in changed]
 
 
-def _git_validate_projects_yaml(projects, core_project):
+def _git_head(repo_dir):
     """
-    Validate the projects yaml.
+    Return the commit checked out in repo_dir.
     """
-    _git_ensure_key_exists('repositories', projects)
+    return subprocess.check_output(
+        ['git', '-C', repo_dir, 'rev-parse', 'HEAD']).decode('UTF-8').strip()
 
-    for project in projects['repositories']:
-        _git_ensure_key_exists('name', project.keys())
-        _git_ensure_key_exists('repository', project.keys())
-        _git_ensure_key_exists('branch', project.keys())
-
-    if projects['repositories'][0]['name'] != 'requirements':
-        error_out('{} git repo must be specified first'.format('requirements'))
-
-    if projects['repositories'][-1]['name'] != core_project:
-        error_out('{} git repo must be specified last'.format(core_project))
 
-    _git_ensure_key_exists('release', projects)
+def _git_constraints_key(constraints):
+    """
+    Return a digest of the upper-constraints file, or 'unconstrained'.
+    """
+    if not constraints:
+        return 'unconstrained'
+    with open(constraints, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
 
 
-def _git_ensure_key_exists(key, keys):
+def _git_clone_all(repositories, parent_dir):
     """
-    Ensure that key exists in keys.
+    Clone the repositories concurrently, returning their directories in
+    the order given.
     """
-    if key not in keys:
-        error_out('openstack-origin-git key \'{}\' is missing'.format(key))
+    if not os.path.exists(parent_dir):
+        os.mkdir(parent_dir)
+
+    for p in repositories:
+        juju_log('Cloning git repo: {}, branch: {}'.format(p['repository'],
+                                                           p['branch']))
+
+    def clone(p):
+        return install_remote(p['repository'], dest=parent_dir,
+                              branch=p['branch'], depth=p.get('depth', '1'))
+
+    pool = ThreadPool(min(GIT_CLONE_WORKERS, len(repositories)))
+    try:
+        return pool.map(clone, repositories)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def _git_clone_and_install_single(repo, branch, depth, parent_dir, http_proxy,
@@ -949,14 +1010,8 @@ def _git_clone_and_install_single(repo, branch, depth, parent_dir, http_proxy,
     """
     Clone and install a single git repository.
     """
-    if not os.path.exists(parent_dir):
-        juju_log('Directory already exists at {}. '
-                 'No need to create directory.'.format(parent_dir))
-        os.mkdir(parent_dir)
-
-    juju_log('Cloning git repo: {}, branch: {}'.format(repo, branch))
-    repo_dir = install_remote(
-        repo, dest=parent_dir, branch=branch, depth=depth)
+    repo_dir = _git_clone_all([{'repository': repo, 'branch': branch,
+                                'depth': depth}], parent_dir)[0]
 
     venv = os.path.join(parent_dir, 'venv')
 
@@ -976,6 +1031,54 @@ def _git_clone_and_install_single(repo, branch, depth, parent_dir, http_proxy,
     return repo_dir
 
 
+def _git_build_wheelhouse(venv, repo_dirs, parent_dir, constraints,
+                          constraints_key, http_proxy):
+    """
+    Build wheels of the requirements of all repo_dirs into a wheelhouse
+    keyed by the upper-constraints, returning its path or None if there are
+    no requirements.
+    """
+    requirements = [os.path.join(d, 'requirements.txt') for d in repo_dirs
+                    if os.path.isfile(os.path.join(d, 'requirements.txt'))]
+    if not requirements:
+        return None
+    wheelhouse = os.path.join(parent_dir, 'wheelhouse', constraints_key)
+    if not os.path.isdir(wheelhouse):
+        os.makedirs(wheelhouse)
+    juju_log('Building requirements into wheelhouse: {}'.format(wheelhouse))
+    pip_wheel(requirements, wheelhouse, venv, constraints=constraints,
+              proxy=http_proxy)
+    return wheelhouse
+
+
+def _git_validate_projects_yaml(projects, core_project):
+    """
+    Validate the projects yaml.
+    """
+    _git_ensure_key_exists('repositories', projects)
+
+    for project in projects['repositories']:
+        _git_ensure_key_exists('name', project.keys())
+        _git_ensure_key_exists('repository', project.keys())
+        _git_ensure_key_exists('branch', project.keys())
+
+    if projects['repositories'][0]['name'] != 'requirements':
+        error_out('{} git repo must be specified first'.format('requirements'))
+
+    if projects['repositories'][-1]['name'] != core_project:
+        error_out('{} git repo must be specified last'.format(core_project))
+
+    _git_ensure_key_exists('release', projects)
+
+
+def _git_ensure_key_exists(key, keys):
+    """
+    Ensure that key exists in keys.
+    """
+    if key not in keys:
+        error_out('openstack-origin-git key \'{}\' is missing'.format(key))
+
+
 def _git_update_requirements(venv, package_dir, reqs_dir):
     """
     Update from global requirements.
@@ -1040,6 +1143,148 @@ def git_yaml_value(projects_yaml, key):
     return None
 
 
+def git_pack_venv(projects_yaml, tarball, core_project):
+    """
+    Pack the pip virtualenv and the core project's etc directory into a
+    gzipped tarball that git_unpack_venv can install on other units.
+
+    git_unpack_venv rejects absolute links, so absolute symlinks into the
+    venv are packed relative to the link, and those out of it (virtualenv
+    links the system stdlib) are packed as copies of their target.
+    """
+    venv = git_pip_venv_dir(projects_yaml)
+    parent_dir = os.path.dirname(venv)
+    etc = os.path.join(git_src_dir(projects_yaml, core_project), 'etc')
+    packed_venv = venv.encode('UTF-8')
+    external = []
+
+    def _relative_links(info):
+        if info.issym() and os.path.isabs(info.linkname):
+            path = os.path.join(venv, os.path.relpath(info.name, 'venv'))
+            target = os.path.normpath(info.linkname)
+            if target == venv or target.startswith(venv + os.sep):
+                info.linkname = os.path.relpath(target,
+                                                os.path.dirname(path))
+            elif os.path.exists(path):
+                external.append((os.path.realpath(path), info.name))
+                return None
+            else:
+                juju_log('Not packing dangling link {} -> {}'.format(
+                    path, info.linkname))
+                return None
+        return info
+
+    with tarfile.open(tarball, 'w:gz') as tar:
+        tar.add(venv, arcname='venv', filter=_relative_links)
+        for path, arcname in external:
+            tar.add(path, arcname=arcname, filter=_relative_links)
+        tar.add(etc, arcname=os.path.relpath(etc, parent_dir))
+        info = tarfile.TarInfo(GIT_VENV_PATH_FILE)
+        info.size = len(packed_venv)
+        tar.addfile(info, io.BytesIO(packed_venv))
+
+
+def git_unpack_venv(projects_yaml, tarball):
+    """
+    Install a tarball packed by git_pack_venv, replacing any existing
+    virtualenv.
+
+    The venv is relocated if it was packed from a different directory:
+    scripts in its bin directory are rewritten to the local venv path.
+    """
+    venv = git_pip_venv_dir(projects_yaml)
+    parent_dir = os.path.dirname(venv)
+    if not os.path.exists(parent_dir):
+        os.makedirs(parent_dir)
+
+    staging = tempfile.mkdtemp(dir=parent_dir)
+    try:
+        with tarfile.open(tarball) as tar:
+            for member in tar.getmembers():
+                path = os.path.normpath(member.name)
+                if os.path.isabs(path) or path.startswith(os.pardir):
+                    raise ValueError('Unsafe path in venv tarball: '
+                                     '{}'.format(member.name))
+                if member.issym() or member.islnk():
+                    # Hard links name a member, symlinks are relative to
+                    # their own directory; neither may leave the tarball.
+                    link = member.linkname
+                    if member.issym():
+                        link = os.path.join(os.path.dirname(path), link)
+                    link = os.path.normpath(link)
+                    if (os.path.isabs(member.linkname) or
+                            link == os.pardir or
+                            link.startswith(os.pardir + os.sep)):
+                        raise ValueError('Unsafe link in venv tarball: '
+                                         '{} -> {}'.format(member.name,
+                                                           member.linkname))
+            tar.extractall(staging)
+        with open(os.path.join(staging, GIT_VENV_PATH_FILE), 'rb') as f:
+            packed_venv = f.read()
+        os.unlink(os.path.join(staging, GIT_VENV_PATH_FILE))
+
+        old_venv = None
+        if os.path.exists(venv):
+            old_venv = tempfile.mkdtemp(dir=parent_dir)
+            os.rename(venv, os.path.join(old_venv, 'venv'))
+        os.rename(os.path.join(staging, 'venv'), venv)
+        if old_venv:
+            shutil.rmtree(old_venv)
+
+        for root, dirs, files in os.walk(staging):
+            dest = os.path.join(parent_dir, os.path.relpath(root, staging))
+            if not os.path.isdir(dest):
+                os.makedirs(dest)
+            for f in files:
+                os.rename(os.path.join(root, f), os.path.join(dest, f))
+    finally:
+        shutil.rmtree(staging)
+
+    local_venv = venv.encode('UTF-8')
+    if packed_venv != local_venv:
+        juju_log('Relocating venv from {} to {}'.format(
+            packed_venv.decode('UTF-8'), venv))
+        bin_dir = os.path.join(venv, 'bin')
+        for f in os.listdir(bin_dir):
+            path = os.path.join(bin_dir, f)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as fd:
+                content = fd.read()
+            if not (content.startswith(b'#!') or f.startswith('activate')):
+                continue
+            if packed_venv in content:
+                with open(path, 'wb') as fd:
+                    fd.write(content.replace(packed_venv, local_venv))
+
+    # The venv no longer matches what git_clone_and_install recorded, and
+    # every project in it is new to the services running them.
+    kv = unitdata.kv()
+    kv.unset(GIT_INSTALL_KEY)
+    kv.set(GIT_RESTART_PENDING_KEY, sorted(
+        p['name'] for p in _git_yaml_load(projects_yaml)['repositories']))
+    kv.flush()
+
+
+def git_restart_pending():
+    """
+    Return the names of the projects installed from git since
+    git_restart_done was last called, so a hook which failed after
+    installing them but before restarting the services still restarts
+    them next time.
+    """
+    return unitdata.kv().get(GIT_RESTART_PENDING_KEY, [])
+
+
+def git_restart_done():
+    """
+    Record that the services run the projects installed from git.
+    """
+    kv = unitdata.kv()
+    kv.unset(GIT_RESTART_PENDING_KEY)
+    kv.flush()
+
+
 def git_generate_systemd_init_files(templates_dir):
     """
     Generate systemd init files.
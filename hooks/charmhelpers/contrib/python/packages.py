@@ -78,6 +78,29 @@ def pip_install_requirements(requirements, constraints=None, **options):
     pip_execute(command)
 
 
+def pip_wheel(requirements, wheel_dir, venv, constraints=None, **options):
+    """Build wheels of the given requirements files into wheel_dir.
+
+    The requirements are resolved together, and wheels already in wheel_dir
+    are reused rather than built again.
+
+    :param requirements: list of paths to requirements files.
+    """
+    command = [os.path.join(venv, 'bin/pip'), 'wheel',
+               '--wheel-dir={}'.format(wheel_dir),
+               '--find-links={}'.format(wheel_dir)]
+    available_options = ('proxy', 'log', 'index-url', )
+    for option in parse_options(options, available_options):
+        command.append(option)
+    if constraints:
+        command.extend(['-c', constraints])
+    for path in requirements:
+        command.extend(['-r', path])
+    log("Building wheels into {} with options: {}".format(wheel_dir,
+                                                          command))
+    subprocess.check_call(command)
+
+
 def pip_install(package, fatal=False, upgrade=False, venv=None,
                 constraints=None, **options):
     """Install a python package"""
@@ -87,7 +110,7 @@ def pip_install(package, fatal=False, upgrade=False, venv=None,
     else:
         command = ["install"]
 
-    available_options = ('proxy', 'src', 'log', 'index-url', )
+    available_options = ('proxy', 'src', 'log', 'index-url', 'find-links', )
     for option in parse_options(options, available_options):
         command.append(option)
 
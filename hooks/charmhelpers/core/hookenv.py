@@ -26,13 +26,22 @@ import glob
 import os
 import json
 import yaml
+import signal
 import subprocess
 import sys
 import errno
 import tempfile
+import time
+import traceback
+import atexit as _py_atexit
 from subprocess import CalledProcessError
 
 import six
+
+from charmhelpers.core import profiling
+from charmhelpers.core import unitdata
+from charmhelpers.core.strutils import bool_from_string
+
 if not six.PY3:
     from UserDict import UserDict
 else:
@@ -85,20 +94,124 @@ def flush(key):
             flush_list.append(item)
     for item in flush_list:
         del cache[item]
+    for item in [i for i in _hook_tool_cache if key in str(i)]:
+        del _hook_tool_cache[item]
+
+
+# All hook tool invocations go through _read_hook_tool or _run_hook_tool,
+# which count and time them per tool. Identical reads are only run once,
+# until the next call of a tool which may change what they return.
+_hook_tool_cache = {}
+_hook_tool_stats = {}
+# Read tools whose output each state changing tool may change. Tools not
+# listed here discard every cached read.
+_HOOK_TOOL_INVALIDATES = {
+    'relation-set': ('relation-get',),
+    'status-set': ('status-get',),
+    'leader-set': ('leader-get',),
+    'open-port': ('opened-ports',),
+    'close-port': ('opened-ports',),
+    'action-set': (),
+    'action-fail': (),
+    'application-version-set': (),
+    'add-metric': (),
+    'juju-log': (),
+    'payload-register': (),
+    'payload-unregister': (),
+    'payload-status-set': (),
+}
+
+
+def _hook_tool_record(cmd, seconds=None):
+    stats = _hook_tool_stats.setdefault(
+        cmd[0], {'calls': 0, 'cached': 0, 'seconds': 0.0})
+    if seconds is None:
+        stats['cached'] += 1
+    else:
+        stats['calls'] += 1
+        stats['seconds'] += seconds
 
 
-def log(message, level=None):
-    """Write a message to the juju log"""
+def _read_hook_tool(cmd, **kwargs):
+    """Return the output of a hook tool which does not change state."""
+    key = (tuple(cmd), tuple(sorted(kwargs.items())))
+    if key in _hook_tool_cache:
+        _hook_tool_record(cmd)
+        return _hook_tool_cache[key]
+    start = time.time()
+    try:
+        with profiling.phase(cmd[0]):
+            output = subprocess.check_output(cmd, **kwargs)
+    finally:
+        _hook_tool_record(cmd, time.time() - start)
+    _hook_tool_cache[key] = output
+    return output
+
+
+def _invalidate_hook_tool_cache(tool):
+    """Discard the cached reads that running tool may make stale.
+
+    relation-set only changes the local unit's relation data, so only
+    relation-get reads of the local unit are discarded."""
+    reads = _HOOK_TOOL_INVALIDATES.get(tool)
+    if reads is None:
+        _hook_tool_cache.clear()
+        return
+    unit = None
+    if tool == 'relation-set':
+        unit = os.environ.get('JUJU_UNIT_NAME')
+    for key in list(_hook_tool_cache):
+        cmd = key[0]
+        if cmd[0] in reads and (unit is None or unit in cmd):
+            del _hook_tool_cache[key]
+
+
+def _run_hook_tool(cmd, check=True, invalidate=True):
+    """Run a hook tool which may change state.
+
+    :param check: raise CalledProcessError on failure, otherwise return the
+                  exit code.
+    :param invalidate: discard the cached reads the tool may make stale.
+    """
+    if invalidate:
+        _invalidate_hook_tool_cache(cmd[0])
+    start = time.time()
+    try:
+        with profiling.phase(cmd[0]):
+            if check:
+                return subprocess.check_call(cmd)
+            return subprocess.call(cmd)
+    finally:
+        _hook_tool_record(cmd, time.time() - start)
+
+
+def hook_tool_stats():
+    """Return calls, cached reads and seconds spent per hook tool."""
+    return copy.deepcopy(_hook_tool_stats)
+
+
+# Buffered log messages are written with a single juju-log call per run of
+# messages at the same level, once either threshold is reached.
+LOG_BUFFER_MAX_MESSAGES = 50
+LOG_BUFFER_MAX_BYTES = 32 * 1024
+LOG_BUFFER_MAX_AGE = 5
+
+_log_buffer = []
+_log_buffer_state = {'enabled': False, 'bytes': 0, 'since': None,
+                     'handlers': {}}
+# Signals that kill a hook without running atexit handlers
+LOG_FLUSH_SIGNALS = (signal.SIGTERM, signal.SIGHUP)
+
+
+def _juju_log(message, level=None):
     command = ['juju-log']
     if level:
         command += ['-l', level]
-    if not isinstance(message, six.string_types):
-        message = repr(message)
     command += [message]
     # Missing juju-log should not cause failures in unit tests
     # Send log output to stderr
     try:
-        subprocess.call(command)
+        _run_hook_tool(command, check=False, invalidate=False)
     except OSError as e:
         if e.errno == errno.ENOENT:
             if level:
@@ -109,6 +222,78 @@ def log(message, level=None):
             raise
 
 
+def log(message, level=None):
+    """Write a message to the juju log
+
+    While buffering is enabled (see log_buffering), messages are held in
+    memory and written in batches by flush_log. ERROR and CRITICAL
+    messages flush the buffer immediately."""
+    if not isinstance(message, six.string_types):
+        message = repr(message)
+    if not _log_buffer_state['enabled']:
+        _juju_log(message, level)
+        return
+    if not _log_buffer:
+        _log_buffer_state['since'] = time.time()
+    _log_buffer.append((level, message))
+    _log_buffer_state['bytes'] += len(message)
+    if (level in (ERROR, CRITICAL) or
+            len(_log_buffer) >= LOG_BUFFER_MAX_MESSAGES or
+            _log_buffer_state['bytes'] >= LOG_BUFFER_MAX_BYTES or
+            time.time() - _log_buffer_state['since'] >= LOG_BUFFER_MAX_AGE):
+        flush_log()
+
+
+def flush_log():
+    """Write any buffered log messages to the juju log.
+
+    Consecutive messages at the same level are joined into a single
+    juju-log call, so ordering and level filtering are preserved."""
+    batch = list(_log_buffer)
+    del _log_buffer[:]
+    _log_buffer_state['bytes'] = 0
+    _log_buffer_state['since'] = None
+    while batch:
+        level = batch[0][0]
+        messages = []
+        while batch and batch[0][0] == level:
+            messages.append(batch.pop(0)[1])
+        _juju_log('\n'.join(messages), level)
+
+
+def _flush_log_on_signal(signum, frame):
+    """Flush buffered log messages, then deliver signum to the handler
+    that was installed before buffering was enabled."""
+    flush_log()
+    signal.signal(signum,
+                  _log_buffer_state['handlers'].pop(signum, signal.SIG_DFL))
+    os.kill(os.getpid(), signum)
+
+
+def log_buffering(enabled=True):
+    """Enable or disable buffering of log messages.
+
+    Disabling buffering flushes anything already buffered. Buffered
+    messages are also flushed when the interpreter exits, and before the
+    hook is terminated by one of LOG_FLUSH_SIGNALS."""
+    _log_buffer_state['enabled'] = enabled
+    handlers = _log_buffer_state['handlers']
+    try:
+        for signum in LOG_FLUSH_SIGNALS:
+            if enabled and signum not in handlers:
+                handlers[signum] = signal.signal(signum, _flush_log_on_signal)
+            elif not enabled and signum in handlers:
+                signal.signal(signum, handlers.pop(signum))
+    except ValueError:
+        # Signal handlers can only be changed from the main thread
+        pass
+    if not enabled:
+        flush_log()
+
+
+_py_atexit.register(flush_log)
+
+
 class Serializable(UserDict):
     """Wrapper, an object that can be serialized to yaml or json"""
 
@@ -254,19 +439,58 @@ class Config(dict):
         >>> # keys/values that we add are preserved across hooks
         >>> config['mykey']
         'myval'
+        >>> # test a set of keys at once
+        >>> config.any_changed('foo', 'bar')
+        True
+
+    Values of options are coerced to the type declared in config.yaml, and
+    the set of keys which changed since the previous hook is computed once,
+    when the config is loaded.
 
     """
     CONFIG_FILE_NAME = '.juju-persistent-config'
+    # unitdata key of the option values last passed to mark_applied
+    APPLIED_KEY = 'config.applied'
+    _option_types = None
 
     def __init__(self, *args, **kw):
         super(Config, self).__init__(*args, **kw)
         self.implicit_save = True
         self._prev_dict = None
+        self._changed = None
+        self._options = frozenset(self)
+        self._coerce_types()
         self.path = os.path.join(charm_dir(), Config.CONFIG_FILE_NAME)
         if os.path.exists(self.path):
             self.load_previous()
+        else:
+            self._changed = frozenset(self)
         atexit(self._implicit_save)
 
+    @classmethod
+    def option_types(cls):
+        """Return the type of each option declared in config.yaml."""
+        if cls._option_types is None:
+            cls._option_types = {}
+            path = os.path.join(charm_dir() or '', 'config.yaml')
+            if os.path.exists(path):
+                with open(path) as f:
+                    options = (yaml.safe_load(f) or {}).get('options') or {}
+                cls._option_types = dict((k, v.get('type', 'string'))
+                                         for k, v in options.items())
+        return cls._option_types
+
+    def _coerce_types(self):
+        coercions = {'int': int, 'float': float, 'boolean': _to_bool}
+        for key, option_type in self.option_types().items():
+            value = self.get(key)
+            if value is None or option_type not in coercions:
+                continue
+            try:
+                self[key] = coercions[option_type](value)
+            except (TypeError, ValueError):
+                pass
+
     def load_previous(self, path=None):
         """Load previous copy of config from disk.
 
@@ -284,18 +508,55 @@ class Config(dict):
         self.path = path or self.path
         with open(self.path) as f:
             self._prev_dict = json.load(f)
-        for k, v in copy.deepcopy(self._prev_dict).items():
-            if k not in self:
-                self[k] = v
+        # Only keys stored by the charm itself are carried over.
+        for k in set(self._prev_dict) - set(self):
+            self[k] = copy.deepcopy(self._prev_dict[k])
+        self._changed = frozenset(
+            k for k in set(self) | set(self._prev_dict)
+            if self._prev_dict.get(k) != self.get(k))
+
+    @property
+    def changed_keys(self):
+        """The keys whose value differs from the previous hook."""
+        return self._changed
 
     def changed(self, key):
-        """Return True if the current value for this key is different from
-        the previous value.
+        """Return True if the value for this key is different from the
+        value in the previous hook.
 
         """
         if self._prev_dict is None:
             return True
-        return self.previous(key) != self.get(key)
+        return key in self._changed
+
+    def any_changed(self, *keys):
+        """Return True if any of keys changed since the previous hook."""
+        if self._prev_dict is None:
+            return True
+        return not self._changed.isdisjoint(keys)
+
+    def changed_since_applied(self):
+        """Return the options whose value differs from when mark_applied
+        was last called, or None if it never was.
+
+        Unlike changed_keys, which compares with the previous hook of any
+        kind, this still reports the options set before install when the
+        first config-changed runs.
+        """
+        applied = unitdata.kv().get(self.APPLIED_KEY)
+        if applied is None:
+            return None
+        return frozenset(k for k in self._options | set(applied)
+                         if applied.get(k) != self.get(k))
+
+    def mark_applied(self):
+        """Record the current option values as applied to the unit.
+
+        The record is kept in unitdata, so it is discarded with the rest of
+        the hook's unitdata changes if the hook fails.
+        """
+        unitdata.kv().set(self.APPLIED_KEY,
+                          dict((k, self[k]) for k in self._options))
 
     def previous(self, key):
         """Return previous value for this key, or None if there
@@ -326,25 +587,33 @@ class Config(dict):
             self.save()
 
 
+def _to_bool(value):
+    if isinstance(value, six.string_types):
+        return bool_from_string(value)
+    return bool(value)
+
+
 @cached
-def config(scope=None):
-    """Juju charm configuration"""
-    config_cmd_line = ['config-get']
-    if scope is not None:
-        config_cmd_line.append(scope)
-    else:
-        config_cmd_line.append('--all')
-    config_cmd_line.append('--format=json')
+def _config_snapshot():
+    config_cmd_line = ['config-get', '--all', '--format=json']
     try:
-        config_data = json.loads(
-            subprocess.check_output(config_cmd_line).decode('UTF-8'))
-        if scope is not None:
-            return config_data
-        return Config(config_data)
+        return Config(json.loads(
+            _read_hook_tool(config_cmd_line).decode('UTF-8')))
     except ValueError:
         return None
 
 
+def config(scope=None):
+    """Juju charm configuration
+
+    All options are fetched with a single config-get call per hook; scope
+    selects a single value from them."""
+    snapshot = _config_snapshot()
+    if scope is None or snapshot is None:
+        return snapshot
+    return snapshot.get(scope)
+
+
 @cached
 def relation_get(attribute=None, unit=None, rid=None):
     """Get relation information"""
@@ -356,7 +625,7 @@ def relation_get(attribute=None, unit=None, rid=None):
     if unit:
         _args.append(unit)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_read_hook_tool(_args).decode('UTF-8'))
     except ValueError:
         return None
     except CalledProcessError as e:
@@ -369,7 +638,7 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
     """Set relation information for the current unit"""
     relation_settings = relation_settings if relation_settings else {}
     relation_cmd_line = ['relation-set']
-    accepts_file = "--file" in subprocess.check_output(
+    accepts_file = "--file" in _read_hook_tool(
         relation_cmd_line + ["--help"], universal_newlines=True)
     if relation_id is not None:
         relation_cmd_line.extend(('-r', relation_id))
@@ -387,7 +656,7 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
         # stdin, but that feature is broken in 1.23.2: Bug #1454678.
         with tempfile.NamedTemporaryFile(delete=False) as settings_file:
             settings_file.write(yaml.safe_dump(settings).encode("utf-8"))
-        subprocess.check_call(
+        _run_hook_tool(
             relation_cmd_line + ["--file", settings_file.name])
         os.remove(settings_file.name)
     else:
@@ -396,7 +665,7 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
                 relation_cmd_line.append('{}='.format(key))
             else:
                 relation_cmd_line.append('{}={}'.format(key, value))
-        subprocess.check_call(relation_cmd_line)
+        _run_hook_tool(relation_cmd_line)
     # Flush cache of any relation-gets for local unit
     flush(local_unit())
 
@@ -420,7 +689,7 @@ def relation_ids(reltype=None):
     if reltype is not None:
         relid_cmd_line.append(reltype)
         return json.loads(
-            subprocess.check_output(relid_cmd_line).decode('UTF-8')) or []
+            _read_hook_tool(relid_cmd_line).decode('UTF-8')) or []
     return []
 
 
@@ -432,7 +701,7 @@ def related_units(relid=None):
     if relid is not None:
         units_cmd_line.extend(('-r', relid))
     return json.loads(
-        subprocess.check_output(units_cmd_line).decode('UTF-8')) or []
+        _read_hook_tool(units_cmd_line).decode('UTF-8')) or []
 
 
 @cached
@@ -606,28 +875,28 @@ def open_port(port, protocol="TCP"):
     """Open a service network port"""
     _args = ['open-port']
     _args.append('{}/{}'.format(port, protocol))
-    subprocess.check_call(_args)
+    _run_hook_tool(_args)
 
 
 def close_port(port, protocol="TCP"):
     """Close a service network port"""
     _args = ['close-port']
     _args.append('{}/{}'.format(port, protocol))
-    subprocess.check_call(_args)
+    _run_hook_tool(_args)
 
 
 def open_ports(start, end, protocol="TCP"):
     """Opens a range of service network ports"""
     _args = ['open-port']
     _args.append('{}-{}/{}'.format(start, end, protocol))
-    subprocess.check_call(_args)
+    _run_hook_tool(_args)
 
 
 def close_ports(start, end, protocol="TCP"):
     """Close a range of service network ports"""
     _args = ['close-port']
     _args.append('{}-{}/{}'.format(start, end, protocol))
-    subprocess.check_call(_args)
+    _run_hook_tool(_args)
 
 
 @cached
@@ -635,7 +904,7 @@ def unit_get(attribute):
     """Get the unit ID for the remote unit"""
     _args = ['unit-get', '--format=json', attribute]
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_read_hook_tool(_args).decode('UTF-8'))
     except ValueError:
         return None
 
@@ -659,7 +928,7 @@ def storage_get(attribute=None, storage_id=None):
     if attribute:
         _args.append(attribute)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_read_hook_tool(_args).decode('UTF-8'))
     except ValueError:
         return None
 
@@ -671,7 +940,7 @@ def storage_list(storage_name=None):
     if storage_name:
         _args.append(storage_name)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        return json.loads(_read_hook_tool(_args).decode('UTF-8'))
     except ValueError:
         return None
     except OSError as e:
@@ -709,9 +978,12 @@ class Hooks(object):
             hooks.execute(sys.argv)
     """
 
-    def __init__(self, config_save=None):
+    def __init__(self, config_save=None, profile=None):
         super(Hooks, self).__init__()
         self._hooks = {}
+        # Optional callable returning True when hook execution should be
+        # profiled, see charmhelpers.core.profiling.
+        self._profile = profile
 
         # For unknown reasons, we allow the Hooks constructor to override
         # config().implicit_save.
@@ -724,6 +996,48 @@ class Hooks(object):
 
     def execute(self, args):
         """Execute a registered hook based on args[0]"""
+        log_buffering(True)
+        unitdata.defer_commits()
+        profile = self._profile is not None and self._profile()
+        if profile:
+            profiling.start(os.path.basename(args[0]))
+        succeeded = False
+        try:
+            self._execute(args)
+            succeeded = True
+        except SystemExit as x:
+            succeeded = x.code is None or x.code == 0
+            raise
+        except Exception:
+            # Logged at ERROR so it is written out with the buffered
+            # messages that led up to it.
+            log('Hook {} failed:\n{}'.format(os.path.basename(args[0]),
+                                             traceback.format_exc()),
+                level=ERROR)
+            raise
+        finally:
+            if profile:
+                entry = profiling.finish(save=succeeded)
+                phases = sorted(entry['phases'].items(),
+                                key=lambda p: p[1]['seconds'], reverse=True)
+                log('Hook {} took {}s: {}'.format(
+                    entry['hook'], entry['duration'],
+                    ', '.join('{} {}s/{}'.format(name, p['seconds'],
+                                                 p['count'])
+                              for name, p in phases)), level=DEBUG)
+            stats = sorted(_hook_tool_stats.items(),
+                           key=lambda t: t[1]['seconds'], reverse=True)
+            if stats:
+                log('Hook tools: {}'.format(', '.join(
+                    '{} {} calls {} cached {:.3f}s'.format(
+                        tool, t['calls'], t['cached'], t['seconds'])
+                    for tool, t in stats)), level=DEBUG)
+            try:
+                unitdata.commit_deferred(succeeded)
+            finally:
+                log_buffering(False)
+
+    def _execute(self, args):
         _run_atstart()
         hook_name = os.path.basename(args[0])
         if hook_name in self._hooks:
@@ -763,7 +1077,7 @@ def action_get(key=None):
     if key is not None:
         cmd.append(key)
     cmd.append('--format=json')
-    action_data = json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    action_data = json.loads(_read_hook_tool(cmd).decode('UTF-8'))
     return action_data
 
 
@@ -772,14 +1086,14 @@ def action_set(values):
     cmd = ['action-set']
     for k, v in list(values.items()):
         cmd.append('{}={}'.format(k, v))
-    subprocess.check_call(cmd)
+    _run_hook_tool(cmd)
 
 
 def action_fail(message):
     """Sets the action status to failed and sets the error message.
 
     The results set by action_set are preserved."""
-    subprocess.check_call(['action-fail', message])
+    _run_hook_tool(['action-fail', message])
 
 
 def action_name():
@@ -797,12 +1111,34 @@ def action_tag():
     return os.environ.get('JUJU_ACTION_TAG')
 
 
+# The workload state and message last set by status_set
+_last_status = {}
+_STATUS_GET_CMD = ['status-get', "--format=json", "--include-data"]
+
+
+def _current_status():
+    """Return the workload state and message known without running a hook
+    tool: the last status_set, else a status_get already read this hook.
+
+    status-get is not run just to compare with: it costs the same fork the
+    comparison would save."""
+    if 'status' in _last_status:
+        return _last_status['status']
+    raw_status = _hook_tool_cache.get((tuple(_STATUS_GET_CMD), ()))
+    if raw_status is None:
+        return None
+    status = json.loads(raw_status.decode("UTF-8"))
+    return (status["status"], status["message"])
+
+
 def status_set(workload_state, message):
     """Set the workload state with a message
 
     Use status-set to set the workload state with a message which is visible
     to the user via juju status. If the status-set command is not found then
-    assume this is juju < 1.23 and juju-log the message unstead.
+    assume this is juju < 1.23 and juju-log the message unstead. Nothing is
+    set if the same state and message were already set by this process, or
+    were returned by a status_get earlier in the hook.
 
     workload_state -- valid juju workload state.
     message        -- status update message
@@ -812,10 +1148,13 @@ def status_set(workload_state, message):
         raise ValueError(
             '{!r} is not a valid workload state'.format(workload_state)
         )
+    if _current_status() == (workload_state, message):
+        return
     cmd = ['status-set', workload_state, message]
     try:
-        ret = subprocess.call(cmd)
+        ret = _run_hook_tool(cmd, check=False)
         if ret == 0:
+            _last_status['status'] = (workload_state, message)
             return
     except OSError as e:
         if e.errno != errno.ENOENT:
@@ -832,9 +1171,8 @@ def status_get():
     return 'unknown', ""
 
     """
-    cmd = ['status-get', "--format=json", "--include-data"]
     try:
-        raw_status = subprocess.check_output(cmd)
+        raw_status = _read_hook_tool(_STATUS_GET_CMD)
     except OSError as e:
         if e.errno == errno.ENOENT:
             return ('unknown', "")
@@ -868,7 +1206,7 @@ def application_version_set(version):
     cmd = ['application-version-set']
     cmd.append(version)
     try:
-        subprocess.check_call(cmd)
+        _run_hook_tool(cmd)
     except OSError:
         log("Application Version: {}".format(version))
 
@@ -880,14 +1218,14 @@ def is_leader():
     Uses juju to determine whether the current unit is the leader of its peers
     """
     cmd = ['is-leader', '--format=json']
-    return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    return json.loads(_read_hook_tool(cmd).decode('UTF-8'))
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
 def leader_get(attribute=None):
     """Juju leader get value(s)"""
     cmd = ['leader-get', '--format=json'] + [attribute or '-']
-    return json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    return json.loads(_read_hook_tool(cmd).decode('UTF-8'))
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -903,7 +1241,7 @@ def leader_set(settings=None, **kwargs):
             cmd.append('{}='.format(k))
         else:
             cmd.append('{}={}'.format(k, v))
-    subprocess.check_call(cmd)
+    _run_hook_tool(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -913,7 +1251,7 @@ def payload_register(ptype, klass, pid):
     cmd = ['payload-register']
     for x in [ptype, klass, pid]:
         cmd.append(x)
-    subprocess.check_call(cmd)
+    _run_hook_tool(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -925,7 +1263,7 @@ def payload_unregister(klass, pid):
     cmd = ['payload-unregister']
     for x in [klass, pid]:
         cmd.append(x)
-    subprocess.check_call(cmd)
+    _run_hook_tool(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -937,7 +1275,7 @@ def payload_status_set(klass, pid, status):
     cmd = ['payload-status-set']
     for x in [klass, pid, status]:
         cmd.append(x)
-    subprocess.check_call(cmd)
+    _run_hook_tool(cmd)
 
 
 @translate_exc(from_exc=OSError, to_exc=NotImplementedError)
@@ -953,7 +1291,7 @@ def resource_get(name):
 
     cmd = ['resource-get', name]
     try:
-        return subprocess.check_output(cmd).decode('UTF-8')
+        return _read_hook_tool(cmd).decode('UTF-8')
     except subprocess.CalledProcessError:
         return False
 
@@ -1034,7 +1372,7 @@ def network_get_primary_address(binding):
     :raise: NotImplementedError if run on Juju < 2.0
     '''
     cmd = ['network-get', '--primary-address', binding]
-    return subprocess.check_output(cmd).decode('UTF-8').strip()
+    return _read_hook_tool(cmd).decode('UTF-8').strip()
 
 
 def add_metric(*args, **kwargs):
@@ -1048,7 +1386,7 @@ def add_metric(*args, **kwargs):
     _kvpairs.extend(['{}={}'.format(k, v) for k, v in kwargs.items()])
     _args.extend(sorted(_kvpairs))
     try:
-        subprocess.check_call(_args)
+        _run_hook_tool(_args)
         return
     except EnvironmentError as e:
         if e.errno != errno.ENOENT:
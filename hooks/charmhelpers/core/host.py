@@ -35,6 +35,7 @@ import six
 from contextlib import contextmanager
 from collections import OrderedDict
 from .hookenv import log
+from .profiling import phase, profiled
 from .fstab import Fstab
 from charmhelpers.osplatform import get_platform
 
@@ -242,6 +243,7 @@ def service_resume(service_name, init_dir="/etc/init",
     return started
 
 
+@profiled('service')
 def service(action, service_name, **kwargs):
     """Control a system service.
 
@@ -651,12 +653,14 @@ def restart_on_change_helper(lambda_f, restart_map, stopstart=False,
     """
     if restart_functions is None:
         restart_functions = {}
-    checksums = {path: path_hash(path) for path in restart_map}
+    with phase('restart_on_change'):
+        checksums = {path: path_hash(path) for path in restart_map}
     r = lambda_f()
     # create a list of lists of the services to restart
-    restarts = [restart_map[path]
-                for path in restart_map
-                if path_hash(path) != checksums[path]]
+    with phase('restart_on_change'):
+        restarts = [restart_map[path]
+                    for path in restart_map
+                    if path_hash(path) != checksums[path]]
     # create a flat list of ordered services without duplicates from lists
     services_list = list(OrderedDict.fromkeys(itertools.chain(*restarts)))
     if services_list:
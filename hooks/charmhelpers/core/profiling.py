@@ -0,0 +1,156 @@
+# Copyright 2016 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Opt-in wall time profiling of hook execution.
+
+Code paths which are expensive or fork external commands are wrapped in
+named phases::
+
+    from charmhelpers.core.profiling import phase, profiled
+
+    @profiled('apt')
+    def _run_apt_command(cmd, fatal=False):
+        ...
+
+    with phase('restart_on_change'):
+        checksums = {path: path_hash(path) for path in restart_map}
+
+Phases are only timed between start() and finish(), which Hooks.execute
+calls when the charm enables profiling. Each successful hook appends its
+timings to a rolling ledger kept in unitdata, which can be read back with
+ledger() and summarised with summary().
+"""
+
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+from charmhelpers.core import unitdata
+
+__author__ = 'Canonical Ltd.'
+
+LEDGER_KEY = 'hook-stats'
+LEDGER_SIZE = 50
+
+_phases = OrderedDict()
+_state = {'hook': None, 'start': None}
+
+
+def enabled():
+    """Return True while a hook is being profiled."""
+    return _state['hook'] is not None
+
+
+def record(name, seconds):
+    """Add a single timing for phase name."""
+    count, total = _phases.get(name, (0, 0.0))
+    _phases[name] = (count + 1, total + seconds)
+
+
+@contextmanager
+def phase(name):
+    """Time the enclosed block as phase name."""
+    if not enabled():
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start)
+
+
+def profiled(name):
+    """Decorator timing each call of the decorated function as phase name."""
+    def wrapper(f):
+        @wraps(f)
+        def wrapped_f(*args, **kwargs):
+            if not enabled():
+                return f(*args, **kwargs)
+            with phase(name):
+                return f(*args, **kwargs)
+        return wrapped_f
+    return wrapper
+
+
+def start(hook_name):
+    """Start profiling hook_name, discarding any previous timings."""
+    _phases.clear()
+    _state['hook'] = hook_name
+    _state['start'] = time.time()
+
+
+def finish(save=True):
+    """Stop profiling and return the timings of the hook.
+
+    :param save: append the timings to the ledger in unitdata and flush it.
+                 This should be False if the hook failed, as flushing would
+                 also commit any other unitdata changes made by the hook.
+    :returns: dict of hook, start, duration and phases, each phase being a
+              dict of count and seconds.
+    """
+    if not enabled():
+        return None
+    entry = {
+        'hook': _state['hook'],
+        'start': datetime.utcfromtimestamp(_state['start']).isoformat(),
+        'duration': round(time.time() - _state['start'], 3),
+        'phases': dict((name, {'count': count, 'seconds': round(total, 3)})
+                       for name, (count, total) in _phases.items()),
+    }
+    _state['hook'] = _state['start'] = None
+    _phases.clear()
+    if save:
+        kv = unitdata.kv()
+        entries = kv.get(LEDGER_KEY, [])
+        entries.append(entry)
+        kv.set(LEDGER_KEY, entries[-LEDGER_SIZE:])
+        kv.flush()
+    return entry
+
+
+def ledger():
+    """Return the recorded hook timings, oldest first."""
+    return unitdata.kv().get(LEDGER_KEY, [])
+
+
+def summary(entries=None):
+    """Aggregate ledger entries per hook.
+
+    :returns: dict keyed by hook name of runs, mean and max duration and the
+              mean seconds spent per run in each phase.
+    """
+    if entries is None:
+        entries = ledger()
+    hooks = {}
+    for entry in entries:
+        hooks.setdefault(entry['hook'], []).append(entry)
+    result = {}
+    for hook, runs in hooks.items():
+        durations = [r['duration'] for r in runs]
+        phases = {}
+        for r in runs:
+            for name, p in r['phases'].items():
+                phases[name] = phases.get(name, 0.0) + p['seconds']
+        result[hook] = {
+            'runs': len(runs),
+            'mean': round(sum(durations) / len(runs), 3),
+            'max': max(durations),
+            'phases': dict((name, round(total / len(runs), 3))
+                           for name, total in phases.items()),
+        }
+    return result
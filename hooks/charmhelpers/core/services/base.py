@@ -14,6 +14,7 @@
 
 import os
 import json
+import hashlib
 from inspect import getargspec
 from collections import Iterable, OrderedDict
 
@@ -85,6 +86,18 @@ class ServiceManager(object):
         and the default 'stop' handler will close the ports prior to stopping
         the service.
 
+        Readiness is evaluated incrementally.  Each 'required_data' item is
+        reduced to a digest, taken from its `digest()` method or `version`
+        attribute if it has one, or else from its JSON serialised contents.
+        Callbacks with a `digest()` method, such as templates, contribute the
+        digest of their own inputs and outputs.  When a service's readiness
+        and the digest of its 'required_data', callbacks and 'ports' are
+        unchanged since the last hook, its callbacks are skipped.  Services
+        with an item which cannot be digested are never skipped.  Services
+        skipped by the last pass are listed in `skipped`.  The
+        'upgrade-charm' hook, or naming services explicitly in
+        `reconfigure_services()`, always fires the callbacks.
+
 
         Examples:
 
@@ -117,6 +130,9 @@ class ServiceManager(object):
         """
         self._ready_file = os.path.join(hookenv.charm_dir(), 'READY-SERVICES.json')
         self._ready = None
+        self._digests = None
+        self._readiness = {}
+        self.skipped = []
         self.services = OrderedDict()
         for service in services or []:
             service_name = service['service']
@@ -162,7 +178,9 @@ class ServiceManager(object):
         services.
         """
         for service_name, service in self.services.items():
-            service_ready = self.is_ready(service_name)
+            service_ready = self._readiness.get(service_name)
+            if service_ready is None:
+                service_ready = self.is_ready(service_name)
             for provider in service.get('provided_data', []):
                 for relid in hookenv.relation_ids(provider.name):
                     units = hookenv.related_units(relid)
@@ -182,22 +200,42 @@ class ServiceManager(object):
         Update all files for one or more registered services, and,
         if ready, optionally restart them.
 
-        If no service names are given, reconfigures all registered services.
+        If no service names are given, reconfigures all registered services,
+        skipping those whose readiness and inputs are unchanged since the
+        last hook.
         """
+        force = bool(service_names) or hookenv.hook_name() == 'upgrade-charm'
+        self._load_ready_file()
+        self._readiness = {}
+        self.skipped = []
         for service_name in service_names or self.services.keys():
-            if self.is_ready(service_name):
+            ready = self._readiness[service_name] = self.is_ready(service_name)
+            digest = self.service_digest(service_name)
+            unchanged = (digest is not None and
+                         self.was_ready(service_name) == ready and
+                         self._digests.get(service_name) == digest)
+            if unchanged and not force:
+                self.skipped.append(service_name)
+                continue
+            if ready:
                 self.fire_event('data_ready', service_name)
                 self.fire_event('start', service_name, default=[
                     service_restart,
                     manage_ports])
-                self.save_ready(service_name)
+                # The callbacks' outputs are part of the digest
+                self.save_ready(service_name,
+                                self.service_digest(service_name))
             else:
                 if self.was_ready(service_name):
                     self.fire_event('data_lost', service_name)
                 self.fire_event('stop', service_name, default=[
                     manage_ports,
                     service_stop])
-                self.save_lost(service_name)
+                self.save_lost(service_name,
+                               self.service_digest(service_name))
+        if self.skipped:
+            hookenv.log('Inputs unchanged, skipped services: {}'.format(
+                ', '.join(self.skipped)), hookenv.DEBUG)
 
     def stop_services(self, *service_names):
         """
@@ -246,36 +284,73 @@ class ServiceManager(object):
         reqs = service.get('required_data', [])
         return all(bool(req) for req in reqs)
 
+    def service_digest(self, service_name):
+        """
+        Return a digest of the 'required_data', callbacks and 'ports' of a
+        service, or None if any of them cannot be digested.
+        """
+        service = self.get_service(service_name)
+        parts = [_digest(req) for req in service.get('required_data', [])]
+        for event_name in ('data_ready', 'start', 'data_lost', 'stop'):
+            callbacks = service.get(event_name) or []
+            if not isinstance(callbacks, Iterable):
+                callbacks = [callbacks]
+            for callback in callbacks:
+                if callable(getattr(callback, 'digest', None)):
+                    parts.append(callback.digest())
+        parts.append(_digest(service.get('ports', [])))
+        if None in parts:
+            return None
+        return hashlib.md5('\n'.join(
+            str(part) for part in parts).encode('utf-8')).hexdigest()
+
     def _load_ready_file(self):
         if self._ready is not None:
             return
+        self._ready = set()
+        self._digests = {}
         if os.path.exists(self._ready_file):
             with open(self._ready_file) as fp:
-                self._ready = set(json.load(fp))
-        else:
-            self._ready = set()
+                data = json.load(fp)
+            if isinstance(data, dict):
+                self._ready = set(data.get('ready', []))
+                self._digests = data.get('digests', {})
+            else:
+                self._ready = set(data)
 
     def _save_ready_file(self):
         if self._ready is None:
             return
         with open(self._ready_file, 'w') as fp:
-            json.dump(list(self._ready), fp)
+            json.dump({'ready': sorted(self._ready),
+                       'digests': self._digests}, fp)
 
-    def save_ready(self, service_name):
+    def _save_state(self, service_name, ready, digest):
+        self._load_ready_file()
+        state = (service_name in self._ready, self._digests.get(service_name))
+        if ready:
+            self._ready.add(service_name)
+        else:
+            self._ready.discard(service_name)
+        if digest is None:
+            self._digests.pop(service_name, None)
+        else:
+            self._digests[service_name] = digest
+        if state != (ready, self._digests.get(service_name)):
+            self._save_ready_file()
+
+    def save_ready(self, service_name, digest=None):
         """
-        Save an indicator that the given service is now data_ready.
+        Save an indicator that the given service is now data_ready, and
+        optionally the digest of the inputs it was configured with.
         """
-        self._load_ready_file()
-        self._ready.add(service_name)
-        self._save_ready_file()
+        self._save_state(service_name, True, digest)
 
-    def save_lost(self, service_name):
+    def save_lost(self, service_name, digest=None):
         """
         Save an indicator that the given service is no longer data_ready.
         """
-        self._load_ready_file()
-        self._ready.discard(service_name)
-        self._save_ready_file()
+        self._save_state(service_name, False, digest)
 
     def was_ready(self, service_name):
         """
@@ -285,6 +360,25 @@ class ServiceManager(object):
         return service_name in self._ready
 
 
+def _digest(data):
+    """
+    Return a digest of a 'required_data' item.
+
+    Items may provide their own through a `digest()` method or a `version`
+    attribute; anything else is digested from its JSON serialised contents,
+    or if it cannot be serialised, None is returned.
+    """
+    if callable(getattr(data, 'digest', None)):
+        return data.digest()
+    if getattr(data, 'version', None) is not None:
+        return str(data.version)
+    try:
+        serialized = json.dumps(data, sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+    return hashlib.md5(serialized.encode('utf-8')).hexdigest()
+
+
 class ManagerCallback(object):
     """
     Special case of a callback that takes the `ServiceManager` instance
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
 import os
 import yaml
 
@@ -285,6 +287,21 @@ class TemplateCallback(ManagerCallback):
 
         return result
 
+    def digest(self):
+        """
+        Return a digest of the template, the target as last rendered and
+        the file attributes, or None for templates from a custom loader.
+        """
+        if self.template_loader is not None:
+            return None
+        source = self.source
+        if not os.path.isabs(source):
+            source = os.path.join(hookenv.charm_dir(), 'templates', source)
+        target = host.file_hash(self.target) if self.target else None
+        parts = [self.source, self.target, self.owner, self.group,
+                 self.perms, host.file_hash(source), target]
+        return hashlib.md5(json.dumps(parts).encode('utf-8')).hexdigest()
+
 
 # Convenience aliases for templates
 render_template = template = TemplateCallback
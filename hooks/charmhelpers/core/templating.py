@@ -12,15 +12,69 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import grp
 import os
+import pwd
+import stat
 import sys
 
 from charmhelpers.core import host
 from charmhelpers.core import hookenv
+from charmhelpers.core.profiling import profiled
 
+BYTECODE_CACHE_DIR = '.jinja2-cache'
 
+# Environments by templates_dir or template_loader, so templates are only
+# compiled once per hook.
+_environments = {}
+
+
+def _environment(templates_dir, template_loader):
+    from jinja2 import FileSystemLoader, Environment
+    key = template_loader or templates_dir
+    if key not in _environments:
+        loader = template_loader or FileSystemLoader(templates_dir)
+        _environments[key] = Environment(loader=loader,
+                                         bytecode_cache=_bytecode_cache())
+    return _environments[key]
+
+
+def _bytecode_cache():
+    """Return a bytecode cache persisted in the charm directory, so
+    templates are not compiled again in later hooks, or None."""
+    from jinja2 import FileSystemBytecodeCache
+    charm_dir = hookenv.charm_dir()
+    if not charm_dir:
+        return None
+    cache_dir = os.path.join(charm_dir, BYTECODE_CACHE_DIR)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.mkdir(cache_dir, 0o700)
+    except OSError:
+        return None
+    return FileSystemBytecodeCache(cache_dir)
+
+
+def _unchanged(path, content, owner, group, perms):
+    """Return True if path already holds content with the given ownership
+    and permissions."""
+    try:
+        st = os.stat(path)
+        if (stat.S_IMODE(st.st_mode) != perms or
+                st.st_uid != pwd.getpwnam(owner).pw_uid or
+                st.st_gid != grp.getgrnam(group).gr_gid or
+                st.st_size != len(content)):
+            return False
+        with open(path, 'rb') as f:
+            return f.read() == content
+    except (OSError, IOError, KeyError):
+        return False
+
+
+@profiled('render')
 def render(source, target, context, owner='root', group='root',
-           perms=0o444, templates_dir=None, encoding='UTF-8', template_loader=None):
+           perms=0o444, templates_dir=None, encoding='UTF-8',
+           template_loader=None, skip_unchanged=False):
     """
     Render a template.
 
@@ -36,6 +90,13 @@ def render(source, target, context, owner='root', group='root',
 
     If omitted, `templates_dir` defaults to the `templates` folder in the charm.
 
+    If `skip_unchanged` is True, the target is not written when it already
+    has the rendered content, owner, group and perms.
+
+    Jinja2 environments are reused for the same `templates_dir` or
+    `template_loader`, and compiled templates are cached in the charm
+    directory across hooks.
+
     The rendered template will be written to the file as well as being returned
     as a string.
 
@@ -44,7 +105,7 @@ def render(source, target, context, owner='root', group='root',
     to install it.
     """
     try:
-        from jinja2 import FileSystemLoader, Environment, exceptions
+        from jinja2 import exceptions
     except ImportError:
         try:
             from charmhelpers.fetch import apt_install
@@ -57,16 +118,12 @@ def render(source, target, context, owner='root', group='root',
             apt_install('python-jinja2', fatal=True)
         else:
             apt_install('python3-jinja2', fatal=True)
-        from jinja2 import FileSystemLoader, Environment, exceptions
-
-    if template_loader:
-        template_env = Environment(loader=template_loader)
-    else:
-        if templates_dir is None:
-            templates_dir = os.path.join(hookenv.charm_dir(), 'templates')
-        template_env = Environment(loader=FileSystemLoader(templates_dir))
+        from jinja2 import exceptions
+
+    if not template_loader and templates_dir is None:
+        templates_dir = os.path.join(hookenv.charm_dir(), 'templates')
+    template_env = _environment(templates_dir, template_loader)
     try:
-        source = source
         template = template_env.get_template(source)
     except exceptions.TemplateNotFound as e:
         hookenv.log('Could not load template %s from %s.' %
@@ -75,10 +132,15 @@ def render(source, target, context, owner='root', group='root',
         raise e
     content = template.render(context)
     if target is not None:
+        data = content.encode(encoding)
+        if skip_unchanged and _unchanged(target, data, owner, group, perms):
+            hookenv.log('Skipping unchanged {}'.format(target),
+                        level=hookenv.DEBUG)
+            return content
         target_dir = os.path.dirname(target)
         if not os.path.exists(target_dir):
             # This is a terrible default directory permission, as the file
             # or its siblings will often contain secrets.
             host.mkdir(os.path.dirname(target), owner, group, perms=0o755)
-        host.write_file(target, content.encode(encoding), owner, group, perms)
+        host.write_file(target, data, owner, group, perms)
     return content
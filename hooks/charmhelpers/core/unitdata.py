@@ -153,11 +153,23 @@ import itertools
 import json
 import os
 import pprint
+import re
 import sqlite3
+import string
 import sys
 
+import six
+
 __author__ = 'Kapil Thangavelu <kapil.foss@gmail.com>'
 
+_SCALAR_TYPES = six.string_types + six.integer_types + (float, bool)
+
+
+def _ascii_case(text, upper):
+    """Change the case of ASCII letters only, as sqlite's LIKE folds."""
+    return ''.join((c.upper() if upper else c.lower())
+                   if c in string.ascii_letters else c for c in text)
+
 
 class Storage(object):
     """Simple key value database for local unit state within charms.
@@ -166,8 +178,28 @@ class Storage(object):
 
     To support dicts, lists, integer, floats, and booleans values
     are automatically json encoded/decoded.
+
+    The database uses sqlite's write-ahead log. While commits are deferred
+    (see :meth:`defer_commits`), :meth:`flush` only marks the state to be
+    committed with a savepoint, and it is committed once by
+    :meth:`commit_deferred` at the end of the hook, unless a durable flush
+    is requested.
+
+    The history of hooks and key revisions recorded by :meth:`hook_scope`
+    is retained for the last ``history_hooks`` hooks, and no longer than
+    ``history_days`` days; older history is removed by :meth:`compact`.
+    These default to the UNIT_STATE_HISTORY_HOOKS and
+    UNIT_STATE_HISTORY_DAYS environment variables, or 1000 hooks and 30
+    days. A value of 0 keeps history without limit.
     """
-    def __init__(self, path=None):
+    # Maximum number of bound parameters in a single sqlite statement
+    MAX_VARIABLES = 900
+    HISTORY_HOOKS = 1000
+    HISTORY_DAYS = 30
+    # Number of hooks removed by the compaction step at the end of a hook
+    COMPACT_BATCH = 50
+
+    def __init__(self, path=None, history_hooks=None, history_days=None):
         self.db_path = path
         if path is None:
             if 'UNIT_STATE_DB' in os.environ:
@@ -179,24 +211,98 @@ class Storage(object):
         self.cursor = self.conn.cursor()
         self.revision = None
         self._closed = False
+        self._deferred = False
+        # Whether the flushed savepoint exists while commits are deferred
+        self._flushed = False
+        # Serialized values by key, None for keys known not to be set
+        self._cache = {}
+        self._decoded = {}
+        if history_hooks is None:
+            history_hooks = int(os.environ.get('UNIT_STATE_HISTORY_HOOKS',
+                                               self.HISTORY_HOOKS))
+        if history_days is None:
+            history_days = float(os.environ.get('UNIT_STATE_HISTORY_DAYS',
+                                                self.HISTORY_DAYS))
+        self.history_hooks = history_hooks
+        self.history_days = history_days
         self._init()
 
     def close(self):
         if self._closed:
             return
+        if self._deferred:
+            self.commit_deferred(False)
         self.flush(False)
         self.cursor.close()
         self.conn.close()
         self._closed = True
 
-    def get(self, key, default=None, record=False):
+    def _cached(self, key):
+        """Return the serialized value of key, or None if it is not set.
+
+        Values are cached as read or written, and only decoded on access.
+        """
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
         self.cursor.execute('select data from kv where key=?', [key])
         result = self.cursor.fetchone()
-        if not result:
+        self._cache[key] = result[0] if result else None
+        return self._cache[key]
+
+    def _decode(self, key, data):
+        # Immutable values are decoded once; containers are decoded on
+        # every access so callers may modify what they are given.
+        try:
+            return self._decoded[key]
+        except KeyError:
+            pass
+        value = json.loads(data)
+        if value is None or isinstance(value, _SCALAR_TYPES):
+            self._decoded[key] = value
+        return value
+
+    def _invalidate(self, key=None, prefix=None):
+        if key is not None:
+            self._decoded.pop(key, None)
+            return
+        if prefix:
+            prefix = _ascii_case(prefix, False)
+            for k in [k for k in self._cache
+                      if _ascii_case(k, False).startswith(prefix)]:
+                del self._cache[k]
+                self._decoded.pop(k, None)
+        else:
+            self._cache.clear()
+            self._decoded.clear()
+
+    def get(self, key, default=None, record=False):
+        data = self._cached(key)
+        if data is None:
             return default
         if record:
-            return Record(json.loads(result[0]))
-        return json.loads(result[0])
+            return Record(json.loads(data))
+        return self._decode(key, data)
+
+    def _range(self, prefix):
+        """Return the where clause and parameters selecting keys starting
+        with prefix, ignoring the case of ASCII letters as LIKE does.
+
+        The keys are bounded by the prefix in upper and in lower case, a
+        range the primary key index can be used for, and then matched with
+        LIKE, with its wildcards escaped.
+        """
+        if not prefix:
+            return '1', []
+        clause = "key >= ? and key like ? escape '\\'"
+        params = [_ascii_case(prefix, True),
+                  re.sub(r'([\\%_])', r'\\\1', prefix) + '%']
+        lower = _ascii_case(prefix, False)
+        if ord(lower[-1]) < sys.maxunicode:
+            clause += ' and key < ?'
+            params.append(lower[:-1] + six.unichr(ord(lower[-1]) + 1))
+        return clause, params
 
     def getrange(self, key_prefix, strip=False):
         """
@@ -208,12 +314,14 @@ class Storage(object):
             names in the returned dict
         :return dict: A (possibly empty) dict of key-value mappings
         """
-        self.cursor.execute("select key, data from kv where key like ?",
-                            ['%s%%' % key_prefix])
+        clause, params = self._range(key_prefix)
+        self.cursor.execute("select key, data from kv where %s" % clause,
+                            params)
         result = self.cursor.fetchall()
 
         if not result:
             return {}
+        self._cache.update(result)
         if not strip:
             key_prefix = ''
         return dict([
@@ -227,14 +335,53 @@ class Storage(object):
         :param str prefix: Optional prefix to apply to all keys in `mapping`
             before setting
         """
-        for k, v in mapping.items():
-            self.set("%s%s" % (prefix, k), v)
+        self.set_many(
+            ("%s%s" % (prefix, k), v) for k, v in mapping.items())
+
+    def set_many(self, items):
+        """
+        Set the values of multiple keys with one statement per table.
+
+        :param items: Mapping or iterable of (key, value) pairs
+        :return list: The keys whose value changed
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        serialized = collections.OrderedDict(
+            (k, json.dumps(v)) for k, v in items)
+        existing = dict((k, self._cache[k]) for k in serialized
+                        if k in self._cache)
+        keys = [k for k in serialized if k not in existing]
+        for i in range(0, len(keys), self.MAX_VARIABLES):
+            chunk = keys[i:i + self.MAX_VARIABLES]
+            self.cursor.execute(
+                'select key, data from kv where key in (%s)' %
+                ','.join(['?'] * len(chunk)), chunk)
+            existing.update(self.cursor.fetchall())
+        # Skip mutations to the same value
+        changed = [(k, v) for k, v in serialized.items()
+                   if existing.get(k) != v]
+        if not changed:
+            return []
+        self.cursor.executemany(
+            'insert or replace into kv (key, data) values (?, ?)', changed)
+        for k, v in changed:
+            self._cache[k] = v
+            self._invalidate(k)
+        if self.revision:
+            self.cursor.executemany(
+                '''insert or replace into kv_revisions (
+                revision, key, data) values (?, ?, ?)''',
+                [(self.revision, k, v) for k, v in changed])
+        return [k for k, v in changed]
 
     def unset(self, key):
         """
         Remove a key from the database entirely.
         """
         self.cursor.execute('delete from kv where key=?', [key])
+        self._cache[key] = None
+        self._invalidate(key)
         if self.revision and self.cursor.rowcount:
             self.cursor.execute(
                 'insert into kv_revisions values (?, ?, ?)',
@@ -252,13 +399,17 @@ class Storage(object):
         if keys is not None:
             keys = ['%s%s' % (prefix, key) for key in keys]
             self.cursor.execute('delete from kv where key in (%s)' % ','.join(['?'] * len(keys)), keys)
+            for key in keys:
+                self._cache[key] = None
+                self._invalidate(key)
             if self.revision and self.cursor.rowcount:
                 self.cursor.execute(
                     'insert into kv_revisions values %s' % ','.join(['(?, ?, ?)'] * len(keys)),
                     list(itertools.chain.from_iterable((key, self.revision, json.dumps('DELETED')) for key in keys)))
         else:
-            self.cursor.execute('delete from kv where key like ?',
-                                ['%s%%' % prefix])
+            clause, params = self._range(prefix)
+            self.cursor.execute('delete from kv where %s' % clause, params)
+            self._invalidate(prefix=prefix)
             if self.revision and self.cursor.rowcount:
                 self.cursor.execute(
                     'insert into kv_revisions values (?, ?, ?)',
@@ -273,46 +424,31 @@ class Storage(object):
         """
         serialized = json.dumps(value)
 
-        self.cursor.execute('select data from kv where key=?', [key])
-        exists = self.cursor.fetchone()
-
         # Skip mutations to the same value
-        if exists:
-            if exists[0] == serialized:
-                return value
+        if self._cache.get(key) == serialized:
+            return value
 
-        if not exists:
+        # Upsert, skipping mutations to the same value
+        self.cursor.execute(
+            'insert or ignore into kv (key, data) values (?, ?)',
+            (key, serialized))
+        changed = self.cursor.rowcount
+        if not changed:
             self.cursor.execute(
-                'insert into kv (key, data) values (?, ?)',
-                (key, serialized))
-        else:
-            self.cursor.execute('''
-            update kv
-            set data = ?
-            where key = ?''', [serialized, key])
+                'update kv set data = ? where key = ? and data != ?',
+                [serialized, key, serialized])
+            changed = self.cursor.rowcount
+        self._cache[key] = serialized
+        self._invalidate(key)
 
         # Save
-        if not self.revision:
+        if not changed or not self.revision:
             return value
 
         self.cursor.execute(
-            'select 1 from kv_revisions where key=? and revision=?',
-            [key, self.revision])
-        exists = self.cursor.fetchone()
-
-        if not exists:
-            self.cursor.execute(
-                '''insert into kv_revisions (
-                revision, key, data) values (?, ?, ?)''',
-                (self.revision, key, serialized))
-        else:
-            self.cursor.execute(
-                '''
-                update kv_revisions
-                set data = ?
-                where key = ?
-                and   revision = ?''',
-                [serialized, key, self.revision])
+            '''insert or replace into kv_revisions (
+            revision, key, data) values (?, ?, ?)''',
+            (self.revision, key, serialized))
 
         return value
 
@@ -365,15 +501,132 @@ class Storage(object):
         else:
             self.flush()
 
-    def flush(self, save=True):
-        if save:
+    def flush(self, save=True, durable=False):
+        """Commit, or with save=False roll back, pending changes.
+
+        While commits are deferred, saving only marks the current state to
+        be committed by :meth:`commit_deferred`, unless durable is True,
+        and rolling back returns to the state last marked.
+        """
+        if self._deferred:
+            if not save:
+                self._rollback_deferred()
+            elif durable:
+                self.cursor.execute('commit')
+                self.cursor.execute('begin')
+                self._flushed = False
+            else:
+                if self._flushed:
+                    self.cursor.execute('release flushed')
+                self.cursor.execute('savepoint flushed')
+                self._flushed = True
+        elif save:
             self.conn.commit()
         elif self._closed:
             return
         else:
             self.conn.rollback()
+            self._invalidate()
+
+    def _rollback_deferred(self):
+        if self._flushed:
+            self.cursor.execute('rollback to flushed')
+        else:
+            self.cursor.execute('rollback')
+            self.cursor.execute('begin')
+        self._invalidate()
+
+    def defer_commits(self):
+        """Defer commits requested by :meth:`flush` to
+        :meth:`commit_deferred`.
+
+        The deferred changes are made in a single transaction, managed
+        explicitly, as sqlite savepoints cannot be used in the transactions
+        the sqlite3 module begins implicitly.
+        """
+        if self._deferred or self._closed:
+            return
+        self.conn.commit()
+        self._isolation_level = self.conn.isolation_level
+        self.conn.isolation_level = None
+        self.cursor.execute('begin')
+        self._deferred = True
+        self._flushed = False
+
+    def commit_deferred(self, success=True):
+        """Stop deferring commits and commit the state last flushed.
+
+        If success is False, as when a hook failed, changes made since the
+        last flush are rolled back, and the state as of that flush is
+        committed. On success, all changes are committed, and up to
+        COMPACT_BATCH hooks of expired history are removed.
+        """
+        if self._closed:
+            self._deferred = False
+            return
+        if self._deferred:
+            if not success:
+                self._rollback_deferred()
+            self.cursor.execute('commit')
+            self.conn.isolation_level = self._isolation_level
+            self._deferred = False
+            self._flushed = False
+        else:
+            self.flush(success)
+        if success:
+            self.compact(limit=self.COMPACT_BATCH)
+            self.flush()
+
+    def compact(self, limit=None):
+        """Remove hooks and key revisions beyond the retention limits.
+
+        :param int limit: Remove at most this many hooks, so that a large
+            backlog is worked through incrementally by successive hooks.
+        :return int: The number of hooks removed
+        """
+        clauses = []
+        params = []
+        if self.history_hooks:
+            self.cursor.execute('select max(version) from hooks')
+            latest = self.cursor.fetchone()[0] or 0
+            clauses.append('version <= ?')
+            params.append(latest - self.history_hooks)
+        if self.history_days:
+            cutoff = (datetime.datetime.utcnow() -
+                      datetime.timedelta(days=self.history_days))
+            clauses.append('date < ?')
+            params.append(cutoff.isoformat())
+        if not clauses:
+            return 0
+        query = 'select version from hooks where %s order by version' % (
+            ' or '.join(clauses))
+        if limit:
+            query += ' limit %d' % int(limit)
+        self.cursor.execute(query, params)
+        versions = [row[0] for row in self.cursor.fetchall()]
+        # Never remove the history of the hook in progress
+        versions = [v for v in versions if v != self.revision]
+        for i in range(0, len(versions), self.MAX_VARIABLES):
+            chunk = versions[i:i + self.MAX_VARIABLES]
+            marks = ','.join(['?'] * len(chunk))
+            self.cursor.execute(
+                'delete from kv_revisions where revision in (%s)' % marks,
+                chunk)
+            self.cursor.execute(
+                'delete from hooks where version in (%s)' % marks, chunk)
+        return len(versions)
+
+    def vacuum(self):
+        """Commit and return the space freed by :meth:`compact` to the
+        filesystem."""
+        self.conn.commit()
+        self.conn.execute('vacuum')
 
     def _init(self):
+        # Readers do not block the writer and commits only append to the
+        # log, which is synced at checkpoints rather than on every commit.
+        self.cursor.execute('pragma journal_mode=wal')
+        self.cursor.execute('pragma synchronous=normal')
         self.cursor.execute('''
             create table if not exists kv (
                key text,
@@ -393,6 +646,9 @@ class Storage(object):
                hook text,
                date text
                )''')
+        self.cursor.execute('''
+            create index if not exists kv_revisions_revision
+            on kv_revisions (revision)''')
         self.conn.commit()
 
     def gethistory(self, key, deserialize=False):
@@ -509,10 +765,34 @@ Delta = collections.namedtuple('Delta', ['previous', 'current'])
 
 
 _KV = None
+_DEFER_COMMITS = False
 
 
 def kv():
     global _KV
     if _KV is None:
         _KV = Storage()
+        if _DEFER_COMMITS:
+            _KV.defer_commits()
     return _KV
+
+
+def defer_commits():
+    """Defer commits of the unit kv store until :func:`commit_deferred`.
+
+    Hook frameworks call this before running the hook, so that repeated
+    flushes during the hook result in a single commit.
+    """
+    global _DEFER_COMMITS
+    _DEFER_COMMITS = True
+    if _KV is not None:
+        _KV.defer_commits()
+
+
+def commit_deferred(success=True):
+    """Commit changes to the unit kv store deferred by
+    :func:`defer_commits`."""
+    global _DEFER_COMMITS
+    _DEFER_COMMITS = False
+    if _KV is not None:
+        _KV.commit_deferred(success)
@@ -33,7 +33,7 @@ class GitUrlFetchHandler(BaseFetchHandler):
     def can_handle(self, source):
         url_parts = self.parse_url(source)
         # TODO (mattyw) no support for ssh git@ yet
-        if url_parts.scheme not in ('http', 'https', 'git', ''):
+        if url_parts.scheme not in ('http', 'https', 'git', 'file', ''):
             return False
         elif not url_parts.scheme:
             return os.path.exists(os.path.join(source, '.git'))
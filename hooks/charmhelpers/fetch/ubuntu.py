@@ -22,6 +22,7 @@ from charmhelpers.core.host import (
     lsb_release
 )
 from charmhelpers.core.hookenv import log
+from charmhelpers.core.profiling import profiled
 from charmhelpers.fetch import SourceConfigError
 
 CLOUD_ARCHIVE = """# Ubuntu Cloud Archive
@@ -286,6 +287,7 @@ def add_source(source, key=None):
                                    key])
 
 
+@profiled('apt')
 def _run_apt_command(cmd, fatal=False):
     """Run an APT command.
 
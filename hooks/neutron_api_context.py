@@ -12,19 +12,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
+import math
+import re
 from collections import OrderedDict
 
 from charmhelpers.core.hookenv import (
+    cached,
     config,
     relation_ids,
     related_units,
     relation_get,
     log,
+    WARNING,
 )
 from charmhelpers.contrib.openstack import context
 from charmhelpers.contrib.hahelpers.cluster import (
     determine_api_port,
     determine_apache_port,
+    https,
+    peer_units,
 )
 from charmhelpers.contrib.openstack.utils import (
     os_release,
@@ -39,6 +47,36 @@ OVERLAY_NET_TYPES = [VXLAN, GRE]
 NON_OVERLAY_NET_TYPES = [VLAN, FLAT, LOCAL]
 TENANT_NET_TYPES = [VXLAN, GRE, VLAN, FLAT, LOCAL]
 
+SUBORDINATE_INTERFACE = 'neutron-plugin-api-subordinate'
+
+# Concurrent connections haproxy will pass to each neutron-server API worker
+# before queueing; used to derive the per-server maxconn.
+HAPROXY_CONNS_PER_WORKER = 32
+# Neutron version discovery endpoint, served without authentication
+HAPROXY_HTTPCHK = 'GET /'
+# Agents whose state reports one rpc_state_report_worker is sized to handle
+AGENTS_PER_STATE_REPORT_WORKER = 250
+# Database connections pooled per neutron-server worker
+DB_CONNS_PER_WORKER = 4
+# Bounds of the RPC executor thread pool of each worker; the lower bound is
+# the oslo.messaging default.
+EXECUTOR_THREADS_MIN = 64
+EXECUTOR_THREADS_MAX = 256
+# oslo.messaging defaults for the reply connection pool and RPC timeout
+RPC_CONN_POOL_MIN = 30
+RPC_RESPONSE_TIMEOUT_MIN = 60
+RPC_RESPONSE_TIMEOUT_MAX = 300
+# Seconds added to rpc_response_timeout per 100 agents served by a worker
+RPC_RESPONSE_TIMEOUT_PER_100_AGENTS = 30
+
+
+def plugin_api_agents():
+    """Return the number of agents connected over neutron-plugin-api."""
+    agents = 0
+    for rid in relation_ids('neutron-plugin-api'):
+        agents += len(related_units(rid))
+    return agents
+
 
 def get_l2population():
     plugin = config('neutron-plugin')
@@ -339,6 +377,173 @@ class HAProxyContext(context.HAProxyContext):
 
         # for haproxy.conf
         ctxt['service_ports'] = port_mapping
+        ctxt.update(self.backend_tuning())
+        return ctxt
+
+    def backend_tuning(self):
+        '''
+        Backend server and health check settings for neutron-server.
+        The per-server maxconn defaults to a multiple of the API worker
+        count so freshly restarted units are not flooded before they warm
+        up; slowstart ramps their weight up once checks pass again.
+        '''
+        ctxt = {}
+        if config('haproxy-maxconn'):
+            ctxt['haproxy_maxconn'] = config('haproxy-maxconn')
+
+        if config('haproxy-mode') == 'http':
+            if https():
+                log('HAProxy http mode is not supported when backends are '
+                    'SSL terminated by apache, using tcp mode',
+                    level=WARNING)
+            else:
+                ctxt['haproxy_mode'] = 'http'
+                ctxt['haproxy_httpchk'] = HAPROXY_HTTPCHK
+
+        server_maxconn = config('haproxy-server-maxconn')
+        if server_maxconn is None:
+            workers = WorkerConfigContext()()['api_workers']
+            server_maxconn = max(workers, 1) * HAPROXY_CONNS_PER_WORKER
+        if server_maxconn:
+            ctxt['haproxy_server_maxconn'] = server_maxconn
+
+        for key in ['check-inter', 'check-rise', 'check-fall', 'slowstart']:
+            if config('haproxy-{}'.format(key)):
+                ctxt['haproxy_{}'.format(key.replace('-', '_'))] = \
+                    config('haproxy-{}'.format(key))
+        return ctxt
+
+
+class WorkerConfigContext(context.WorkerConfigContext):
+    '''
+    Extends the charmhelpers WorkerConfigContext so the neutron-server API
+    and RPC worker pools can be sized with separate multipliers; both
+    default to worker-multiplier.
+    '''
+    process_name = 'neutron-server'
+    worker_pools = 2
+
+    def __call__(self):
+        ctxt = super(WorkerConfigContext, self).__call__()
+        for pool in ['api', 'rpc']:
+            multiplier = config('{}-worker-multiplier'.format(pool))
+            if multiplier is None:
+                ctxt['{}_workers'.format(pool)] = ctxt['workers']
+            else:
+                ctxt['{}_workers'.format(pool)] = \
+                    self.worker_count(multiplier)
+        return ctxt
+
+
+class NeutronPerformanceContext(context.OSContextGenerator):
+    '''
+    Tuning for neutron-server state reports, agent liveness and the WSGI
+    green thread pool.
+
+    Unless configured, rpc_state_report_workers is sized so the units of
+    the service share the state reports of the agents connected over
+    neutron-plugin-api, bounded by the CPUs of this unit, and
+    agent_down_time is 2.5 times the agent report_interval.
+    '''
+    interfaces = []
+
+    def state_report_workers(self):
+        agents = plugin_api_agents()
+        units = len(peer_units()) + 1
+        cpus = WorkerConfigContext().num_cpus
+        workers = int(math.ceil(
+            float(agents) / (units * AGENTS_PER_STATE_REPORT_WORKER)))
+        workers = min(max(workers, 1), max(cpus, 1))
+        log('Sizing rpc_state_report_workers: {} for {} agents across {} '
+            'units with {} cpus'.format(workers, agents, units, cpus))
+        return workers
+
+    def __call__(self):
+        ctxt = {}
+        ctxt['rpc_state_report_workers'] = (
+            config('rpc-state-report-workers') or
+            self.state_report_workers())
+        ctxt['report_interval'] = config('report-interval')
+        ctxt['agent_down_time'] = config('agent-down-time')
+        if not ctxt['agent_down_time'] and ctxt['report_interval']:
+            ctxt['agent_down_time'] = \
+                int(math.ceil(ctxt['report_interval'] * 2.5))
+        if config('wsgi-default-pool-size'):
+            ctxt['wsgi_default_pool_size'] = config('wsgi-default-pool-size')
+        return ctxt
+
+
+class DatabasePoolContext(context.OSContextGenerator):
+    '''
+    SQLAlchemy connection pool of each neutron-server process.
+
+    Unless configured, max_pool_size is DB_CONNS_PER_WORKER times the
+    larger of the API and RPC worker counts and max_overflow allows half as
+    many connections again for bursts.
+    '''
+    interfaces = []
+
+    def __call__(self):
+        workers = WorkerConfigContext()()
+        pool_size = config('database-max-pool-size') or (
+            DB_CONNS_PER_WORKER *
+            max(workers['api_workers'], workers['rpc_workers'], 1))
+        max_overflow = config('database-max-overflow')
+        if max_overflow is None:
+            max_overflow = int(math.ceil(pool_size / 2.0))
+        ctxt = {
+            'database_max_pool_size': pool_size,
+            'database_max_overflow': max_overflow,
+        }
+        for key in ['pool-timeout', 'idle-timeout', 'max-retries']:
+            if config('database-{}'.format(key)) is not None:
+                ctxt['database_{}'.format(key.replace('-', '_'))] = \
+                    config('database-{}'.format(key))
+        return ctxt
+
+
+class NeutronMessagingContext(context.OSContextGenerator):
+    '''
+    oslo.messaging tuning for neutron-server RPC.
+
+    Unless configured, the executor thread pool of each RPC worker is sized
+    to the agents it serves, when the agents connected over
+    neutron-plugin-api are shared across the RPC workers of all units. The
+    rabbit prefetch count matches the executor pool so each worker only
+    takes the messages it can process, the reply connection pool is half
+    the executor pool, and rpc_response_timeout grows with the agents per
+    worker.
+    '''
+    interfaces = []
+
+    def agents_per_worker(self):
+        agents = plugin_api_agents()
+        units = len(peer_units()) + 1
+        workers = max(WorkerConfigContext()()['rpc_workers'], 1)
+        return int(math.ceil(float(agents) / (units * workers)))
+
+    def __call__(self):
+        per_worker = self.agents_per_worker()
+        threads = config('executor-thread-pool-size') or min(
+            max(per_worker, EXECUTOR_THREADS_MIN), EXECUTOR_THREADS_MAX)
+        timeout = min(
+            RPC_RESPONSE_TIMEOUT_MIN +
+            RPC_RESPONSE_TIMEOUT_PER_100_AGENTS * (per_worker // 100),
+            RPC_RESPONSE_TIMEOUT_MAX)
+        ctxt = {
+            'executor_thread_pool_size': threads,
+            'rpc_conn_pool_size': (
+                config('rpc-conn-pool-size') or
+                max(RPC_CONN_POOL_MIN, int(math.ceil(threads / 2.0)))),
+            'rabbit_qos_prefetch_count': (
+                config('rabbit-qos-prefetch-count') or threads),
+            'rpc_response_timeout': config('rpc-response-timeout') or timeout,
+        }
+        for key in ['heartbeat-timeout-threshold', 'heartbeat-rate']:
+            if config('rabbit-{}'.format(key)) is not None:
+                ctxt[key.replace('-', '_')] = config('rabbit-{}'.format(key))
+        if config('amqp-durable-queues'):
+            ctxt['amqp_durable_queues'] = True
         return ctxt
 
 
@@ -364,15 +569,53 @@ class EtcdContext(context.OSContextGenerator):
         return ctxt
 
 
+def _relation_order(name):
+    """Sort key ordering relation ids and unit names by their number."""
+    match = re.match(r'^(.*?)(\d+)$', name)
+    if match:
+        return match.group(1), int(match.group(2))
+    return name, -1
+
+
+@cached
+def subordinate_units():
+    """Return the settings of the units related over
+    neutron-plugin-api-subordinate.
+
+    The relation data is read once per hook and shared by the contexts
+    rendering subordinate settings. Units are ordered by relation id and
+    unit number, so when subordinates conflict the same one wins whatever
+    order they are listed in.
+
+    :returns: list of (rid, unit, settings) tuples
+    """
+    units = []
+    for rid in sorted(relation_ids(SUBORDINATE_INTERFACE),
+                      key=_relation_order):
+        for unit in sorted(related_units(rid), key=_relation_order):
+            units.append((rid, unit, relation_get(rid=rid, unit=unit) or {}))
+    return units
+
+
+def subordinate_digest():
+    """Return a digest of the subordinate relation data."""
+    data = json.dumps(subordinate_units(), sort_keys=True)
+    return hashlib.md5(data.encode('UTF-8')).hexdigest()
+
+
 class NeutronApiSDNContext(context.SubordinateConfigContext):
     interfaces = 'neutron-plugin-api-subordinate'
 
     def __init__(self):
         super(NeutronApiSDNContext, self).__init__(
-            interface='neutron-plugin-api-subordinate',
+            interface=SUBORDINATE_INTERFACE,
             service='neutron-api',
             config_file='/etc/neutron/neutron.conf')
 
+    def subordinate_configs(self):
+        for rid, unit, rdata in subordinate_units():
+            yield rid, rdata.get('subordinate_configuration')
+
     def __call__(self):
         ctxt = super(NeutronApiSDNContext, self).__call__()
         defaults = {
@@ -401,21 +644,25 @@ class NeutronApiSDNContext(context.SubordinateConfigContext):
                 'value': '',
             },
         }
-        for rid in relation_ids('neutron-plugin-api-subordinate'):
-            for unit in related_units(rid):
-                rdata = relation_get(rid=rid, unit=unit)
-                plugin = rdata.get('neutron-plugin')
-                if not plugin:
-                    continue
-                ctxt['neutron_plugin'] = plugin
-                for key in defaults.keys():
-                    remote_value = rdata.get(key)
-                    ctxt_key = defaults[key]['templ_key']
-                    if remote_value:
-                        ctxt[ctxt_key] = remote_value
-                    else:
-                        ctxt[ctxt_key] = defaults[key]['value']
-                return ctxt
+        plugins = [(unit, rdata) for rid, unit, rdata in subordinate_units()
+                   if rdata.get('neutron-plugin')]
+        if not plugins:
+            return ctxt
+        unit, rdata = plugins[0]
+        for other, odata in plugins[1:]:
+            if odata['neutron-plugin'] != rdata['neutron-plugin']:
+                log('Ignoring neutron-plugin {} from {}, using {} from '
+                    '{}'.format(odata['neutron-plugin'], other,
+                                rdata['neutron-plugin'], unit),
+                    level=WARNING)
+        ctxt['neutron_plugin'] = rdata['neutron-plugin']
+        for key in defaults.keys():
+            remote_value = rdata.get(key)
+            ctxt_key = defaults[key]['templ_key']
+            if remote_value:
+                ctxt[ctxt_key] = remote_value
+            else:
+                ctxt[ctxt_key] = defaults[key]['value']
         return ctxt
 
 
@@ -423,12 +670,10 @@ class NeutronApiSDNConfigFileContext(context.OSContextGenerator):
     interfaces = ['neutron-plugin-api-subordinate']
 
     def __call__(self):
-        for rid in relation_ids('neutron-plugin-api-subordinate'):
-            for unit in related_units(rid):
-                rdata = relation_get(rid=rid, unit=unit)
-                neutron_server_plugin_conf = rdata.get('neutron-plugin-config')
-                if neutron_server_plugin_conf:
-                    return {'config': neutron_server_plugin_conf}
+        for rid, unit, rdata in subordinate_units():
+            neutron_server_plugin_conf = rdata.get('neutron-plugin-config')
+            if neutron_server_plugin_conf:
+                return {'config': neutron_server_plugin_conf}
         return {'config': '/etc/neutron/plugins/ml2/ml2_conf.ini'}
 
 
@@ -38,6 +38,7 @@ from charmhelpers.core.hookenv import (
 )
 
 from charmhelpers.core.host import (
+    file_hash,
     mkdir,
     service_reload,
     service_restart,
@@ -66,22 +67,39 @@ from neutron_api_utils import (
     CLUSTER_RES,
     NEUTRON_CONF,
     api_port,
+    config_changed_targets,
+    config_files_for,
     determine_packages,
     determine_ports,
     do_openstack_upgrade,
     git_install,
+    git_share_venv,
+    git_venv_build_required,
+    git_venv_source,
     is_api_ready,
     dvr_router_present,
     l3ha_router_present,
+    mark_config_applied,
     migrate_neutron_database,
+    neutron_db_initialised,
+    neutron_db_migrated,
+    record_neutron_db_migration,
+    online_migration_enabled,
+    progress_online_migration,
+    restart_for_online_migration,
+    start_online_migration,
     neutron_ready,
     register_configs,
     restart_map,
+    restart_functions,
     services,
     setup_ipv6,
     get_topics,
     additional_install_locations,
-    force_etcd_restart,
+    update_etcd,
+    write_subordinate_configs,
+    ETCD_DEFAULT,
+    ETCD_INIT_CONF,
     assess_status,
 )
 from neutron_api_context import (
@@ -126,7 +144,7 @@ from charmhelpers.contrib.openstack.context import ADDRESS_TYPES
 from charmhelpers.contrib.charmsupport import nrpe
 from charmhelpers.contrib.hardening.harden import harden
 
-hooks = Hooks()
+hooks = Hooks(profile=lambda: config('profile-hooks'))
 CONFIGS = register_configs()
 
 
@@ -138,7 +156,17 @@ def conditional_neutron_migration():
     if is_elected_leader(CLUSTER_RES):
         allowed_units = relation_get('allowed_units')
         if allowed_units and local_unit() in allowed_units.split():
+            if online_migration_enabled() and neutron_db_initialised():
+                # Restarts are rolled across the units as the migration
+                # progresses.
+                start_online_migration()
+                return
+            if neutron_db_migrated():
+                log('Neutron database is already at the heads of the '
+                    'installed packages, not migrating')
+                return
             migrate_neutron_database()
+            record_neutron_db_migration()
             if not is_unit_paused_set():
                 service_restart('neutron-server')
         else:
@@ -201,7 +229,8 @@ def install():
 
 
 @hooks.hook('vsd-rest-api-relation-joined')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map(), stopstart=True,
+                   restart_functions=restart_functions())
 def relation_set_nuage_cms_name(rid=None):
     if os_release('neutron-server') >= 'kilo':
         if config('vsd-cms-name') is None:
@@ -216,7 +245,8 @@ def relation_set_nuage_cms_name(rid=None):
 
 
 @hooks.hook('vsd-rest-api-relation-changed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map(), stopstart=True,
+                   restart_functions=restart_functions())
 def vsd_changed(relation_id=None, remote_unit=None):
     if config('neutron-plugin') == 'vsp':
         vsd_ip_address = relation_get('vsd-ip-address')
@@ -237,12 +267,20 @@ def vsd_changed(relation_id=None, remote_unit=None):
 
 @hooks.hook('upgrade-charm')
 @hooks.hook('config-changed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map(), stopstart=True,
+                   restart_functions=restart_functions())
 @harden()
 def config_changed():
+    # Only run the phases affected by the options that changed, or every
+    # phase outside of the config-changed hook.
+    targets = config_changed_targets()
+
+    def affected(target):
+        return targets is None or target in targets
+
     # If neutron is ready to be queried then check for incompatability between
     # existing neutron objects and charm settings
-    if neutron_ready():
+    if affected('routers') and neutron_ready():
         if l3ha_router_present() and not get_l3ha():
             e = ('Cannot disable Router HA while ha enabled routers exist.'
                  ' Please remove any ha routers')
@@ -254,44 +292,69 @@ def config_changed():
             log(e, level=ERROR)
             status_set('blocked', e)
             raise Exception(e)
-    if config('prefer-ipv6'):
+    if config('prefer-ipv6') and affected('ipv6'):
         status_set('maintenance', 'configuring ipv6')
         setup_ipv6()
         sync_db_with_multi_ipv6_addresses(config('database'),
                                           config('database-user'))
 
     global CONFIGS
-    if git_install_requested():
-        if config_value_changed('openstack-origin-git'):
-            status_set('maintenance', 'Running Git install')
-            git_install(config('openstack-origin-git'))
-    elif not config('action-managed-upgrade'):
-        if openstack_upgrade_available('neutron-common'):
-            status_set('maintenance', 'Running openstack upgrade')
-            do_openstack_upgrade(CONFIGS)
-
-    additional_install_locations(
-        config('neutron-plugin'),
-        config('openstack-origin')
-    )
-    status_set('maintenance', 'Installing apt packages')
-    apt_install(filter_installed_packages(
-                determine_packages(config('openstack-origin'))),
-                fatal=True)
-    configure_https()
-    update_nrpe_config()
-    CONFIGS.write_all()
-    for r_id in relation_ids('neutron-api'):
-        neutron_api_relation_joined(rid=r_id)
-    for r_id in relation_ids('neutron-plugin-api'):
-        neutron_plugin_api_relation_joined(rid=r_id)
-    for r_id in relation_ids('amqp'):
-        amqp_joined(relation_id=r_id)
-    for r_id in relation_ids('identity-service'):
-        identity_joined(rid=r_id)
-    for rid in relation_ids('zeromq-configuration'):
-        zeromq_configuration_relation_joined(rid)
-    [cluster_joined(rid) for rid in relation_ids('cluster')]
+    if affected('upgrade'):
+        if git_install_requested():
+            # Units installing a prebuilt venv check for a new one on every
+            # run, which is cheap when it has not changed.
+            origin_changed = config_value_changed('openstack-origin-git')
+            source_changed = config_value_changed('git-venv-source')
+            if (origin_changed or source_changed or
+                    not git_venv_build_required()):
+                status_set('maintenance', 'Running Git install')
+                git_install(config('openstack-origin-git'))
+        elif not config('action-managed-upgrade'):
+            if openstack_upgrade_available('neutron-common'):
+                status_set('maintenance', 'Running openstack upgrade')
+                do_openstack_upgrade(CONFIGS)
+
+    if affected('apt'):
+        additional_install_locations(
+            config('neutron-plugin'),
+            config('openstack-origin')
+        )
+        status_set('maintenance', 'Installing apt packages')
+        apt_install(filter_installed_packages(
+                    determine_packages(config('openstack-origin'))),
+                    fatal=True)
+    if affected('https'):
+        configure_https()
+    if affected('nrpe'):
+        update_nrpe_config()
+    if targets is None:
+        CONFIGS.write_all()
+    elif 'https' not in targets:
+        # configure_https has already written every config file
+        for conf in config_files_for(targets, CONFIGS):
+            CONFIGS.write(conf)
+    if affected('neutron-api'):
+        for r_id in relation_ids('neutron-api'):
+            neutron_api_relation_joined(rid=r_id)
+    if affected('neutron-plugin-api'):
+        for r_id in relation_ids('neutron-plugin-api'):
+            neutron_plugin_api_relation_joined(rid=r_id)
+    if affected('amqp'):
+        for r_id in relation_ids('amqp'):
+            amqp_joined(relation_id=r_id)
+    if affected('identity-service'):
+        for r_id in relation_ids('identity-service'):
+            identity_joined(rid=r_id)
+    if affected('zeromq-configuration'):
+        for rid in relation_ids('zeromq-configuration'):
+            zeromq_configuration_relation_joined(rid)
+    if affected('cluster'):
+        [cluster_joined(rid) for rid in relation_ids('cluster')]
+    if not is_elected_leader(CLUSTER_RES):
+        # Acknowledge a restart token received before this unit was
+        # upgraded, which leader-settings-changed will not deliver again.
+        restart_for_online_migration()
+    mark_config_applied()
 
 
 @hooks.hook('amqp-relation-joined')
@@ -302,7 +365,7 @@ def amqp_joined(relation_id=None):
 
 @hooks.hook('amqp-relation-changed')
 @hooks.hook('amqp-relation-departed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), restart_functions=restart_functions())
 def amqp_changed():
     if 'amqp' not in CONFIGS.complete_contexts():
         log('amqp relation incomplete. Peer not ready?')
@@ -352,7 +415,7 @@ def pgsql_neutron_db_joined():
 
 
 @hooks.hook('shared-db-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), restart_functions=restart_functions())
 def db_changed():
     if 'shared-db' not in CONFIGS.complete_contexts():
         log('shared-db relation incomplete. Peer not ready?')
@@ -365,7 +428,7 @@ def db_changed():
 
 
 @hooks.hook('pgsql-db-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), restart_functions=restart_functions())
 def postgresql_neutron_db_changed():
     CONFIGS.write(NEUTRON_CONF)
     conditional_neutron_migration()
@@ -409,7 +472,7 @@ def identity_joined(rid=None, relation_trigger=False):
 
 
 @hooks.hook('identity-service-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), restart_functions=restart_functions())
 def identity_changed():
     if 'identity-service' not in CONFIGS.complete_contexts():
         log('identity-service relation incomplete. Peer not ready?')
@@ -451,7 +514,7 @@ def neutron_api_relation_joined(rid=None):
 
 
 @hooks.hook('neutron-api-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), restart_functions=restart_functions())
 def neutron_api_relation_changed():
     CONFIGS.write(NEUTRON_CONF)
 
@@ -483,6 +546,10 @@ def neutron_plugin_api_relation_joined(rid=None):
         if net_dev_mtu:
             relation_data['network-device-mtu'] = net_dev_mtu
 
+        # Hint for agent state reporting, agent_down_time is derived from it
+        if config('report-interval'):
+            relation_data['report-interval'] = config('report-interval')
+
     identity_ctxt = IdentityServiceContext()()
     if not identity_ctxt:
         identity_ctxt = {}
@@ -527,9 +594,25 @@ def cluster_joined(relation_id=None):
 
 @hooks.hook('cluster-relation-changed',
             'cluster-relation-departed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map(), stopstart=True,
+                   restart_functions=restart_functions())
 def cluster_changed():
     CONFIGS.write_all()
+    if is_elected_leader(CLUSTER_RES):
+        progress_online_migration()
+
+
+@hooks.hook('leader-elected')
+def leader_elected():
+    progress_online_migration()
+    git_share_venv()
+
+
+@hooks.hook('leader-settings-changed')
+def leader_settings_changed():
+    restart_for_online_migration()
+    if git_venv_source() == 'leader':
+        git_install(config('openstack-origin-git'))
 
 
 @hooks.hook('ha-relation-joined')
@@ -621,13 +704,21 @@ def neutron_plugin_api_subordinate_relation_joined(relid=None):
     relation_set(relation_id=relid, **relation_data)
 
 
-@hooks.hook('zeromq-configuration-relation-changed',
-            'neutron-plugin-api-subordinate-relation-changed')
-@restart_on_change(restart_map(), stopstart=True)
+@hooks.hook('zeromq-configuration-relation-changed')
+@restart_on_change(restart_map(), stopstart=True,
+                   restart_functions=restart_functions())
 def zeromq_configuration_relation_changed():
     CONFIGS.write_all()
 
 
+@hooks.hook('neutron-plugin-api-subordinate-relation-changed',
+            'neutron-plugin-api-subordinate-relation-departed')
+@restart_on_change(restart_map(), stopstart=True,
+                   restart_functions=restart_functions())
+def neutron_plugin_api_subordinate_relation_changed():
+    write_subordinate_configs(CONFIGS)
+
+
 @hooks.hook('nrpe-external-master-relation-joined',
             'nrpe-external-master-relation-changed')
 def update_nrpe_config():
@@ -640,6 +731,8 @@ def update_nrpe_config():
     nrpe.add_init_service_checks(nrpe_setup, services(), current_unit)
 
     nrpe.add_haproxy_checks(nrpe_setup, current_unit)
+    nrpe.add_haproxy_stats_checks(nrpe_setup, current_unit,
+                                  ['neutron-server'])
     nrpe_setup.write()
 
 
@@ -650,19 +743,22 @@ def etcd_proxy_force_restart(relation_id=None):
     # but occasionally it does require a full config nuking. This does not
     # play well with the standard neutron-api config management, so we
     # treat etcd like the special snowflake it insists on being.
-    CONFIGS.register('/etc/init/etcd.conf', [EtcdContext()])
-    CONFIGS.write('/etc/init/etcd.conf')
-    CONFIGS.register('/etc/default/etcd', [EtcdContext()])
-    CONFIGS.write('/etc/default/etcd')
+    etcd = EtcdContext()
+    changed = False
+    for path in (ETCD_INIT_CONF, ETCD_DEFAULT):
+        before = file_hash(path)
+        CONFIGS.register(path, [etcd])
+        CONFIGS.write(path)
+        changed = changed or file_hash(path) != before
 
     if 'etcd-proxy' in CONFIGS.complete_contexts():
-        force_etcd_restart()
+        update_etcd(etcd()['cluster'], restart=changed)
 
 
 @hooks.hook('midonet-relation-joined')
 @hooks.hook('midonet-relation-changed')
 @hooks.hook('midonet-relation-departed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), restart_functions=restart_functions())
 def midonet_changed():
     CONFIGS.write_all()
 
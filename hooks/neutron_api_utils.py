@@ -15,11 +15,14 @@
 from collections import OrderedDict
 from copy import deepcopy
 from functools import partial
+import ast
+import hashlib
 import os
 import shutil
 import subprocess
 import glob
 from base64 import b64encode
+from charmhelpers.contrib.network.ip import format_ipv6_addr
 from charmhelpers.contrib.openstack import context, templating
 from charmhelpers.contrib.openstack.neutron import (
     neutron_plugin_attribute,
@@ -32,7 +35,11 @@ from charmhelpers.contrib.openstack.utils import (
     git_default_repos,
     git_generate_systemd_init_files,
     git_install_requested,
+    git_pack_venv,
     git_pip_venv_dir,
+    git_restart_done,
+    git_restart_pending,
+    git_unpack_venv,
     git_src_dir,
     git_yaml_value,
     configure_installation_source,
@@ -40,6 +47,7 @@ from charmhelpers.contrib.openstack.utils import (
     is_unit_paused_set,
     make_assess_status_func,
     pause_unit,
+    reset_os_release,
     resume_unit,
     os_application_version_set,
     token_cache_pkgs,
@@ -53,23 +61,42 @@ from charmhelpers.contrib.python.packages import (
 from charmhelpers.core.hookenv import (
     charm_dir,
     config,
+    hook_name,
+    leader_get,
+    leader_set,
+    local_unit,
     log,
+    related_units,
+    relation_get,
     relation_ids,
+    relation_set,
+    resource_get,
+    status_set,
+    unit_private_ip,
+    ERROR,
+    WARNING,
 )
 
 from charmhelpers.fetch import (
     apt_update,
     apt_install,
     apt_upgrade,
-    add_source
+    add_source,
+    filter_installed_packages,
 )
+from charmhelpers.fetch.archiveurl import ArchiveUrlFetchHandler
 
+from charmhelpers.core import unitdata
 from charmhelpers.core.host import (
+    check_hash,
+    file_hash,
     lsb_release,
     adduser,
     add_group,
     add_user_to_group,
     mkdir,
+    service_reload,
+    service_running,
     service_stop,
     service_start,
     service_restart,
@@ -81,6 +108,7 @@ from charmhelpers.contrib.hahelpers.cluster import (
 )
 
 
+from charmhelpers.core.profiling import profiled
 from charmhelpers.core.templating import render
 from charmhelpers.contrib.hahelpers.cluster import is_elected_leader
 
@@ -90,6 +118,41 @@ TEMPLATES = 'templates/'
 
 CLUSTER_RES = 'grp_neutron_vips'
 
+# Leader settings recording online database migrations: the release the
+# schema was fully migrated to, the release it was expanded for and the
+# unit currently allowed to restart onto the expanded schema.
+DB_MIGRATION_KEY = 'db-migration'
+DB_MIGRATION_EXPANDED_KEY = 'db-migration-expanded'
+DB_MIGRATION_RESTART_KEY = 'db-migration-restart'
+# Cluster relation setting acknowledging a restart onto the expanded schema
+# with the release neutron-server runs, and unitdata key of the release this
+# unit last restarted for.
+DB_MIGRATION_RESTARTED_KEY = 'db-migration-restarted'
+# Leader setting recording the database and alembic heads it was last
+# migrated to, so unchanged schemas are not migrated again.
+DB_MIGRATION_HEADS_KEY = 'db-migration-heads'
+# Alembic migrations shipped by neutron and its service projects, relative
+# to the python site directory they are installed in.
+ALEMBIC_VERSIONS_GLOB = 'neutron*/db/migration/alembic_migrations/versions'
+SITE_PACKAGES = '/usr/lib/python2.7/dist-packages'
+# Prebuilt venv tarballs for git-venv-source 'leader' and 'resource'. The
+# leader publishes the URL and sha256 of its tarball in leader settings;
+# every unit keeps the tarball it installed so a new leader can serve it.
+GIT_VENV_RESOURCE = 'neutron-venv'
+GIT_VENV_URL_KEY = 'git-venv-url'
+GIT_VENV_SHA256_KEY = 'git-venv-sha256'
+GIT_VENV_ARTIFACT_DIR = '/var/www/html/neutron-api'
+# unitdata key of the sha256 of the venv tarball installed on this unit
+GIT_VENV_KEY = 'git-venv-sha256'
+ETCD_INIT_CONF = '/etc/init/etcd.conf'
+ETCD_DEFAULT = '/etc/default/etcd'
+# unitdata key of the etcd cluster string the local proxy was last started
+# with
+ETCD_CLUSTER_KEY = 'etcd-cluster'
+# unitdata key of the digest of the subordinate relation data the configs
+# were last written for, and of the configs that were written
+SUBORDINATE_DIGEST_KEY = 'subordinate-digest'
+
 # removed from original: charm-helper-sh
 BASE_PACKAGES = [
     'apache2',
@@ -124,6 +187,18 @@ BASE_GIT_PACKAGES = [
     'zlib1g-dev',
 ]
 
+# Only needed on units that build the git venv themselves
+GIT_BUILD_PACKAGES = [
+    'libffi-dev',
+    'libmysqlclient-dev',
+    'libssl-dev',
+    'libxml2-dev',
+    'libxslt1-dev',
+    'libyaml-dev',
+    'python-dev',
+    'zlib1g-dev',
+]
+
 # ubuntu packages that should not be installed when deploying from git
 GIT_PACKAGE_BLACKLIST = [
     'neutron-server',
@@ -138,6 +213,147 @@ GIT_PACKAGE_BLACKLIST_KILO = [
     'python-neutron-vpnaas',
 ]
 
+# What each config option affects, used by config_changed to only run the
+# phases a config-changed hook needs. Targets are config file groups
+# (CONFIG_FILE_GROUPS), relations updated by config_changed and the phases:
+#   routers - refuse to disable dvr/l3ha while such routers exist
+#   ipv6    - ipv6 setup and database access grants
+#   upgrade - openstack upgrade or git install
+#   apt     - package sources and installation
+#   https   - apache ssl frontend and identity endpoints
+#   nrpe    - nagios checks
+SERVER_CONFIGS = 'neutron-server'
+ALL_CONFIGS = [SERVER_CONFIGS, 'haproxy', 'apache', 'memcached']
+ENDPOINT_TARGETS = ['https', 'identity-service', 'neutron-api']
+ADDRESS_TARGETS = ENDPOINT_TARGETS + ['haproxy', 'apache', 'cluster']
+PLUGIN_TARGETS = [SERVER_CONFIGS, 'neutron-api', 'neutron-plugin-api']
+
+CONFIG_DEPENDENCIES = {
+    'debug': [SERVER_CONFIGS],
+    'verbose': [SERVER_CONFIGS],
+    'use-syslog': [SERVER_CONFIGS],
+    'config-flags': [SERVER_CONFIGS],
+    'openstack-origin': ['upgrade', 'apt', 'neutron-api', 'neutron-plugin-api',
+                         'zeromq-configuration'] + ALL_CONFIGS,
+    'openstack-origin-git': ['upgrade', 'apt', SERVER_CONFIGS],
+    'git-venv-source': ['upgrade', 'apt'],
+    'action-managed-upgrade': ['upgrade'],
+    'extra-source': ['apt'],
+    'extra-key': ['apt'],
+    'calico-origin': ['apt'],
+    'midonet-origin': ['apt'],
+    'mem-username': ['apt'],
+    'mem-password': ['apt'],
+    'nuage-packages': ['apt'],
+    'neutron-plugin': ['apt', 'nrpe'] + PLUGIN_TARGETS,
+    'manage-neutron-plugin-legacy-mode': ['apt', 'nrpe'] + PLUGIN_TARGETS,
+    'rabbit-user': ['amqp'],
+    'rabbit-vhost': ['amqp'],
+    'database-user': ['ipv6'],
+    'database': ['ipv6'],
+    'region': [SERVER_CONFIGS, 'identity-service', 'neutron-plugin-api'],
+    'use-internal-endpoints': [SERVER_CONFIGS],
+    'neutron-security-groups': PLUGIN_TARGETS,
+    'neutron-external-network': [SERVER_CONFIGS],
+    'network-device-mtu': [SERVER_CONFIGS, 'neutron-plugin-api'],
+    'global-physnet-mtu': [SERVER_CONFIGS],
+    'path-mtu': [SERVER_CONFIGS],
+    'overlay-network-type': PLUGIN_TARGETS,
+    'default-tenant-network-type': [SERVER_CONFIGS],
+    'flat-network-providers': [SERVER_CONFIGS],
+    'vlan-ranges': [SERVER_CONFIGS],
+    'vni-ranges': [SERVER_CONFIGS],
+    'l2-population': PLUGIN_TARGETS,
+    'enable-dvr': ['routers'] + PLUGIN_TARGETS,
+    'enable-l3ha': ['routers'] + PLUGIN_TARGETS,
+    'enable-sriov': PLUGIN_TARGETS,
+    'enable-ml2-port-security': [SERVER_CONFIGS],
+    'max-l3-agents-per-router': [SERVER_CONFIGS],
+    'min-l3-agents-per-router': [SERVER_CONFIGS],
+    'dhcp-agents-per-network': [SERVER_CONFIGS],
+    'worker-multiplier': [SERVER_CONFIGS, 'haproxy'],
+    'api-worker-multiplier': [SERVER_CONFIGS, 'haproxy'],
+    'rpc-worker-multiplier': [SERVER_CONFIGS],
+    'rpc-state-report-workers': [SERVER_CONFIGS],
+    'report-interval': [SERVER_CONFIGS, 'neutron-plugin-api'],
+    'agent-down-time': [SERVER_CONFIGS],
+    'wsgi-default-pool-size': [SERVER_CONFIGS],
+    'database-max-pool-size': [SERVER_CONFIGS],
+    'database-max-overflow': [SERVER_CONFIGS],
+    'database-pool-timeout': [SERVER_CONFIGS],
+    'database-idle-timeout': [SERVER_CONFIGS],
+    'database-max-retries': [SERVER_CONFIGS],
+    'rpc-response-timeout': [SERVER_CONFIGS],
+    'executor-thread-pool-size': [SERVER_CONFIGS],
+    'rpc-conn-pool-size': [SERVER_CONFIGS],
+    'rabbit-qos-prefetch-count': [SERVER_CONFIGS],
+    'rabbit-heartbeat-timeout-threshold': [SERVER_CONFIGS],
+    'rabbit-heartbeat-rate': [SERVER_CONFIGS],
+    'amqp-durable-queues': [SERVER_CONFIGS],
+    'vip': ADDRESS_TARGETS,
+    'vip_iface': [],
+    'vip_cidr': [],
+    'database-migration-mode': [],
+    'ha-bindiface': [],
+    'ha-mcastport': [],
+    'dns-ha': ENDPOINT_TARGETS,
+    'prefer-ipv6': (['ipv6', 'neutron-plugin-api'] + ADDRESS_TARGETS +
+                    ALL_CONFIGS),
+    'os-admin-network': ADDRESS_TARGETS,
+    'os-internal-network': ADDRESS_TARGETS,
+    'os-public-network': ADDRESS_TARGETS,
+    'os-admin-hostname': ENDPOINT_TARGETS,
+    'os-internal-hostname': ENDPOINT_TARGETS,
+    'os-public-hostname': ENDPOINT_TARGETS,
+    'ssl_cert': ENDPOINT_TARGETS,
+    'ssl_key': ENDPOINT_TARGETS,
+    'ssl_ca': ENDPOINT_TARGETS,
+    'haproxy-server-timeout': ['haproxy'],
+    'haproxy-client-timeout': ['haproxy'],
+    'haproxy-queue-timeout': ['haproxy'],
+    'haproxy-connect-timeout': ['haproxy'],
+    'haproxy-maxconn': ['haproxy'],
+    'haproxy-mode': ['haproxy'],
+    'haproxy-server-maxconn': ['haproxy'],
+    'haproxy-check-inter': ['haproxy'],
+    'haproxy-check-rise': ['haproxy'],
+    'haproxy-check-fall': ['haproxy'],
+    'haproxy-slowstart': ['haproxy'],
+    'quota-security-group': [SERVER_CONFIGS],
+    'quota-security-group-rule': [SERVER_CONFIGS],
+    'quota-network': [SERVER_CONFIGS],
+    'quota-subnet': [SERVER_CONFIGS],
+    'quota-port': [SERVER_CONFIGS],
+    'quota-vip': [SERVER_CONFIGS],
+    'quota-pool': [SERVER_CONFIGS],
+    'quota-member': [SERVER_CONFIGS],
+    'quota-health-monitors': [SERVER_CONFIGS],
+    'quota-router': [SERVER_CONFIGS],
+    'quota-floatingip': [SERVER_CONFIGS],
+    'vsd-cms-id': [SERVER_CONFIGS],
+    'vsd-cms-name': [SERVER_CONFIGS],
+    'vsd-server': [SERVER_CONFIGS],
+    'vsd-auth': [SERVER_CONFIGS],
+    'vsd-organization': [SERVER_CONFIGS],
+    'vsd-auth-ssl': [SERVER_CONFIGS],
+    'vsd-base-uri': [SERVER_CONFIGS],
+    'vsd-auth-resource': [SERVER_CONFIGS],
+    'vsd-netpart-name': [SERVER_CONFIGS],
+    'nsx-controllers': PLUGIN_TARGETS,
+    'nsx-username': PLUGIN_TARGETS,
+    'nsx-password': PLUGIN_TARGETS,
+    'nsx-tz-uuid': PLUGIN_TARGETS,
+    'nsx-l3-uuid': PLUGIN_TARGETS,
+    'plumgrid-username': [SERVER_CONFIGS],
+    'plumgrid-password': [SERVER_CONFIGS],
+    'plumgrid-virtual-ip': [SERVER_CONFIGS],
+    'nagios_context': ['nrpe'],
+    'nagios_servicegroups': ['nrpe'],
+    'harden': [],
+    'profile-hooks': [],
+}
+
+
 BASE_SERVICES = [
     'neutron-server'
 ]
@@ -175,7 +391,10 @@ BASE_RESOURCE_MAP = OrderedDict([
                      context.ZeroMQContext(),
                      context.NotificationDriverContext(),
                      context.BindHostContext(),
-                     context.WorkerConfigContext(),
+                     neutron_api_context.WorkerConfigContext(),
+                     neutron_api_context.NeutronPerformanceContext(),
+                     neutron_api_context.NeutronMessagingContext(),
+                     neutron_api_context.DatabasePoolContext(),
                      context.InternalEndpointContext(),
                      context.MemcacheContext()],
     }),
@@ -293,6 +512,131 @@ def force_etcd_restart():
         service_start('etcd')
 
 
+def update_etcd(cluster, restart=False):
+    '''
+    Apply the etcd cluster string to the local etcd proxy.
+
+    Only a cluster string that differs from the one last applied needs
+    force_etcd_restart to wipe the proxy's data. Otherwise etcd keeps its
+    data and is restarted if restart is set, eg. because another setting
+    in its config changed, or just started if it is not running.
+    '''
+    kv = unitdata.kv()
+    if kv.get(ETCD_CLUSTER_KEY) != cluster:
+        log('etcd cluster changed to {}, restarting etcd'.format(cluster))
+        force_etcd_restart()
+        kv.set(ETCD_CLUSTER_KEY, cluster)
+        kv.flush()
+    elif is_unit_paused_set():
+        return
+    elif restart:
+        service_restart('etcd')
+    elif not service_running('etcd'):
+        service_start('etcd')
+
+
+def write_subordinate_configs(configs):
+    '''
+    Write all configs unless the neutron-plugin-api-subordinate relation
+    data is unchanged since they were last written for it.
+
+    The hashes of the written configs are recorded with the relation data,
+    so configs rewritten by other hooks since are always written again.
+    '''
+    def _digest():
+        return {
+            'relation': neutron_api_context.subordinate_digest(),
+            'configs': dict((f, file_hash(f)) for f in resource_map()),
+        }
+
+    kv = unitdata.kv()
+    if kv.get(SUBORDINATE_DIGEST_KEY) == _digest():
+        log('Subordinate relation data unchanged, not rewriting configs')
+        return
+    configs.write_all()
+    kv.set(SUBORDINATE_DIGEST_KEY, _digest())
+    kv.flush()
+
+
+def reload_haproxy(service_name='haproxy'):
+    '''
+    Gracefully reload haproxy after validating its configuration.
+
+    The running haproxy finishes in-flight connections on the old process
+    and, where supported, hands its listening sockets to the new one, so
+    neutron API clients do not see resets. An invalid configuration is
+    never loaded; haproxy keeps serving with the previous configuration.
+    '''
+    try:
+        subprocess.check_output(['haproxy', '-c', '-q', '-f', HAPROXY_CONF],
+                                stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        log('Not reloading {}, {} failed validation: {}'
+            ''.format(service_name, HAPROXY_CONF, e.output), level=ERROR)
+        return
+    if service_running(service_name):
+        service_reload(service_name)
+    else:
+        service_start(service_name)
+
+
+def restart_functions():
+    '''Services to restart with custom functions on config file changes'''
+    return {'haproxy': reload_haproxy}
+
+
+def config_changed_targets():
+    '''Return the targets of CONFIG_DEPENDENCIES affected by this hook.
+
+    Returns None, meaning everything is affected, outside of the
+    config-changed hook, as hooks such as upgrade-charm also run
+    config_changed. Options missing from CONFIG_DEPENDENCIES affect
+    everything.
+
+    Options are compared with those config_changed last applied, see
+    mark_config_applied. Everything is affected when config_changed has
+    never completed, such as on the first config-changed after install,
+    and when no option changed, as Juju only runs config-changed then
+    after a reboot or agent restart.
+    '''
+    if hook_name() != 'config-changed':
+        return None
+    cfg = config()
+    changed = cfg.changed_since_applied()
+    if not changed:
+        return None
+    targets = set()
+    for key in changed:
+        if key not in CONFIG_DEPENDENCIES:
+            if key in cfg.option_types():
+                return None
+            # keys stored by the charm itself
+            continue
+        targets.update(CONFIG_DEPENDENCIES[key])
+    return targets
+
+
+def mark_config_applied():
+    '''Record that config_changed has applied the current options.'''
+    config().mark_applied()
+
+
+def config_files_for(targets, configs):
+    '''Return the registered config files affected by targets.'''
+    groups = {
+        'haproxy': [HAPROXY_CONF],
+        'apache': [APACHE_CONF, APACHE_24_CONF],
+        'memcached': [MEMCACHED_CONF],
+    }
+    other = [f for files in groups.values() for f in files]
+    groups[SERVER_CONFIGS] = [f for f in configs.templates
+                              if f not in other]
+    files = set()
+    for target in targets:
+        files.update(groups.get(target, []))
+    return [f for f in configs.templates if f in files]
+
+
 def manage_plugin():
     return config('manage-neutron-plugin-legacy-mode')
 
@@ -331,6 +675,8 @@ def determine_packages(source=None):
         if release >= 'kilo':
             for p in GIT_PACKAGE_BLACKLIST_KILO:
                 packages.remove(p)
+        if not git_venv_build_required():
+            packages = [p for p in packages if p not in GIT_BUILD_PACKAGES]
 
     packages.extend(token_cache_pkgs(release=release))
     return list(set(packages))
@@ -458,11 +804,22 @@ def do_openstack_upgrade(configs):
     # set CONFIGS to load templates from new release
     configs.set_release(openstack_release=new_os_rel)
     # Before kilo it's nova-cloud-controllers job
-    if is_elected_leader(CLUSTER_RES):
-        # Stamping seems broken and unnecessary in liberty (Bug #1536675)
-        if os_release('neutron-common') < 'liberty':
-            stamp_neutron_database(cur_os_rel)
+    leader = is_elected_leader(CLUSTER_RES)
+    # Stamping seems broken and unnecessary in liberty (Bug #1536675)
+    if leader and os_release('neutron-common') < 'liberty':
+        stamp_neutron_database(cur_os_rel)
+    # os_release is cached from before the packages were upgraded
+    reset_os_release()
+    if not leader:
+        # The leader may have handed this unit the restart token for an
+        # online migration before it was upgraded; it leaves the token in
+        # place until this unit acknowledges the target release.
+        restart_for_online_migration()
+    elif online_migration_enabled() and neutron_db_initialised():
+        start_online_migration()
+    else:
         migrate_neutron_database()
+        record_neutron_db_migration()
 
 
 def stamp_neutron_database(release):
@@ -510,9 +867,14 @@ def nuage_vsp_juno_neutron_migration():
         raise Exception(e)
 
 
-def migrate_neutron_database():
-    '''Initializes a new database or upgrades an existing database.'''
-    log('Migrating the neutron database.')
+def migrate_neutron_database(phase=None):
+    '''Initializes a new database or upgrades an existing database.
+
+    :param phase: 'expand' or 'contract' to only apply that branch of the
+                  migrations, or None to upgrade to head.
+    '''
+    log('Migrating the neutron database{}.'.format(
+        ' ({})'.format(phase) if phase else ''))
     if(os_release('neutron-server') == 'juno' and
        config('neutron-plugin') == 'vsp'):
         nuage_vsp_juno_neutron_migration()
@@ -523,11 +885,332 @@ def migrate_neutron_database():
                '--config-file', neutron_plugin_attribute(plugin,
                                                          'config',
                                                          'neutron'),
-               'upgrade',
-               'head']
+               'upgrade']
+        cmd.append('--{}'.format(phase) if phase else 'head')
         subprocess.check_output(cmd)
 
 
+def _alembic_revision(script):
+    '''Return the revision and the set of down revisions declared by an
+    alembic migration script, or None if it declares no revision.
+
+    Merge revisions declare a tuple of down revisions.
+    '''
+    try:
+        tree = ast.parse(script)
+    except SyntaxError:
+        return None
+    values = {}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        for target in node.targets:
+            if (isinstance(target, ast.Name) and
+                    target.id in ('revision', 'down_revision')):
+                try:
+                    values[target.id] = ast.literal_eval(node.value)
+                except ValueError:
+                    pass
+    revision = values.get('revision')
+    if not isinstance(revision, basestring):
+        return None
+    down_revisions = values.get('down_revision') or ()
+    if isinstance(down_revisions, basestring):
+        down_revisions = (down_revisions,)
+    return revision, set(down_revisions)
+
+
+def alembic_heads():
+    '''Return the alembic head revisions of the installed neutron projects.
+
+    The migration scripts are parsed rather than asking neutron-db-manage,
+    which takes seconds to import neutron and its plugins.
+
+    :returns: sorted list of '<project>:<revision>', empty if no migrations
+              are found.
+    '''
+    site_dirs = [SITE_PACKAGES]
+    if git_install_requested():
+        site_dirs.append(os.path.join(
+            git_pip_venv_dir(config('openstack-origin-git')),
+            'lib/python2.7/site-packages'))
+    heads = []
+    for site_dir in site_dirs:
+        for versions in glob.glob(os.path.join(site_dir,
+                                               ALEMBIC_VERSIONS_GLOB)):
+            project = versions[len(site_dir):].strip('/').split('/')[0]
+            revisions = set()
+            down_revisions = set()
+            for path, _, files in os.walk(versions):
+                for name in files:
+                    if not name.endswith('.py'):
+                        continue
+                    with open(os.path.join(path, name)) as f:
+                        declared = _alembic_revision(f.read())
+                    if declared:
+                        revisions.add(declared[0])
+                        down_revisions.update(declared[1])
+            heads.extend('{}:{}'.format(project, head)
+                         for head in revisions - down_revisions)
+    return sorted(heads)
+
+
+def _database_credentials():
+    '''Return the type, host, user, password and name of the related
+    database, or None if it is not related yet.'''
+    for rid in relation_ids('shared-db'):
+        for unit in related_units(rid):
+            rdata = relation_get(rid=rid, unit=unit)
+            if rdata.get('db_host') and rdata.get('password'):
+                return {'type': 'mysql',
+                        'host': rdata['db_host'],
+                        'user': config('database-user'),
+                        'password': rdata['password'],
+                        'database': config('database')}
+    for rid in relation_ids('pgsql-db'):
+        for unit in related_units(rid):
+            rdata = relation_get(rid=rid, unit=unit)
+            if rdata.get('host') and rdata.get('password'):
+                return {'type': 'postgresql',
+                        'host': rdata['host'],
+                        'user': rdata.get('user'),
+                        'password': rdata['password'],
+                        'database': config('database')}
+    return None
+
+
+def db_alembic_versions():
+    '''Return the alembic revisions recorded in the related database.
+
+    Neutron records its revisions in alembic_version, and its service
+    projects in their own alembic_version_* tables.
+
+    :returns: sorted list of revisions, empty if the database was never
+              migrated, or None if the database cannot be read.
+    '''
+    creds = _database_credentials()
+    if not creds:
+        return None
+    try:
+        if creds['type'] == 'mysql':
+            import MySQLdb as driver
+            conn = driver.connect(host=creds['host'], user=creds['user'],
+                                  passwd=creds['password'],
+                                  db=creds['database'])
+            schema_column = 'table_schema'
+        else:
+            import psycopg2 as driver
+            conn = driver.connect(host=creds['host'], user=creds['user'],
+                                  password=creds['password'],
+                                  dbname=creds['database'])
+            schema_column = 'table_catalog'
+    except ImportError as e:
+        log('Unable to read the neutron database: {}'.format(e),
+            level=WARNING)
+        return None
+    except driver.Error as e:
+        log('Unable to connect to the neutron database: {}'.format(e),
+            level=WARNING)
+        return None
+    versions = []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("select table_name from information_schema.tables "
+                       "where {} = %s and table_name like "
+                       "'alembic\\_version%%'".format(schema_column),
+                       [creds['database']])
+        for table in [row[0] for row in cursor.fetchall()]:
+            cursor.execute('select version_num from {}'.format(table))
+            versions.extend(row[0] for row in cursor.fetchall())
+    except driver.Error as e:
+        log('Unable to read the neutron database: {}'.format(e),
+            level=WARNING)
+        return None
+    finally:
+        conn.close()
+    return sorted(versions)
+
+
+def db_migration_fingerprint(heads=None):
+    '''Return a digest of the related database and the alembic heads of the
+    installed packages, or None if either is unknown.'''
+    creds = _database_credentials()
+    if heads is None:
+        heads = alembic_heads()
+    if not creds or not heads:
+        return None
+    database = '{}/{}'.format(creds['host'], creds['database'])
+    return hashlib.md5(
+        '\n'.join([database] + heads).encode('utf-8')).hexdigest()
+
+
+def neutron_db_migrated():
+    '''Whether the database is already migrated to the alembic heads of the
+    installed packages.
+
+    The fingerprint the leader records after migrating is only a hint,
+    which saves connecting to the database when the heads changed. The
+    revisions in the database decide, as it may have been restored or
+    replaced since.
+    '''
+    heads = alembic_heads()
+    fingerprint = db_migration_fingerprint(heads)
+    if not fingerprint:
+        return False
+    try:
+        if leader_get(DB_MIGRATION_HEADS_KEY) != fingerprint:
+            return False
+    except NotImplementedError:
+        pass
+    versions = db_alembic_versions()
+    if versions is None:
+        return False
+    return set(head.split(':', 1)[1] for head in heads).issubset(versions)
+
+
+def record_neutron_db_migration():
+    '''Record in leader settings that the database is fully migrated to the
+    installed release and the alembic heads of the installed packages.'''
+    release = os_release('neutron-server')
+    settings = {DB_MIGRATION_KEY: release,
+                DB_MIGRATION_EXPANDED_KEY: release,
+                DB_MIGRATION_RESTART_KEY: None}
+    fingerprint = db_migration_fingerprint()
+    if fingerprint:
+        settings[DB_MIGRATION_HEADS_KEY] = fingerprint
+    try:
+        leader_set(settings)
+    except NotImplementedError:
+        log('Leader settings unavailable, not recording database migration')
+
+
+def neutron_db_initialised():
+    '''Whether the neutron database was migrated before; a database never
+    migrated has no running servers to keep serving, so is migrated
+    offline.
+
+    Falls back to the migrations recorded in leader settings if the
+    database cannot be read.
+    '''
+    versions = db_alembic_versions()
+    if versions is not None:
+        return bool(versions)
+    return bool(leader_get(DB_MIGRATION_KEY) or
+                leader_get(DB_MIGRATION_HEADS_KEY))
+
+
+def online_migration_enabled():
+    '''Whether database migrations run online: the schema is expanded
+    while the current servers keep serving, the units are restarted one at
+    a time and the schema is contracted once they all run the new code.'''
+    return (config('database-migration-mode') == 'online' and
+            os_release('neutron-server') >= 'liberty')
+
+
+def db_migration_pending():
+    '''Return the release an online migration is in progress to, or
+    None.'''
+    if not online_migration_enabled():
+        return None
+    target = leader_get(DB_MIGRATION_EXPANDED_KEY)
+    if target and target != leader_get(DB_MIGRATION_KEY):
+        return target
+    return None
+
+
+def _restarted_for_migration(target):
+    '''Restart neutron-server onto the expanded schema, once per target
+    release, and acknowledge the release it runs to the leader over the
+    cluster relation.
+
+    A unit not yet upgraded to the target release is not restarted, and
+    its acknowledgement holds the migration until it is.
+    '''
+    release = os_release('neutron-server')
+    kv = unitdata.kv()
+    if release != target:
+        log('neutron-server runs {}, not restarting it for the {} database '
+            'migration until it is upgraded'.format(release, target),
+            level=WARNING)
+    elif kv.get(DB_MIGRATION_RESTARTED_KEY) != target:
+        status_set('maintenance',
+                   'Restarting neutron-server for {} database '
+                   'migration'.format(target))
+        if not is_unit_paused_set():
+            service_restart('neutron-server')
+        kv.set(DB_MIGRATION_RESTARTED_KEY, target)
+        kv.flush()
+    for rid in relation_ids('cluster'):
+        relation_set(relation_id=rid,
+                     relation_settings={DB_MIGRATION_RESTARTED_KEY: release})
+
+
+def start_online_migration():
+    '''Expand the database schema for the installed release and start the
+    rolling restart, on the leader.
+
+    Completed migrations are recorded in leader settings so they are never
+    run twice, whichever unit leads.
+
+    :returns: False if the database is already migrated to the release.
+    '''
+    target = os_release('neutron-server')
+    if leader_get(DB_MIGRATION_KEY) == target:
+        log('Neutron database already migrated to {}'.format(target))
+        return False
+    if leader_get(DB_MIGRATION_EXPANDED_KEY) != target:
+        status_set('maintenance',
+                   'Expanding neutron database schema for {}'.format(target))
+        migrate_neutron_database('expand')
+        leader_set({DB_MIGRATION_EXPANDED_KEY: target})
+    progress_online_migration()
+    return True
+
+
+def progress_online_migration():
+    '''Advance an online migration, on the leader.
+
+    The leader restarts itself first, then hands the restart token in leader
+    settings to each peer in turn as the previous one acknowledges its
+    restart, and contracts the schema once every unit has restarted.
+    '''
+    target = db_migration_pending()
+    if not target:
+        return
+    rids = relation_ids('cluster')
+    if unitdata.kv().get(DB_MIGRATION_RESTARTED_KEY) != target:
+        _restarted_for_migration(target)
+    peers = sorted(set(unit for rid in rids for unit in related_units(rid)))
+    pending = [unit for unit in peers
+               if not any(relation_get(DB_MIGRATION_RESTARTED_KEY, rid=rid,
+                                       unit=unit) == target
+                          for rid in rids)]
+    if pending:
+        if leader_get(DB_MIGRATION_RESTART_KEY) != pending[0]:
+            leader_set({DB_MIGRATION_RESTART_KEY: pending[0]})
+        status_set('maintenance',
+                   'Rolling restart for {} database migration: {} of {} '
+                   'units restarted'.format(target,
+                                            len(peers) - len(pending) + 1,
+                                            len(peers) + 1))
+        return
+    status_set('maintenance',
+               'Contracting neutron database schema for {}'.format(target))
+    migrate_neutron_database('contract')
+    leader_set({DB_MIGRATION_KEY: target, DB_MIGRATION_RESTART_KEY: None})
+    log('Online migration of the neutron database to {} '
+        'complete'.format(target))
+
+
+def restart_for_online_migration():
+    '''Restart onto an expanded schema when the leader hands this unit the
+    restart token, unless it already restarted for the migration.'''
+    target = db_migration_pending()
+    if (target and leader_get(DB_MIGRATION_RESTART_KEY) == local_unit() and
+            unitdata.kv().get(DB_MIGRATION_RESTARTED_KEY) != target):
+        _restarted_for_migration(target)
+
+
 def get_topics():
     return ['q-l3-plugin',
             'q-firewall-plugin',
@@ -571,6 +1254,7 @@ def get_neutron_client():
     return neutron_client
 
 
+@profiled('neutron-api')
 def router_feature_present(feature):
     ''' Check For dvr enabled routers '''
     neutron_client = get_neutron_client()
@@ -584,6 +1268,7 @@ l3ha_router_present = partial(router_feature_present, feature='ha')
 dvr_router_present = partial(router_feature_present, feature='distributed')
 
 
+@profiled('neutron-api')
 def neutron_ready():
     ''' Check if neutron is ready by running arbitrary query'''
     neutron_client = get_neutron_client()
@@ -600,12 +1285,150 @@ def neutron_ready():
 
 
 def git_install(projects_yaml):
-    """Perform setup, and install git repos specified in yaml parameter."""
+    """Perform setup, and install git repos specified in yaml parameter.
+
+    Depending on git-venv-source the venv is built on this unit, or
+    installed from a tarball built by the leader or attached as the
+    neutron-venv resource.
+    """
     if git_install_requested():
         git_pre_install()
         projects_yaml = git_default_repos(projects_yaml)
-        git_clone_and_install(projects_yaml, core_project='neutron')
-        git_post_install(projects_yaml)
+        if git_venv_build_required():
+            missing = filter_installed_packages(GIT_BUILD_PACKAGES)
+            if missing:
+                apt_install(missing, fatal=True)
+            changed = git_clone_and_install(projects_yaml,
+                                            core_project='neutron')
+            if changed:
+                http_proxy = git_yaml_value(projects_yaml, 'http_proxy')
+                if http_proxy:
+                    pip_install('mysql-python', proxy=http_proxy,
+                                venv=git_pip_venv_dir(projects_yaml))
+                else:
+                    pip_install('mysql-python',
+                                venv=git_pip_venv_dir(projects_yaml))
+        else:
+            changed = git_fetch_venv(projects_yaml)
+            if changed is None:
+                log('Prebuilt neutron venv not available yet, deferring git '
+                    'install')
+                return
+        git_post_install(projects_yaml, changed)
+        if git_venv_source() == 'leader' and is_elected_leader(CLUSTER_RES):
+            git_publish_venv(projects_yaml, changed)
+
+
+def git_venv_source():
+    """Return where the git venv comes from: build, leader or resource."""
+    return config('git-venv-source') or 'build'
+
+
+def git_venv_build_required():
+    """Whether this unit builds the git venv from source itself."""
+    source = git_venv_source()
+    return (source == 'build' or
+            (source == 'leader' and is_elected_leader(CLUSTER_RES)))
+
+
+def git_venv_artifact(checksum):
+    """Return the path this unit keeps the venv tarball with checksum in."""
+    return os.path.join(GIT_VENV_ARTIFACT_DIR,
+                        'neutron-venv-{}.tar.gz'.format(checksum[:16]))
+
+
+def git_prune_venv_artifacts(checksum):
+    """Remove venv tarballs other than the one with checksum."""
+    keep = git_venv_artifact(checksum)
+    for path in glob.glob(os.path.join(GIT_VENV_ARTIFACT_DIR,
+                                       'neutron-venv-*')):
+        if path != keep:
+            os.remove(path)
+
+
+def git_fetch_venv(projects_yaml):
+    """Install the prebuilt venv from the leader or the neutron-venv resource.
+
+    :returns: ['neutron'] if a new venv was installed, [] if the installed
+              venv is current or None if no venv is available yet.
+    """
+    tarball = None
+    if git_venv_source() == 'resource':
+        tarball = resource_get(GIT_VENV_RESOURCE)
+        if not tarball:
+            return None
+        tarball = tarball.strip()
+        checksum = file_hash(tarball, hash_type='sha256')
+    else:
+        url = leader_get(GIT_VENV_URL_KEY)
+        checksum = leader_get(GIT_VENV_SHA256_KEY)
+        if not url or not checksum:
+            return None
+
+    kv = unitdata.kv()
+    if (kv.get(GIT_VENV_KEY) == checksum and
+            os.path.exists(git_pip_venv_dir(projects_yaml))):
+        return []
+
+    if tarball is None:
+        tarball = git_venv_artifact(checksum)
+        if not os.path.exists(tarball):
+            mkdir(GIT_VENV_ARTIFACT_DIR, perms=0o755)
+            log('Fetching prebuilt neutron venv from {}'.format(url))
+            partial = '{}.part'.format(tarball)
+            ArchiveUrlFetchHandler().download(url, partial)
+            check_hash(partial, checksum, hash_type='sha256')
+            os.rename(partial, tarball)
+
+    git_unpack_venv(projects_yaml, tarball)
+    kv.set(GIT_VENV_KEY, checksum)
+    kv.flush()
+    if git_venv_source() == 'leader':
+        git_prune_venv_artifacts(checksum)
+    return ['neutron']
+
+
+def git_publish_venv(projects_yaml, changed=None):
+    """Pack the venv if it changed and publish it to peers in leader settings.
+
+    :param changed: projects git_clone_and_install installed, or None if the
+                    venv is only packed when no tarball of it exists yet.
+    """
+    kv = unitdata.kv()
+    checksum = kv.get(GIT_VENV_KEY)
+    if changed or not checksum or not os.path.exists(
+            git_venv_artifact(checksum)):
+        mkdir(GIT_VENV_ARTIFACT_DIR, perms=0o755)
+        partial = os.path.join(GIT_VENV_ARTIFACT_DIR, 'neutron-venv.part')
+        git_pack_venv(projects_yaml, partial, core_project='neutron')
+        checksum = file_hash(partial, hash_type='sha256')
+        os.rename(partial, git_venv_artifact(checksum))
+        kv.set(GIT_VENV_KEY, checksum)
+        kv.flush()
+        git_prune_venv_artifacts(checksum)
+
+    url = 'http://{}/neutron-api/{}'.format(
+        format_ipv6_addr(unit_private_ip()) or unit_private_ip(),
+        os.path.basename(git_venv_artifact(checksum)))
+    if (leader_get(GIT_VENV_URL_KEY) != url or
+            leader_get(GIT_VENV_SHA256_KEY) != checksum):
+        log('Publishing prebuilt neutron venv at {}'.format(url))
+        leader_set({GIT_VENV_URL_KEY: url, GIT_VENV_SHA256_KEY: checksum})
+
+
+def git_share_venv():
+    """Publish the venv to peers when this unit leads in leader mode.
+
+    A new leader publishes the venv it already has instead of rebuilding.
+    """
+    if not (git_install_requested() and git_venv_source() == 'leader' and
+            is_elected_leader(CLUSTER_RES)):
+        return
+    projects_yaml = git_default_repos(config('openstack-origin-git'))
+    if os.path.exists(git_pip_venv_dir(projects_yaml)):
+        git_publish_venv(projects_yaml)
+    else:
+        git_install(config('openstack-origin-git'))
 
 
 def git_pre_install():
@@ -627,34 +1450,87 @@ def git_pre_install():
     for d in dirs:
         mkdir(d, owner='neutron', group='neutron', perms=0755, force=False)
 
+    # git_install runs on every config-changed, so never truncate a log
+    # neutron-server is already writing to.
     for l in logs:
-        write_file(l, '', owner='neutron', group='neutron', perms=0600)
+        if not os.path.exists(l):
+            write_file(l, '', owner='neutron', group='neutron', perms=0600)
 
 
-def git_post_install(projects_yaml):
-    """Perform post-install setup."""
-    http_proxy = git_yaml_value(projects_yaml, 'http_proxy')
-    if http_proxy:
-        pip_install('mysql-python', proxy=http_proxy,
-                    venv=git_pip_venv_dir(projects_yaml))
-    else:
-        pip_install('mysql-python',
-                    venv=git_pip_venv_dir(projects_yaml))
+def sync_tree(src, dest, delete=False, keep=()):
+    """Copy the files under src whose content differs to dest.
 
+    :param delete: remove the files and directories under dest that are not
+                   in src, otherwise they are left in place.
+    :param keep: paths under dest never removed or overwritten, such as
+                 configs the charm renders itself.
+    :returns: list of the paths under dest that were updated or removed.
+    """
+    updated = []
+    if delete and os.path.isdir(dest):
+        for root, dirs, files in os.walk(dest, topdown=False):
+            source = os.path.normpath(
+                os.path.join(src, os.path.relpath(root, dest)))
+            for f in files:
+                path = os.path.join(root, f)
+                if (path not in keep and
+                        not os.path.isfile(os.path.join(source, f))):
+                    os.remove(path)
+                    updated.append(path)
+            if not os.path.isdir(source) and not os.listdir(root):
+                os.rmdir(root)
+    for root, dirs, files in os.walk(src):
+        target = os.path.normpath(
+            os.path.join(dest, os.path.relpath(root, src)))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for f in files:
+            path = os.path.join(target, f)
+            if path in keep:
+                continue
+            with open(os.path.join(root, f), 'rb') as fd:
+                content = fd.read()
+            if os.path.isfile(path):
+                with open(path, 'rb') as fd:
+                    if fd.read() == content:
+                        continue
+            shutil.copy2(os.path.join(root, f), path)
+            updated.append(path)
+    return updated
+
+
+def git_post_install(projects_yaml, changed=None):
+    """Perform post-install setup.
+
+    :param changed: names of the projects that were installed, or None if
+                    not known. neutron-server is only restarted if a
+                    project or one of its config files changed, or a
+                    project installed by an earlier hook is still pending
+                    a restart.
+    """
     src_etc = os.path.join(git_src_dir(projects_yaml, 'neutron'), 'etc')
+    # /etc/neutron also holds the configs the charm renders, so only the
+    # plugins and rootwrap filters mirror the source tree. The stock copies
+    # of rendered configs, such as neutron.conf, are never synced.
     configs = [
         {'src': src_etc,
-         'dest': '/etc/neutron'},
+         'dest': '/etc/neutron',
+         'delete': False},
         {'src': os.path.join(src_etc, 'neutron/plugins'),
-         'dest': '/etc/neutron/plugins'},
+         'dest': '/etc/neutron/plugins',
+         'delete': True},
         {'src': os.path.join(src_etc, 'neutron/rootwrap.d'),
-         'dest': '/etc/neutron/rootwrap.d'},
+         'dest': '/etc/neutron/rootwrap.d',
+         'delete': True},
     ]
 
+    rendered = resource_map().keys()
+    synced = []
     for c in configs:
-        if os.path.exists(c['dest']):
-            shutil.rmtree(c['dest'])
-        shutil.copytree(c['src'], c['dest'])
+        synced.extend(sync_tree(c['src'], c['dest'], delete=c['delete'],
+                                keep=rendered))
+    if synced:
+        log('Updated config files from git: {}'.format(', '.join(synced)))
 
     # NOTE(coreycb): Need to find better solution than bin symlinks.
     symlinks = [
@@ -672,7 +1548,7 @@ def git_post_install(projects_yaml):
         os.symlink(s['src'], s['link'])
 
     render('git/neutron_sudoers', '/etc/sudoers.d/neutron_sudoers', {},
-           perms=0o440)
+           perms=0o440, skip_unchanged=True)
 
     bin_dir = os.path.join(git_pip_venv_dir(projects_yaml), 'bin')
     # Use systemd init units/scripts from ubuntu wily onward
@@ -685,7 +1561,7 @@ def git_post_install(projects_yaml):
         template_file = 'git/{}.init.in.template'.format(daemon)
         init_in_file = '{}.init.in'.format(daemon)
         render(template_file, os.path.join(templates_dir, init_in_file),
-               neutron_api_context, perms=0o644)
+               neutron_api_context, perms=0o644, skip_unchanged=True)
         git_generate_systemd_init_files(templates_dir)
     else:
         neutron_api_context = {
@@ -697,10 +1573,17 @@ def git_post_install(projects_yaml):
 
         render('git/upstart/neutron-server.upstart',
                '/etc/init/neutron-server.conf',
-               neutron_api_context, perms=0o644)
+               neutron_api_context, perms=0o644, skip_unchanged=True)
+
+    if (changed is not None and not changed and not synced and
+            not git_restart_pending()):
+        log('No git projects or config files changed, not restarting '
+            'neutron-server')
+        return
 
     if not is_unit_paused_set():
         service_restart('neutron-server')
+    git_restart_done()
 
 
 def get_optional_interfaces():
@@ -731,6 +1614,17 @@ def check_optional_relations(configs):
             return ('blocked',
                     'hacluster missing configuration: '
                     'vip, vip_iface, vip_cidr')
+    if (git_install_requested() and not git_venv_build_required() and
+            not os.path.exists(git_pip_venv_dir(
+                git_default_repos(config('openstack-origin-git'))))):
+        if git_venv_source() == 'resource':
+            return ('blocked',
+                    'Missing {} resource'.format(GIT_VENV_RESOURCE))
+        return 'waiting', 'Waiting for leader to publish neutron venv'
+    target = db_migration_pending()
+    if target:
+        return ('maintenance',
+                'Online database migration to {} in progress'.format(target))
     # return 'unknown' as the lowest priority to not clobber an existing
     # status.
     return 'unknown', ''
@@ -672,3 +672,45 @@ class NeutronAPIBasicDeployment(OpenStackAmuletDeployment):
         action_id = u.run_action(self.neutron_api_sentry, "resume")
         assert u.wait_on_action(action_id), "Resume action failed"
         self._assert_services(should_run=True)
+
+    def test_902_haproxy_reload_connections(self):
+        """Verify haproxy config changes are applied with a graceful reload
+        that does not drop in-flight neutron API connections."""
+        sentry = self.neutron_api_sentry
+        juju_service = 'neutron-api'
+        results = '/tmp/haproxy-reload-test'
+        stop_file = '/tmp/haproxy-reload-test.stop'
+
+        # Issue requests against the haproxy frontend until told to stop,
+        # recording successful and failed connections.
+        load_cmd = (
+            'rm -f {stop}; nohup bash -c \''
+            'ok=0; failed=0; '
+            'while [ ! -f {stop} ]; do '
+            'if curl -s -o /dev/null -m 10 http://127.0.0.1:9696/; '
+            'then ok=$((ok+1)); else failed=$((failed+1)); fi; '
+            'echo "$ok $failed" > {results}; '
+            'done\' > /dev/null 2>&1 &')
+        load_cmd = load_cmd.format(stop=stop_file, results=results)
+        sentry.run(load_cmd)
+
+        u.log.debug('Making haproxy config change on {}...'.format(
+            juju_service))
+        self.d.configure(juju_service, {'haproxy-connect-timeout': 4000})
+        self._auto_wait_for_status(exclude_services=[])
+        self.d.configure(juju_service, {'haproxy-connect-timeout': 5000})
+        self._auto_wait_for_status(exclude_services=[])
+
+        sentry.run('touch {}'.format(stop_file))
+        output, code = sentry.run('sleep 11; cat {}'.format(results))
+        if code != 0:
+            amulet.raise_status(amulet.FAIL,
+                                msg='No haproxy reload test results')
+        ok, failed = [int(v) for v in output.split()]
+        u.log.debug('haproxy reload: {} requests ok, {} dropped'.format(
+            ok, failed))
+        if failed:
+            msg = ('{} of {} neutron API connections dropped during haproxy '
+                   'reload'.format(failed, ok + failed))
+            amulet.raise_status(amulet.FAIL, msg=msg)
+        u.log.debug('OK')
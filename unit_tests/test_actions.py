@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import mock
+import yaml
 
 mock.patch('charmhelpers.core.hookenv.status_set').start()
 with mock.patch('charmhelpers.core.hookenv.config') as config:
@@ -64,6 +65,32 @@ class ResumeTestCase(CharmTestCase):
         self.resume_unit_helper.assert_called_once_with('test-config')
 
 
+class HookStatsTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(HookStatsTestCase, self).setUp(actions, ["action_set"])
+
+    @mock.patch.object(actions.profiling, 'ledger')
+    def test_hook_stats(self, ledger):
+        entries = [
+            {'hook': 'config-changed', 'start': '2016-01-01T00:00:00',
+             'duration': 10.0,
+             'phases': {'render': {'count': 4, 'seconds': 2.0}}},
+            {'hook': 'config-changed', 'start': '2016-01-01T00:01:00',
+             'duration': 20.0,
+             'phases': {'render': {'count': 4, 'seconds': 4.0},
+                        'apt': {'count': 1, 'seconds': 12.0}}},
+        ]
+        ledger.return_value = entries
+        actions.hook_stats([])
+        values = self.action_set.call_args[0][0]
+        self.assertEqual(values['hooks'], 2)
+        self.assertEqual(yaml.safe_load(values['summary']), {
+            'config-changed': {'runs': 2, 'mean': 15.0, 'max': 20.0,
+                               'phases': {'render': 3.0, 'apt': 6.0}}})
+        self.assertEqual(yaml.safe_load(values['last']), entries[-1:])
+
+
 class MainTestCase(CharmTestCase):
 
     def setUp(self):
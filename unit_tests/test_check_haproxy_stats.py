@@ -0,0 +1,142 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from mock import MagicMock, patch
+
+import charmhelpers.contrib.charmsupport.nrpe as nrpe
+import charmhelpers.contrib.openstack.files.check_haproxy_stats as stats
+
+SHOW_STAT = """\
+# pxname,svname,qcur,rate,status,rtime,ttime,hrsp_5xx,
+neutron-server,FRONTEND,,12,OPEN,,,0,
+neutron-server_admin,neutron-api-0,0,3,UP,45,50,0,
+neutron-server_admin,BACKEND,{qcur},7,{status},{rtime},60,2,
+stats,BACKEND,0,0,UP,,,0,
+
+"""
+
+
+def _rows(qcur=0, status='UP', rtime=45):
+    return stats.parse_stats(SHOW_STAT.format(qcur=qcur, status=status,
+                                              rtime=rtime))
+
+
+class CheckHaproxyStatsTest(unittest.TestCase):
+
+    def check(self, rows):
+        return stats.check_backends(rows, ['neutron-server'], 10, 100,
+                                    2000, 10000)
+
+    def test_parse_stats(self):
+        rows = _rows()
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[2]['pxname'], 'neutron-server_admin')
+        self.assertEqual(rows[2]['svname'], 'BACKEND')
+        self.assertEqual(rows[2]['rtime'], '45')
+
+    def test_parse_stats_unexpected(self):
+        self.assertRaises(ValueError, stats.parse_stats, '')
+        self.assertRaises(ValueError, stats.parse_stats, 'Unknown command\n')
+
+    def test_check_backends_ok(self):
+        status, messages, perfdata = self.check(_rows())
+        self.assertEqual(status, stats.OK)
+        self.assertEqual(messages, ['1 haproxy backends looking good'])
+        self.assertIn("'neutron-server_admin_qcur'=0;10;100;0", perfdata)
+        self.assertIn("'neutron-server_admin_rtime'=45ms;2000;10000;0",
+                      perfdata)
+        self.assertIn("'neutron-server_admin_hrsp_5xx'=2c;;;0", perfdata)
+
+    def test_check_backends_queue_warn(self):
+        status, messages, _ = self.check(_rows(qcur=10))
+        self.assertEqual(status, stats.WARNING)
+        self.assertEqual(messages,
+                         ['neutron-server_admin queue:10 rtime:45ms'])
+
+    def test_check_backends_queue_crit(self):
+        status, _, _ = self.check(_rows(qcur=100))
+        self.assertEqual(status, stats.CRITICAL)
+
+    def test_check_backends_rtime(self):
+        status, _, _ = self.check(_rows(rtime=1999))
+        self.assertEqual(status, stats.OK)
+        status, _, _ = self.check(_rows(rtime=2000))
+        self.assertEqual(status, stats.WARNING)
+        status, _, _ = self.check(_rows(rtime=10000))
+        self.assertEqual(status, stats.CRITICAL)
+
+    def test_check_backends_rtime_falls_back_to_ttime(self):
+        status, _, perfdata = self.check(_rows(rtime=''))
+        self.assertEqual(status, stats.OK)
+        self.assertIn("'neutron-server_admin_rtime'=60ms;2000;10000;0",
+                      perfdata)
+
+    def test_check_backends_down(self):
+        status, messages, _ = self.check(_rows(status='DOWN'))
+        self.assertEqual(status, stats.CRITICAL)
+        self.assertIn('neutron-server_admin is DOWN', messages)
+
+    def test_check_backends_no_match(self):
+        status, messages, perfdata = stats.check_backends(
+            _rows(), ['glance'], 10, 100, 2000, 10000)
+        self.assertEqual(status, stats.UNKNOWN)
+        self.assertEqual(perfdata, [])
+
+    @patch.object(stats, 'read_stats')
+    def test_main(self, read_stats):
+        read_stats.return_value = _rows(qcur=100)
+        self.assertEqual(stats.main(['-b', 'neutron-server']),
+                         stats.CRITICAL)
+        read_stats.side_effect = ValueError('boom')
+        self.assertEqual(stats.main([]), stats.UNKNOWN)
+
+
+class AddHaproxyStatsChecksTest(unittest.TestCase):
+
+    def setUp(self):
+        for name in ('pwd', 'grp', 'host', 'service', 'log'):
+            _m = patch.object(nrpe, name)
+            setattr(self, name, _m.start())
+            self.addCleanup(_m.stop)
+        self.grp.getgrnam.return_value.gr_mem = []
+        self.nrpe = MagicMock()
+
+    def test_adds_checks(self):
+        nrpe.add_haproxy_stats_checks(self.nrpe, 'neutron-api/0',
+                                      ['neutron-server'])
+        self.nrpe.add_check.assert_called_once_with(
+            shortname='haproxy_neutron-server_stats',
+            description='Check HAProxy neutron-server backend stats '
+                        '{neutron-api/0}',
+            check_cmd='check_haproxy_stats.py --backend neutron-server')
+
+    def test_group_change_restarts_nrpe(self):
+        nrpe.add_haproxy_stats_checks(self.nrpe, 'neutron-api/0', [])
+        self.host.add_user_to_group.assert_called_once_with('nagios',
+                                                            'haproxy')
+        self.service.assert_called_once_with('restart', 'nagios-nrpe-server')
+
+    def test_existing_member(self):
+        self.grp.getgrnam.return_value.gr_mem = ['nagios']
+        nrpe.add_haproxy_stats_checks(self.nrpe, 'neutron-api/0', [])
+        self.assertFalse(self.host.add_user_to_group.called)
+        self.assertFalse(self.service.called)
+
+    def test_no_nagios_user(self):
+        self.pwd.getpwnam.side_effect = KeyError('nagios')
+        nrpe.add_haproxy_stats_checks(self.nrpe, 'neutron-api/0', [])
+        self.assertFalse(self.host.add_user_to_group.called)
+        self.assertFalse(self.service.called)
@@ -0,0 +1,265 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import imp
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+
+from mock import patch, call
+
+import charmhelpers.core.hookenv as hookenv
+from charmhelpers.core import unitdata
+
+
+class LogBufferingTest(unittest.TestCase):
+
+    def setUp(self):
+        _m = patch.object(hookenv, '_run_hook_tool')
+        self.run_hook_tool = _m.start()
+        self.addCleanup(_m.stop)
+        self.addCleanup(hookenv.log_buffering, False)
+
+    def juju_log(self, message, level=None):
+        command = ['juju-log']
+        if level:
+            command += ['-l', level]
+        return call(command + [message], check=False, invalidate=False)
+
+    def test_unbuffered(self):
+        hookenv.log('one')
+        self.run_hook_tool.assert_called_once_with(
+            ['juju-log', 'one'], check=False, invalidate=False)
+
+    def test_buffered_batches_by_level(self):
+        hookenv.log_buffering(True)
+        hookenv.log('one', level=hookenv.INFO)
+        hookenv.log('two', level=hookenv.INFO)
+        hookenv.log('three', level=hookenv.DEBUG)
+        self.assertFalse(self.run_hook_tool.called)
+        hookenv.flush_log()
+        self.assertEqual(self.run_hook_tool.call_args_list, [
+            self.juju_log('one\ntwo', hookenv.INFO),
+            self.juju_log('three', hookenv.DEBUG),
+        ])
+
+    def test_disable_flushes(self):
+        hookenv.log_buffering(True)
+        hookenv.log('one')
+        hookenv.log_buffering(False)
+        self.assertEqual(self.run_hook_tool.call_args_list,
+                         [self.juju_log('one')])
+        hookenv.log('two')
+        self.assertEqual(self.run_hook_tool.call_count, 2)
+
+    def test_message_limit_flushes(self):
+        hookenv.log_buffering(True)
+        for i in range(hookenv.LOG_BUFFER_MAX_MESSAGES):
+            hookenv.log(str(i))
+        self.assertEqual(self.run_hook_tool.call_count, 1)
+
+    def test_error_flushes(self):
+        hookenv.log_buffering(True)
+        hookenv.log('one')
+        hookenv.log('boom', level=hookenv.ERROR)
+        self.assertEqual(self.run_hook_tool.call_args_list, [
+            self.juju_log('one'),
+            self.juju_log('boom', hookenv.ERROR),
+        ])
+
+    @patch('os.kill')
+    def test_signal_flushes(self, kill):
+        previous = signal.getsignal(signal.SIGTERM)
+        hookenv.log_buffering(True)
+        self.assertEqual(signal.getsignal(signal.SIGTERM),
+                         hookenv._flush_log_on_signal)
+        hookenv.log('one')
+        hookenv._flush_log_on_signal(signal.SIGTERM, None)
+        self.assertEqual(self.run_hook_tool.call_args_list,
+                         [self.juju_log('one')])
+        self.assertEqual(signal.getsignal(signal.SIGTERM), previous)
+        self.assertTrue(kill.called)
+        hookenv.log_buffering(False)
+        self.assertEqual(signal.getsignal(signal.SIGHUP), signal.SIG_DFL)
+
+    @patch.object(hookenv, 'unitdata')
+    def test_hook_failure_flushes(self, unitdata):
+        hooks = hookenv.Hooks()
+
+        @hooks.hook('install')
+        def install():
+            hookenv.log('installing')
+            raise ValueError('boom')
+
+        self.assertRaises(ValueError, hooks.execute, ['hooks/install'])
+        commands = [c[0][0] for c in self.run_hook_tool.call_args_list]
+        self.assertEqual(commands[0], ['juju-log', 'installing'])
+        self.assertEqual(commands[1][:3], ['juju-log', '-l', 'ERROR'])
+        self.assertIn('ValueError: boom', commands[1][3])
+        self.assertFalse(hookenv._log_buffer_state['enabled'])
+        unitdata.commit_deferred.assert_called_with(False)
+
+
+class HookToolCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        hookenv._hook_tool_cache.clear()
+        self.addCleanup(hookenv._hook_tool_cache.clear)
+        _m = patch.object(hookenv.subprocess, 'check_output')
+        self.check_output = _m.start()
+        self.addCleanup(_m.stop)
+        self.check_output.return_value = b'"value"'
+        _m = patch.object(hookenv.subprocess, 'call')
+        self.call = _m.start()
+        self.addCleanup(_m.stop)
+        self.call.return_value = 0
+        _m = patch.dict('os.environ', {'JUJU_UNIT_NAME': 'neutron-api/0'})
+        _m.start()
+        self.addCleanup(_m.stop)
+
+    def test_read_once(self):
+        hookenv._read_hook_tool(['config-get', '--format=json'])
+        hookenv._read_hook_tool(['config-get', '--format=json'])
+        self.assertEqual(self.check_output.call_count, 1)
+
+    def test_relation_set_invalidates_local_unit(self):
+        local = ['relation-get', '--format=json', '-r', 'amqp:1', '-',
+                 'neutron-api/0']
+        remote = ['relation-get', '--format=json', '-r', 'amqp:1', '-',
+                  'rabbitmq-server/0']
+        config = ['config-get', '--format=json']
+        for cmd in (local, remote, config):
+            hookenv._read_hook_tool(cmd)
+        hookenv._run_hook_tool(['relation-set', '-r', 'amqp:1', 'a=b'])
+        for cmd in (local, remote, config):
+            hookenv._read_hook_tool(cmd)
+        self.assertEqual(self.check_output.call_args_list,
+                         [call(local), call(remote), call(config),
+                          call(local)])
+
+    def test_log_keeps_cache(self):
+        hookenv._read_hook_tool(['status-get'])
+        hookenv._run_hook_tool(['juju-log', 'one'])
+        hookenv._read_hook_tool(['status-get'])
+        self.assertEqual(self.check_output.call_count, 1)
+
+    def test_status_set_invalidates_status_get(self):
+        hookenv._read_hook_tool(['status-get'])
+        hookenv._read_hook_tool(['config-get'])
+        hookenv._run_hook_tool(['status-set', 'active', ''])
+        hookenv._read_hook_tool(['status-get'])
+        hookenv._read_hook_tool(['config-get'])
+        self.assertEqual(self.check_output.call_count, 3)
+
+    def test_unknown_tool_invalidates_all(self):
+        hookenv._read_hook_tool(['config-get'])
+        hookenv._run_hook_tool(['storage-add', 'data'])
+        hookenv._read_hook_tool(['config-get'])
+        self.assertEqual(self.check_output.call_count, 2)
+
+
+class StatusSetTest(unittest.TestCase):
+
+    def setUp(self):
+        # unit_tests.test_utils replaces hookenv.status_set on import, so
+        # exercise a private copy of the module.
+        self.hookenv = imp.load_source('_hookenv_status',
+                                       hookenv.__file__.rstrip('c'))
+        _m = patch.object(self.hookenv, '_run_hook_tool')
+        self.run_hook_tool = _m.start()
+        self.addCleanup(_m.stop)
+        self.run_hook_tool.return_value = 0
+
+    def test_dedup(self):
+        self.hookenv.status_set('active', 'Unit is ready')
+        self.hookenv.status_set('active', 'Unit is ready')
+        self.assertEqual(self.run_hook_tool.call_args_list, [
+            call(['status-set', 'active', 'Unit is ready'], check=False)])
+
+    def test_change_is_set(self):
+        self.hookenv.status_set('maintenance', 'Installing')
+        self.hookenv.status_set('active', 'Unit is ready')
+        self.hookenv.status_set('maintenance', 'Installing')
+        self.assertEqual(self.run_hook_tool.call_count, 3)
+
+    def test_failure_not_remembered(self):
+        self.run_hook_tool.return_value = 1
+        self.hookenv.status_set('active', 'Unit is ready')
+        self.run_hook_tool.return_value = 0
+        self.hookenv.status_set('active', 'Unit is ready')
+        commands = [c[0][0][0] for c in self.run_hook_tool.call_args_list]
+        self.assertEqual(commands.count('status-set'), 2)
+
+    @patch('subprocess.check_output')
+    def test_dedup_against_status_get(self, check_output):
+        self.hookenv._hook_tool_cache.clear()
+        check_output.return_value = (b'{"status": "active", '
+                                     b'"message": "Unit is ready"}')
+        self.assertEqual(self.hookenv.status_get(),
+                         ('active', 'Unit is ready'))
+        self.hookenv.status_set('active', 'Unit is ready')
+        self.assertFalse(self.run_hook_tool.called)
+        self.hookenv.status_set('blocked', 'Missing relations')
+        self.assertEqual(self.run_hook_tool.call_count, 1)
+
+    def test_status_get_not_run_to_compare(self):
+        self.hookenv._hook_tool_cache.clear()
+        with patch('subprocess.check_output') as check_output:
+            self.hookenv.status_set('active', 'Unit is ready')
+            self.assertFalse(check_output.called)
+        self.assertEqual(self.run_hook_tool.call_count, 1)
+
+
+class ConfigAppliedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.kv = unitdata.Storage(os.path.join(self.tmpdir, 'state.db'))
+        self.addCleanup(self.kv.close)
+        _m = patch.object(hookenv.unitdata, 'kv', return_value=self.kv)
+        _m.start()
+        self.addCleanup(_m.stop)
+        _m = patch.dict('os.environ', {'CHARM_DIR': self.tmpdir})
+        _m.start()
+        self.addCleanup(_m.stop)
+        _m = patch.object(hookenv, 'atexit')
+        _m.start()
+        self.addCleanup(_m.stop)
+
+    def config(self, **options):
+        cfg = hookenv.Config(options)
+        cfg.save()
+        return cfg
+
+    def test_never_applied(self):
+        self.config(vip='10.0.0.1')
+        # install saved the config, so nothing changed since that hook
+        cfg = self.config(vip='10.0.0.1')
+        self.assertEqual(cfg.changed_keys, frozenset())
+        self.assertIsNone(cfg.changed_since_applied())
+
+    def test_changed_since_applied(self):
+        cfg = self.config(vip='10.0.0.1', region='RegionOne')
+        cfg['charm-key'] = 'stored'
+        cfg.mark_applied()
+        cfg = self.config(vip='10.0.0.1', region='RegionOne')
+        self.assertEqual(cfg.changed_since_applied(), frozenset())
+        self.config(vip='10.0.0.2', region='RegionOne')
+        # the previous hook saw the change, but it was never applied
+        cfg = self.config(vip='10.0.0.2', region='RegionOne')
+        self.assertEqual(cfg.changed_keys, frozenset())
+        self.assertEqual(cfg.changed_since_applied(), frozenset(['vip']))
@@ -18,6 +18,7 @@ from mock import patch
 
 import neutron_api_context as context
 import charmhelpers
+import charmhelpers.core.hookenv as hookenv
 
 from test_utils import CharmTestCase
 
@@ -249,6 +250,7 @@ class HAProxyContextTest(CharmTestCase):
 
     def setUp(self):
         super(HAProxyContextTest, self).setUp(context, TO_PATCH)
+        self.config.side_effect = self.test_config.get
         self.determine_api_port.return_value = 9686
         self.determine_apache_port.return_value = 9686
         self.api_port = 9696
@@ -256,10 +258,14 @@ class HAProxyContextTest(CharmTestCase):
     def tearDown(self):
         super(HAProxyContextTest, self).tearDown()
 
+    @patch.object(context, 'https')
+    @patch.object(context, 'WorkerConfigContext')
     @patch.object(charmhelpers.contrib.openstack.context, 'relation_ids')
     @patch.object(charmhelpers.contrib.openstack.context, 'log')
-    def test_context_No_peers(self, _log, _rids):
+    def test_context_No_peers(self, _log, _rids, _workers, _https):
         _rids.return_value = []
+        _workers.return_value.return_value = {'api_workers': 4}
+        _https.return_value = False
         hap_ctxt = context.HAProxyContext()
         with patch('__builtin__.__import__'):
             self.assertTrue('units' not in hap_ctxt())
@@ -276,11 +282,16 @@ class HAProxyContextTest(CharmTestCase):
     @patch.object(charmhelpers.contrib.openstack.context, 'relation_ids')
     @patch.object(charmhelpers.contrib.openstack.context, 'log')
     @patch.object(charmhelpers.contrib.openstack.context, 'kv')
+    @patch.object(
+        charmhelpers.contrib.openstack.context, 'haproxy_seamless_reload')
+    @patch.object(context, 'https')
+    @patch.object(context, 'WorkerConfigContext')
     @patch('__builtin__.__import__')
     @patch('__builtin__.open')
-    def test_context_peers(self, _open, _import, _kv, _log, _rids, _runits,
-                           _rget, _uget, _lunit, _config,
-                           _get_address_in_network, _get_netmask_for_address):
+    def test_context_peers(self, _open, _import, _workers, _https, _seamless,
+                           _kv, _log, _rids, _runits, _rget, _uget, _lunit,
+                           _config, _get_address_in_network,
+                           _get_netmask_for_address):
         unit_addresses = {
             'neutron-api-0': '10.10.10.10',
             'neutron-api-1': '10.10.10.11',
@@ -294,12 +305,17 @@ class HAProxyContextTest(CharmTestCase):
         _get_address_in_network.return_value = None
         _get_netmask_for_address.return_value = '255.255.255.0'
         _kv().get.return_value = 'abcdefghijklmnopqrstuvwxyz123456'
+        _workers.return_value.return_value = {'api_workers': 4}
+        _https.return_value = False
+        _seamless.return_value = True
         service_ports = {'neutron-server': [9696, 9686]}
         ctxt_data = {
             'local_host': '127.0.0.1',
             'haproxy_host': '0.0.0.0',
             'local_host': '127.0.0.1',
             'stat_port': '8888',
+            'stat_socket': '/var/lib/haproxy/admin.sock',
+            'stat_socket_expose_fd': True,
             'stat_password': 'abcdefghijklmnopqrstuvwxyz123456',
             'frontends': {
                 '10.10.10.11': {
@@ -310,11 +326,46 @@ class HAProxyContextTest(CharmTestCase):
             'default_backend': '10.10.10.11',
             'service_ports': service_ports,
             'neutron_bind_port': 9686,
+            'haproxy_server_maxconn': 128,
+            'haproxy_slowstart': 30000,
         }
         _import().api_port.return_value = 9696
         hap_ctxt = context.HAProxyContext()
         self.assertEquals(hap_ctxt(), ctxt_data)
         _open.assert_called_with('/etc/default/haproxy', 'w')
+        _open().__enter__().write.assert_called_with(
+            'EXTRAOPTS="-x /var/lib/haproxy/admin.sock"\n')
+
+    @patch.object(context, 'https')
+    @patch.object(context, 'WorkerConfigContext')
+    def test_backend_tuning_http(self, _workers, _https):
+        _workers.return_value.return_value = {'api_workers': 2}
+        _https.return_value = False
+        self.test_config.set('haproxy-mode', 'http')
+        self.test_config.set('haproxy-maxconn', 4000)
+        self.test_config.set('haproxy-check-inter', 5000)
+        self.test_config.set('haproxy-check-rise', 3)
+        self.test_config.set('haproxy-check-fall', 2)
+        self.assertEquals(context.HAProxyContext().backend_tuning(), {
+            'haproxy_maxconn': 4000,
+            'haproxy_mode': 'http',
+            'haproxy_httpchk': 'GET /',
+            'haproxy_server_maxconn': 64,
+            'haproxy_check_inter': 5000,
+            'haproxy_check_rise': 3,
+            'haproxy_check_fall': 2,
+            'haproxy_slowstart': 30000,
+        })
+
+    @patch.object(context, 'https')
+    @patch.object(context, 'WorkerConfigContext')
+    def test_backend_tuning_http_with_ssl(self, _workers, _https):
+        _https.return_value = True
+        self.test_config.set('haproxy-mode', 'http')
+        self.test_config.set('haproxy-server-maxconn', 0)
+        self.test_config.set('haproxy-slowstart', 0)
+        self.assertEquals(context.HAProxyContext().backend_tuning(), {})
+        self.assertFalse(_workers.called)
 
 
 class NeutronCCContextTest(CharmTestCase):
@@ -587,6 +638,257 @@ class NeutronCCContextTest(CharmTestCase):
             self.assertEquals(napi_ctxt[key], expect[key])
 
 
+class ProcessRssTest(CharmTestCase):
+
+    def setUp(self):
+        super(ProcessRssTest, self).setUp(context, TO_PATCH)
+        hookenv.cache = {}
+
+    @patch('glob.glob')
+    def test_process_rss_mb_scanned_once(self, _glob):
+        _glob.return_value = []
+        rss = charmhelpers.contrib.openstack.context.process_rss_mb
+        self.assertEquals(rss('neutron-server'), None)
+        self.assertEquals(rss('neutron-server'), None)
+        _glob.assert_called_once_with('/proc/[0-9]*/status')
+
+
+class HAProxySeamlessReloadTest(CharmTestCase):
+
+    def setUp(self):
+        super(HAProxySeamlessReloadTest, self).setUp(context, TO_PATCH)
+        hookenv.cache = {}
+
+    @patch.object(charmhelpers.contrib.openstack.context, 'check_output')
+    def test_version_read_once(self, _check_output):
+        _check_output.return_value = b'HA-Proxy version 1.8.8 2018/04/19'
+        ch_context = charmhelpers.contrib.openstack.context
+        self.assertTrue(ch_context.haproxy_seamless_reload())
+        self.assertTrue(ch_context.haproxy_seamless_reload())
+        _check_output.assert_called_once_with(['haproxy', '-v'])
+
+    @patch.object(charmhelpers.contrib.openstack.context, 'check_output')
+    def test_old_haproxy(self, _check_output):
+        _check_output.return_value = b'HA-Proxy version 1.6.3 2015/12/25'
+        self.assertFalse(
+            charmhelpers.contrib.openstack.context.haproxy_seamless_reload())
+
+
+class WorkerConfigContextTest(CharmTestCase):
+
+    def setUp(self):
+        super(WorkerConfigContextTest, self).setUp(context, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        hookenv.cache = {}
+        self.patches = {}
+        for method in ['config', 'psutil', 'cgroup_cpuset',
+                       'cgroup_cpu_quota', 'cgroup_memory_limit',
+                       'process_rss_mb', 'log']:
+            _m = patch.object(charmhelpers.contrib.openstack.context, method)
+            self.patches[method] = _m.start()
+            self.addCleanup(_m.stop)
+        self.patches['config'].side_effect = self.test_config.get
+        self.patches['psutil'].cpu_count.return_value = 48
+        self.patches['psutil'].virtual_memory.return_value.total = \
+            64 * 1024 ** 3
+        self.patches['cgroup_cpuset'].return_value = None
+        self.patches['cgroup_cpu_quota'].return_value = None
+        self.patches['cgroup_memory_limit'].return_value = None
+        self.patches['process_rss_mb'].return_value = None
+
+    def test_workers(self):
+        self.test_config.set('worker-multiplier', 0.5)
+        self.assertEquals(context.WorkerConfigContext()(), {
+            'workers': 24,
+            'api_workers': 24,
+            'rpc_workers': 24,
+        })
+
+    def test_workers_cpu_quota(self):
+        self.patches['cgroup_cpuset'].return_value = 8
+        self.patches['cgroup_cpu_quota'].return_value = 3.5
+        self.assertEquals(context.WorkerConfigContext()()['workers'], 8)
+        self.patches['process_rss_mb'].assert_called_with('neutron-server')
+
+    def test_workers_topology_read_once(self):
+        self.test_config.set('worker-multiplier', 0.5)
+        context.WorkerConfigContext()()
+        context.WorkerConfigContext()()
+        self.patches['cgroup_cpuset'].assert_called_once_with()
+        self.patches['cgroup_cpu_quota'].assert_called_once_with()
+
+    def test_workers_cpuset(self):
+        self.patches['cgroup_cpuset'].return_value = 6
+        self.assertEquals(context.WorkerConfigContext()()['workers'], 12)
+
+    def test_workers_memory_limit(self):
+        self.patches['cgroup_cpuset'].return_value = 4
+        self.patches['cgroup_memory_limit'].return_value = 4 * 1024 ** 3
+        self.patches['process_rss_mb'].return_value = 300.0
+        # 4096MB * 0.75 / (300MB * 2 pools)
+        self.assertEquals(context.WorkerConfigContext()()['workers'], 5)
+
+    def test_workers_separate_pools(self):
+        self.patches['cgroup_cpuset'].return_value = 8
+        self.test_config.set('api-worker-multiplier', 1.0)
+        self.test_config.set('rpc-worker-multiplier', 0.25)
+        self.assertEquals(context.WorkerConfigContext()(), {
+            'workers': 16,
+            'api_workers': 8,
+            'rpc_workers': 2,
+        })
+
+    def test_workers_zero_multiplier(self):
+        self.test_config.set('worker-multiplier', 0)
+        self.assertEquals(context.WorkerConfigContext()()['workers'], 0)
+
+    def test_parse_cpu_list(self):
+        parse_cpu_list = charmhelpers.contrib.openstack.context.parse_cpu_list
+        self.assertEquals(parse_cpu_list('0-3,8,10-11\n'), 7)
+        self.assertEquals(parse_cpu_list('5'), 1)
+
+
+class NeutronPerformanceContextTest(CharmTestCase):
+
+    def setUp(self):
+        super(NeutronPerformanceContextTest, self).setUp(context, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.relation_ids.return_value = ['neutron-plugin-api:1']
+        self.related_units.return_value = []
+
+    @patch.object(context, 'peer_units')
+    @patch.object(context, 'WorkerConfigContext')
+    def _ctxt(self, agents, peers, cpus, _workers, _peers):
+        self.related_units.return_value = \
+            ['agent/{}'.format(i) for i in range(agents)]
+        _peers.return_value = ['neutron-api/{}'.format(i)
+                               for i in range(peers)]
+        _workers.return_value.num_cpus = cpus
+        return context.NeutronPerformanceContext()()
+
+    def test_defaults(self):
+        self.assertEquals(self._ctxt(10, 0, 4), {
+            'rpc_state_report_workers': 1,
+            'report_interval': 30,
+            'agent_down_time': 75,
+        })
+
+    def test_state_report_workers_scaled(self):
+        ctxt = self._ctxt(1000, 0, 8)
+        self.assertEquals(ctxt['rpc_state_report_workers'], 4)
+        ctxt = self._ctxt(1000, 1, 8)
+        self.assertEquals(ctxt['rpc_state_report_workers'], 2)
+        ctxt = self._ctxt(1000, 0, 2)
+        self.assertEquals(ctxt['rpc_state_report_workers'], 2)
+
+    def test_configured(self):
+        self.test_config.set('rpc-state-report-workers', 3)
+        self.test_config.set('report-interval', 10)
+        self.test_config.set('wsgi-default-pool-size', 50)
+        self.assertEquals(self._ctxt(10, 0, 4), {
+            'rpc_state_report_workers': 3,
+            'report_interval': 10,
+            'agent_down_time': 25,
+            'wsgi_default_pool_size': 50,
+        })
+
+    def test_agent_down_time_configured(self):
+        self.test_config.set('agent-down-time', 120)
+        self.assertEquals(self._ctxt(10, 0, 4)['agent_down_time'], 120)
+
+
+class DatabasePoolContextTest(CharmTestCase):
+
+    def setUp(self):
+        super(DatabasePoolContextTest, self).setUp(context, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+
+    @patch.object(context, 'WorkerConfigContext')
+    def _ctxt(self, api_workers, rpc_workers, _workers):
+        _workers.return_value.return_value = {'api_workers': api_workers,
+                                              'rpc_workers': rpc_workers}
+        return context.DatabasePoolContext()()
+
+    def test_defaults(self):
+        self.assertEquals(self._ctxt(4, 8), {
+            'database_max_pool_size': 32,
+            'database_max_overflow': 16,
+        })
+        self.assertEquals(self._ctxt(0, 0), {
+            'database_max_pool_size': 4,
+            'database_max_overflow': 2,
+        })
+
+    def test_configured(self):
+        self.test_config.set('database-max-pool-size', 20)
+        self.test_config.set('database-max-overflow', 0)
+        self.test_config.set('database-pool-timeout', 30)
+        self.test_config.set('database-idle-timeout', 60)
+        self.test_config.set('database-max-retries', 5)
+        self.assertEquals(self._ctxt(4, 8), {
+            'database_max_pool_size': 20,
+            'database_max_overflow': 0,
+            'database_pool_timeout': 30,
+            'database_idle_timeout': 60,
+            'database_max_retries': 5,
+        })
+
+
+class NeutronMessagingContextTest(CharmTestCase):
+
+    def setUp(self):
+        super(NeutronMessagingContextTest, self).setUp(context, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.relation_ids.return_value = ['neutron-plugin-api:1']
+
+    @patch.object(context, 'peer_units')
+    @patch.object(context, 'WorkerConfigContext')
+    def _ctxt(self, agents, peers, rpc_workers, _workers, _peers):
+        self.related_units.return_value = \
+            ['agent/{}'.format(i) for i in range(agents)]
+        _peers.return_value = ['neutron-api/{}'.format(i)
+                               for i in range(peers)]
+        _workers.return_value.return_value = {'rpc_workers': rpc_workers}
+        return context.NeutronMessagingContext()()
+
+    def test_defaults(self):
+        self.assertEquals(self._ctxt(10, 0, 4), {
+            'executor_thread_pool_size': 64,
+            'rpc_conn_pool_size': 32,
+            'rabbit_qos_prefetch_count': 64,
+            'rpc_response_timeout': 60,
+        })
+
+    def test_scaled_to_agents(self):
+        self.assertEquals(self._ctxt(2000, 1, 5), {
+            'executor_thread_pool_size': 200,
+            'rpc_conn_pool_size': 100,
+            'rabbit_qos_prefetch_count': 200,
+            'rpc_response_timeout': 120,
+        })
+        ctxt = self._ctxt(10000, 0, 1)
+        self.assertEquals(ctxt['executor_thread_pool_size'], 256)
+        self.assertEquals(ctxt['rpc_response_timeout'], 300)
+
+    def test_configured(self):
+        self.test_config.set('executor-thread-pool-size', 100)
+        self.test_config.set('rpc-conn-pool-size', 40)
+        self.test_config.set('rabbit-qos-prefetch-count', 10)
+        self.test_config.set('rpc-response-timeout', 180)
+        self.test_config.set('rabbit-heartbeat-timeout-threshold', 0)
+        self.test_config.set('rabbit-heartbeat-rate', 4)
+        self.test_config.set('amqp-durable-queues', True)
+        self.assertEquals(self._ctxt(10, 0, 4), {
+            'executor_thread_pool_size': 100,
+            'rpc_conn_pool_size': 40,
+            'rabbit_qos_prefetch_count': 10,
+            'rpc_response_timeout': 180,
+            'heartbeat_timeout_threshold': 0,
+            'heartbeat_rate': 4,
+            'amqp_durable_queues': True,
+        })
+
+
 class EtcdContextTest(CharmTestCase):
 
     def setUp(self):
@@ -639,6 +941,7 @@ class NeutronApiSDNContextTest(CharmTestCase):
     def setUp(self):
         super(NeutronApiSDNContextTest, self).setUp(context, TO_PATCH)
         self.relation_get.side_effect = self.test_relation.get
+        hookenv.cache = {}
 
     def tearDown(self):
         super(NeutronApiSDNContextTest, self).tearDown()
@@ -744,6 +1047,45 @@ class NeutronApiSDNContextTest(CharmTestCase):
             {'sections': {}},
         )
 
+    def test_conflicting_plugins(self):
+        rdata = {
+            ('neutron-plugin-api-subordinate:10', 'odl/0'): {
+                'neutron-plugin': 'odl',
+                'core-plugin': 'odl.plugin',
+            },
+            ('neutron-plugin-api-subordinate:2', 'calico/10'): {
+                'neutron-plugin': 'Calico',
+                'core-plugin': 'calico.plugin',
+            },
+            ('neutron-plugin-api-subordinate:2', 'calico/9'): {
+                'neutron-plugin': 'Calico',
+                'neutron-plugin-config': '/etc/neutron/calico.ini',
+            },
+        }
+        self.relation_ids.return_value = [
+            'neutron-plugin-api-subordinate:10',
+            'neutron-plugin-api-subordinate:2',
+        ]
+        self.related_units.side_effect = lambda rid: [
+            unit for r, unit in rdata if r == rid]
+        self.relation_get.side_effect = \
+            lambda rid, unit: rdata[(rid, unit)]
+        ctxt = context.NeutronApiSDNContext()()
+        self.assertEquals(ctxt['neutron_plugin'], 'Calico')
+        self.assertEquals(ctxt['core_plugin'],
+                          'neutron.plugins.ml2.plugin.Ml2Plugin')
+        self.assertEquals(ctxt['neutron_plugin_config'],
+                          '/etc/neutron/calico.ini')
+        self.assertEquals(context.NeutronApiSDNConfigFileContext()(),
+                          {'config': '/etc/neutron/calico.ini'})
+        # Relation data is read once for all of the contexts
+        self.assertEquals(self.relation_get.call_count, 3)
+        digest = context.subordinate_digest()
+        hookenv.cache = {}
+        rdata[('neutron-plugin-api-subordinate:10', 'odl/0')][
+            'core-plugin'] = 'odl.plugin2'
+        self.assertNotEquals(context.subordinate_digest(), digest)
+
 
 class NeutronApiSDNConfigFileContextTest(CharmTestCase):
 
@@ -751,6 +1093,7 @@ class NeutronApiSDNConfigFileContextTest(CharmTestCase):
         super(NeutronApiSDNConfigFileContextTest, self).setUp(
             context, TO_PATCH)
         self.relation_get.side_effect = self.test_relation.get
+        hookenv.cache = {}
 
     def tearDown(self):
         super(NeutronApiSDNConfigFileContextTest, self).tearDown()
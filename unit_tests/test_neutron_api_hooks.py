@@ -12,13 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
 import sys
+import tempfile
 
 import yaml
 
+from collections import OrderedDict
+
 from mock import MagicMock, patch, call
 from test_utils import CharmTestCase
 
+from charmhelpers.core import hookenv, unitdata
+
 # python-apt is not installed as part of test-requirements but is imported by
 # some charmhelpers modules so create a fake import.
 sys.modules['apt'] = MagicMock()
@@ -48,6 +55,8 @@ TO_PATCH = [
     'apt_update',
     'apt_install',
     'config',
+    'config_changed_targets',
+    'mark_config_applied',
     'CONFIGS',
     'check_call',
     'add_source',
@@ -65,19 +74,29 @@ TO_PATCH = [
     'get_l2population',
     'get_overlay_network_type',
     'git_install',
+    'git_share_venv',
+    'git_venv_build_required',
+    'git_venv_source',
     'is_elected_leader',
     'is_relation_made',
     'log',
     'migrate_neutron_database',
+    'neutron_db_initialised',
+    'neutron_db_migrated',
     'neutron_ready',
+    'online_migration_enabled',
     'open_port',
     'openstack_upgrade_available',
     'os_release',
     'os_requires_version',
+    'progress_online_migration',
+    'record_neutron_db_migration',
     'relation_get',
     'relation_ids',
     'relation_set',
+    'restart_for_online_migration',
     'service_restart',
+    'start_online_migration',
     'unit_get',
     'get_iface_for_address',
     'get_netmask_for_address',
@@ -86,7 +105,8 @@ TO_PATCH = [
     'service_reload',
     'neutron_plugin_attribute',
     'IdentityServiceContext',
-    'force_etcd_restart',
+    'update_etcd',
+    'write_subordinate_configs',
     'status_set',
     'network_get_primary_address',
     'update_dns_ha_resource_params',
@@ -129,6 +149,12 @@ class NeutronAPIHooksTests(CharmTestCase):
         super(NeutronAPIHooksTests, self).setUp(hooks, TO_PATCH)
 
         self.config.side_effect = self.test_config.get
+        self.config_changed_targets.return_value = None
+        self.online_migration_enabled.return_value = False
+        self.neutron_db_migrated.return_value = False
+        self.neutron_db_initialised.return_value = True
+        self.git_venv_build_required.return_value = True
+        self.git_venv_source.return_value = 'build'
         self.relation_get.side_effect = self.test_relation.get
         self.test_config.set('openstack-origin', 'distro')
         self.test_config.set('neutron-plugin', 'ovs')
@@ -246,6 +272,101 @@ class NeutronAPIHooksTests(CharmTestCase):
         self.assertTrue(self.do_openstack_upgrade.called)
         self.assertTrue(self.apt_install.called)
 
+    @patch.object(hooks, 'git_install_requested')
+    def test_config_changed_haproxy_only(self, git_requested):
+        git_requested.return_value = False
+        self.config_changed_targets.return_value = set(['haproxy'])
+        self.CONFIGS.templates = OrderedDict([
+            (NEUTRON_CONF, None), ('/etc/haproxy/haproxy.cfg', None)])
+        self.relation_ids.side_effect = self._fake_relids
+        _n_api_rel_joined = self.patch('neutron_api_relation_joined')
+        _conf_https = self.patch('configure_https')
+        self._call_hook('config-changed')
+        self.assertFalse(self.neutron_ready.called)
+        self.assertFalse(self.openstack_upgrade_available.called)
+        self.assertFalse(self.apt_install.called)
+        self.assertFalse(_conf_https.called)
+        self.assertFalse(self.update_nrpe_config.called)
+        self.assertFalse(_n_api_rel_joined.called)
+        self.assertFalse(self.CONFIGS.write_all.called)
+        self.CONFIGS.write.assert_called_once_with('/etc/haproxy/haproxy.cfg')
+
+    @patch.object(hooks, 'git_install_requested')
+    @patch.object(hooks, 'additional_install_locations')
+    @patch.object(hooks, 'configure_https')
+    def test_install_then_config_changed(self, configure_https,
+                                         additional_install_locations,
+                                         git_requested):
+        git_requested.return_value = False
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        kv = unitdata.Storage(os.path.join(tmpdir, 'state.db'))
+        self.addCleanup(kv.close)
+        for patcher in [patch.object(unitdata, '_KV', kv),
+                        patch.object(hookenv, 'atexit'),
+                        patch.dict('os.environ', {'CHARM_DIR': tmpdir})]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.config_changed_targets.side_effect = \
+            utils.config_changed_targets
+        self.mark_config_applied.side_effect = utils.mark_config_applied
+        self.relation_ids.side_effect = self._fake_relids
+        _n_api_rel_joined = self.patch('neutron_api_relation_joined')
+        for joined in ('neutron_plugin_api_relation_joined', 'amqp_joined',
+                       'identity_joined', 'cluster_joined',
+                       'zeromq_configuration_relation_joined'):
+            self.patch(joined)
+        _setup_ipv6 = self.patch('setup_ipv6')
+        self.patch('sync_db_with_multi_ipv6_addresses')
+
+        def run(hookname):
+            # hookenv.config() loads the config once per hook and saves it
+            # when the hook exits
+            cfg = hookenv.Config(self.test_config.get_all())
+            with patch.dict('os.environ', {'JUJU_HOOK_NAME': hookname}):
+                with patch.object(utils, 'config', return_value=cfg):
+                    self._call_hook(hookname)
+            cfg.save()
+
+        def assert_all_phases_run():
+            for mocked in (self.CONFIGS.write_all, configure_https,
+                           self.update_nrpe_config, _setup_ipv6,
+                           _n_api_rel_joined):
+                self.assertTrue(mocked.called)
+                mocked.reset_mock()
+
+        self.test_config.set('prefer-ipv6', True)
+        run('install.real')
+        # install saved the config, but the first config-changed still
+        # applies every option
+        run('config-changed')
+        assert_all_phases_run()
+        # config-changed with no option changed follows an agent restart
+        run('config-changed')
+        assert_all_phases_run()
+        self.test_config.set('nagios_context', 'other')
+        run('config-changed')
+        self.assertTrue(self.update_nrpe_config.called)
+        self.assertFalse(self.CONFIGS.write_all.called)
+        self.assertFalse(configure_https.called)
+        self.assertFalse(_n_api_rel_joined.called)
+
+    @patch.object(hooks, 'additional_install_locations')
+    @patch.object(hooks, 'git_install_requested')
+    def test_config_changed_peer_migration(self, git_requested, _locations):
+        git_requested.return_value = False
+        self.is_elected_leader.return_value = False
+        self._call_hook('config-changed')
+        self.restart_for_online_migration.assert_called_once_with()
+
+    @patch.object(hooks, 'additional_install_locations')
+    @patch.object(hooks, 'git_install_requested')
+    def test_config_changed_leader_migration(self, git_requested, _locations):
+        git_requested.return_value = False
+        self.is_elected_leader.return_value = True
+        self._call_hook('config-changed')
+        self.assertFalse(self.restart_for_online_migration.called)
+
     def test_config_changed_nodvr_disprouters(self):
         self.neutron_ready.return_value = True
         self.dvr_router_present.return_value = True
@@ -611,6 +732,7 @@ class NeutronAPIHooksTests(CharmTestCase):
             'service_tenant': None,
             'service_port': None,
             'region': 'RegionOne',
+            'report-interval': 30,
             'service_password': None,
             'auth_port': None,
             'auth_host': None,
@@ -644,6 +766,7 @@ class NeutronAPIHooksTests(CharmTestCase):
             'service_tenant': None,
             'service_port': None,
             'region': 'RegionOne',
+            'report-interval': 30,
             'service_password': None,
             'auth_port': None,
             'auth_host': None,
@@ -677,6 +800,7 @@ class NeutronAPIHooksTests(CharmTestCase):
             'service_tenant': None,
             'service_port': None,
             'region': 'RegionOne',
+            'report-interval': 30,
             'service_password': None,
             'auth_port': None,
             'auth_host': None,
@@ -712,6 +836,7 @@ class NeutronAPIHooksTests(CharmTestCase):
             'service_tenant': None,
             'service_port': None,
             'region': 'RegionOne',
+            'report-interval': 30,
             'service_password': None,
             'auth_port': None,
             'auth_host': None,
@@ -730,8 +855,31 @@ class NeutronAPIHooksTests(CharmTestCase):
         )
 
     def test_cluster_changed(self):
+        self.is_elected_leader.return_value = False
         self._call_hook('cluster-relation-changed')
         self.assertTrue(self.CONFIGS.write_all.called)
+        self.assertFalse(self.progress_online_migration.called)
+
+    def test_cluster_changed_leader(self):
+        self.is_elected_leader.return_value = True
+        self._call_hook('cluster-relation-changed')
+        self.progress_online_migration.assert_called_with()
+
+    def test_leader_elected(self):
+        self._call_hook('leader-elected')
+        self.progress_online_migration.assert_called_with()
+        self.git_share_venv.assert_called_with()
+
+    def test_leader_settings_changed(self):
+        self._call_hook('leader-settings-changed')
+        self.restart_for_online_migration.assert_called_with()
+        self.assertFalse(self.git_install.called)
+
+    def test_leader_settings_changed_git_venv_leader(self):
+        self.git_venv_source.return_value = 'leader'
+        self.test_config.set('openstack-origin-git', 'mitaka')
+        self._call_hook('leader-settings-changed')
+        self.git_install.assert_called_with('mitaka')
 
     @patch.object(hooks, 'get_hacluster_config')
     def test_ha_joined(self, _get_ha_config):
@@ -923,6 +1071,47 @@ class NeutronAPIHooksTests(CharmTestCase):
         self.os_release.return_value = 'kilo'
         hooks.conditional_neutron_migration()
         self.migrate_neutron_database.assert_called_with()
+        self.record_neutron_db_migration.assert_called_with()
+        self.service_restart.assert_called_with('neutron-server')
+
+    def test_conditional_neutron_migration_leader_migrated(self):
+        self.test_relation.set({
+            'allowed_units': 'neutron-api/0 neutron-api/1 neutron-api/4',
+        })
+        self.local_unit.return_value = 'neutron-api/1'
+        self.is_elected_leader.return_value = True
+        self.os_release.return_value = 'kilo'
+        self.neutron_db_migrated.return_value = True
+        hooks.conditional_neutron_migration()
+        self.assertFalse(self.migrate_neutron_database.called)
+        self.assertFalse(self.service_restart.called)
+
+    def test_conditional_neutron_migration_leader_online(self):
+        self.test_relation.set({
+            'allowed_units': 'neutron-api/0 neutron-api/1 neutron-api/4',
+        })
+        self.local_unit.return_value = 'neutron-api/1'
+        self.is_elected_leader.return_value = True
+        self.os_release.return_value = 'mitaka'
+        self.online_migration_enabled.return_value = True
+        hooks.conditional_neutron_migration()
+        self.start_online_migration.assert_called_with()
+        self.assertFalse(self.migrate_neutron_database.called)
+        self.assertFalse(self.service_restart.called)
+
+    def test_conditional_neutron_migration_leader_online_fresh(self):
+        self.test_relation.set({
+            'allowed_units': 'neutron-api/0 neutron-api/1 neutron-api/4',
+        })
+        self.local_unit.return_value = 'neutron-api/1'
+        self.is_elected_leader.return_value = True
+        self.os_release.return_value = 'mitaka'
+        self.online_migration_enabled.return_value = True
+        self.neutron_db_initialised.return_value = False
+        hooks.conditional_neutron_migration()
+        self.assertFalse(self.start_online_migration.called)
+        self.migrate_neutron_database.assert_called_with()
+        self.record_neutron_db_migration.assert_called_with()
         self.service_restart.assert_called_with('neutron-server')
 
     def test_conditional_neutron_migration_leader_icehouse(self):
@@ -942,8 +1131,31 @@ class NeutronAPIHooksTests(CharmTestCase):
         self.assertFalse(self.migrate_neutron_database.called)
         self.assertFalse(self.service_restart.called)
 
-    def test_etcd_peer_joined(self):
+    def test_neutron_plugin_api_subordinate_relation_changed(self):
+        self._call_hook('neutron-plugin-api-subordinate-relation-changed')
+        self.write_subordinate_configs.assert_called_with(self.CONFIGS)
+        self.assertFalse(self.CONFIGS.write_all.called)
+
+    def test_neutron_plugin_api_subordinate_relation_departed(self):
+        self._call_hook('neutron-plugin-api-subordinate-relation-departed')
+        self.write_subordinate_configs.assert_called_with(self.CONFIGS)
+
+    @patch.object(hooks, 'file_hash')
+    def test_etcd_peer_joined(self, file_hash):
+        file_hash.return_value = 'same'
         self._call_hook('etcd-proxy-relation-joined')
         self.assertTrue(self.CONFIGS.register.called)
         self.CONFIGS.write.assert_any_call('/etc/init/etcd.conf')
         self.CONFIGS.write.assert_any_call('/etc/default/etcd')
+
+    @patch.object(hooks, 'EtcdContext')
+    @patch.object(hooks, 'file_hash')
+    def test_etcd_peer_changed(self, file_hash, etcd_context):
+        file_hash.side_effect = ['a', 'a', 'b', 'c']
+        etcd_context.return_value.return_value = {'cluster': 'etcd0=x'}
+        self.CONFIGS.complete_contexts.return_value = ['etcd-proxy']
+        self._call_hook('etcd-proxy-relation-changed')
+        self.update_etcd.assert_called_with('etcd0=x', restart=True)
+        file_hash.side_effect = ['a', 'a', 'b', 'b']
+        self._call_hook('etcd-proxy-relation-changed')
+        self.update_etcd.assert_called_with('etcd0=x', restart=False)
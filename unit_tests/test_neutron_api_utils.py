@@ -12,9 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import glob
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+
 from mock import MagicMock, patch, call
 from collections import OrderedDict
 from copy import deepcopy
+from subprocess import CalledProcessError
 
 import charmhelpers.contrib.openstack.templating as templating
 import charmhelpers.contrib.openstack.utils
@@ -29,6 +37,7 @@ with patch('charmhelpers.core.hookenv.config') as config:
 
 from test_utils import (
     CharmTestCase,
+    load_config,
     patch_open,
 )
 
@@ -43,6 +52,8 @@ TO_PATCH = [
     'configure_installation_source',
     'get_os_codename_install_source',
     'git_pip_venv_dir',
+    'git_restart_done',
+    'git_restart_pending',
     'git_src_dir',
     'log',
     'lsb_release',
@@ -110,6 +121,7 @@ class TestNeutronAPIUtils(CharmTestCase):
         self.config.side_effect = self.test_config.get
         self.test_config.set('region', 'region101')
         self.neutron_plugin_attribute.side_effect = _mock_npa
+        self.git_restart_pending.return_value = []
 
     def tearDown(self):
         # Reset cached cache
@@ -160,6 +172,21 @@ class TestNeutronAPIUtils(CharmTestCase):
         expect.extend(['neutron-server'])
         self.assertItemsEqual(pkg_list, expect)
 
+    @patch.object(nutils, 'git_install_requested')
+    def test_determine_packages_git_venv_leader(self, git_requested):
+        git_requested.return_value = True
+        self.test_config.set('git-venv-source', 'leader')
+        self.is_elected_leader.return_value = False
+        self.get_os_codename_install_source.return_value = 'kilo'
+        pkg_list = nutils.determine_packages()
+        self.assertIn('python-neutronclient', pkg_list)
+        for p in nutils.GIT_BUILD_PACKAGES:
+            self.assertNotIn(p, pkg_list)
+        self.is_elected_leader.return_value = True
+        pkg_list = nutils.determine_packages()
+        for p in nutils.GIT_BUILD_PACKAGES:
+            self.assertIn(p, pkg_list)
+
     def test_determine_ports(self):
         port_list = nutils.determine_ports()
         self.assertItemsEqual(port_list, [9696])
@@ -276,12 +303,13 @@ class TestNeutronAPIUtils(CharmTestCase):
 
     @patch.object(charmhelpers.contrib.openstack.utils,
                   'get_os_codename_install_source')
+    @patch.object(nutils, 'record_neutron_db_migration')
     @patch.object(nutils, 'migrate_neutron_database')
     @patch.object(nutils, 'stamp_neutron_database')
     @patch.object(nutils, 'git_install_requested')
     def test_do_openstack_upgrade(self, git_requested,
                                   stamp_neutron_db, migrate_neutron_db,
-                                  gsrc):
+                                  record_migration, gsrc):
         git_requested.return_value = False
         self.is_elected_leader.return_value = True
         self.os_release.return_value = 'icehouse'
@@ -312,15 +340,17 @@ class TestNeutronAPIUtils(CharmTestCase):
         configs.set_release.assert_called_with(openstack_release='juno')
         stamp_neutron_db.assert_called_with('icehouse')
         migrate_neutron_db.assert_called_with()
+        record_migration.assert_called_with()
 
     @patch.object(charmhelpers.contrib.openstack.utils,
                   'get_os_codename_install_source')
+    @patch.object(nutils, 'record_neutron_db_migration')
     @patch.object(nutils, 'migrate_neutron_database')
     @patch.object(nutils, 'stamp_neutron_database')
     @patch.object(nutils, 'git_install_requested')
     def test_do_openstack_upgrade_liberty(self, git_requested,
                                           stamp_neutron_db, migrate_neutron_db,
-                                          gsrc):
+                                          record_migration, gsrc):
         git_requested.return_value = False
         self.is_elected_leader.return_value = True
         self.os_release.return_value = 'liberty'
@@ -488,27 +518,163 @@ class TestNeutronAPIUtils(CharmTestCase):
         get_neutron_client.return_value = dummy_client
         self.assertEquals(nutils.neutron_ready(), False)
 
+    @patch.object(nutils, 'filter_installed_packages')
     @patch.object(nutils, 'git_install_requested')
     @patch.object(nutils, 'git_clone_and_install')
     @patch.object(nutils, 'git_post_install')
     @patch.object(nutils, 'git_pre_install')
     def test_git_install(self, git_pre, git_post, git_clone_and_install,
-                         git_requested):
+                         git_requested, filter_installed_packages):
         projects_yaml = openstack_origin_git
         git_requested.return_value = True
+        filter_installed_packages.return_value = []
         nutils.git_install(projects_yaml)
         self.assertTrue(git_pre.called)
+        self.assertFalse(self.apt_install.called)
         git_clone_and_install.assert_called_with(openstack_origin_git,
                                                  core_project='neutron')
-        self.assertTrue(git_post.called)
+        self.pip_install.assert_called_with(
+            'mysql-python', venv=self.git_pip_venv_dir.return_value)
+        git_post.assert_called_with(openstack_origin_git,
+                                    git_clone_and_install.return_value)
+
+    @patch.object(nutils, 'git_publish_venv')
+    @patch.object(nutils, 'filter_installed_packages')
+    @patch.object(nutils, 'git_install_requested')
+    @patch.object(nutils, 'git_clone_and_install')
+    @patch.object(nutils, 'git_post_install')
+    @patch.object(nutils, 'git_pre_install')
+    def test_git_install_venv_leader(self, git_pre, git_post,
+                                     git_clone_and_install, git_requested,
+                                     filter_installed_packages,
+                                     git_publish_venv):
+        git_requested.return_value = True
+        filter_installed_packages.return_value = ['python-dev']
+        git_clone_and_install.return_value = ['neutron']
+        self.test_config.set('git-venv-source', 'leader')
+        self.is_elected_leader.return_value = True
+        nutils.git_install(openstack_origin_git)
+        self.apt_install.assert_called_with(['python-dev'], fatal=True)
+        git_post.assert_called_with(openstack_origin_git, ['neutron'])
+        git_publish_venv.assert_called_with(openstack_origin_git,
+                                            ['neutron'])
 
+    @patch.object(nutils, 'git_fetch_venv')
+    @patch.object(nutils, 'git_install_requested')
+    @patch.object(nutils, 'git_clone_and_install')
+    @patch.object(nutils, 'git_post_install')
+    @patch.object(nutils, 'git_pre_install')
+    def test_git_install_venv_peer(self, git_pre, git_post,
+                                   git_clone_and_install, git_requested,
+                                   git_fetch_venv):
+        git_requested.return_value = True
+        self.test_config.set('git-venv-source', 'leader')
+        self.is_elected_leader.return_value = False
+        git_fetch_venv.return_value = None
+        nutils.git_install(openstack_origin_git)
+        self.assertFalse(git_post.called)
+        git_fetch_venv.return_value = ['neutron']
+        nutils.git_install(openstack_origin_git)
+        self.assertFalse(git_clone_and_install.called)
+        self.assertFalse(self.pip_install.called)
+        git_post.assert_called_with(openstack_origin_git, ['neutron'])
+
+    def _venv_artifact_dir(self):
+        artifact_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, artifact_dir)
+        patcher = patch.object(nutils, 'GIT_VENV_ARTIFACT_DIR', artifact_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        kv = MagicMock()
+        kv.get.return_value = None
+        patcher = patch.object(nutils.unitdata, 'kv', return_value=kv)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return artifact_dir, kv
+
+    @patch.object(nutils, 'git_unpack_venv')
+    @patch.object(nutils, 'check_hash')
+    @patch.object(nutils, 'ArchiveUrlFetchHandler')
+    @patch.object(nutils, 'leader_get')
+    def test_git_fetch_venv(self, leader_get, fetch_handler, check_hash,
+                            git_unpack_venv):
+        artifact_dir, kv = self._venv_artifact_dir()
+        self.test_config.set('git-venv-source', 'leader')
+        checksum = 'a' * 64
+        url = 'http://10.0.0.1/neutron-api/neutron-venv-aaaa.tar.gz'
+        leader_get.side_effect = {
+            nutils.GIT_VENV_URL_KEY: url,
+            nutils.GIT_VENV_SHA256_KEY: checksum,
+        }.get
+        tarball = nutils.git_venv_artifact(checksum)
+
+        def download(source, dest):
+            with open(dest, 'w') as f:
+                f.write('venv')
+        fetch_handler.return_value.download.side_effect = download
+        self.assertEqual(nutils.git_fetch_venv(openstack_origin_git),
+                         ['neutron'])
+        fetch_handler.return_value.download.assert_called_with(
+            url, '{}.part'.format(tarball))
+        check_hash.assert_called_with('{}.part'.format(tarball), checksum,
+                                      hash_type='sha256')
+        git_unpack_venv.assert_called_with(openstack_origin_git, tarball)
+        kv.set.assert_called_with(nutils.GIT_VENV_KEY, checksum)
+        self.assertEqual(os.listdir(artifact_dir),
+                         [os.path.basename(tarball)])
+
+        kv.get.return_value = checksum
+        git_unpack_venv.reset_mock()
+        with patch('os.path.exists') as exists:
+            exists.return_value = True
+            self.assertEqual(nutils.git_fetch_venv(openstack_origin_git), [])
+        self.assertFalse(git_unpack_venv.called)
+
+    @patch.object(nutils, 'leader_get')
+    def test_git_fetch_venv_unpublished(self, leader_get):
+        self.test_config.set('git-venv-source', 'leader')
+        leader_get.return_value = None
+        self.assertEqual(nutils.git_fetch_venv(openstack_origin_git), None)
+
+    @patch.object(nutils, 'unit_private_ip')
+    @patch.object(nutils, 'git_pack_venv')
+    @patch.object(nutils, 'leader_set')
+    @patch.object(nutils, 'leader_get')
+    def test_git_publish_venv(self, leader_get, leader_set, git_pack_venv,
+                              unit_private_ip):
+        artifact_dir, kv = self._venv_artifact_dir()
+        leader_get.return_value = None
+        unit_private_ip.return_value = '10.0.0.1'
+
+        def pack(projects_yaml, tarball, core_project):
+            with open(tarball, 'w') as f:
+                f.write('venv')
+        git_pack_venv.side_effect = pack
+        nutils.git_publish_venv(openstack_origin_git, ['neutron'])
+        checksum = hashlib.sha256('venv').hexdigest()
+        tarball = nutils.git_venv_artifact(checksum)
+        self.assertTrue(os.path.exists(tarball))
+        kv.set.assert_called_with(nutils.GIT_VENV_KEY, checksum)
+        leader_set.assert_called_with({
+            nutils.GIT_VENV_URL_KEY: 'http://10.0.0.1/neutron-api/{}'.format(
+                os.path.basename(tarball)),
+            nutils.GIT_VENV_SHA256_KEY: checksum,
+        })
+
+        kv.get.return_value = checksum
+        git_pack_venv.reset_mock()
+        nutils.git_publish_venv(openstack_origin_git, [])
+        self.assertFalse(git_pack_venv.called)
+
+    @patch('os.path.exists')
     @patch.object(nutils, 'mkdir')
     @patch.object(nutils, 'write_file')
     @patch.object(nutils, 'add_user_to_group')
     @patch.object(nutils, 'add_group')
     @patch.object(nutils, 'adduser')
     def test_git_pre_install(self, adduser, add_group, add_user_to_group,
-                             write_file, mkdir):
+                             write_file, mkdir, exists):
+        exists.return_value = False
         nutils.git_pre_install()
         adduser.assert_called_with('neutron', shell='/bin/bash',
                                    system_user=True)
@@ -529,25 +695,42 @@ class TestNeutronAPIUtils(CharmTestCase):
         ]
         self.assertEquals(write_file.call_args_list, expected)
 
+    @patch('os.path.exists')
+    @patch.object(nutils, 'mkdir')
+    @patch.object(nutils, 'write_file')
+    @patch.object(nutils, 'add_user_to_group')
+    @patch.object(nutils, 'add_group')
+    @patch.object(nutils, 'adduser')
+    def test_git_pre_install_keeps_log(self, adduser, add_group,
+                                       add_user_to_group, write_file, mkdir,
+                                       exists):
+        exists.return_value = True
+        nutils.git_pre_install()
+        self.assertFalse(write_file.called)
+
     @patch('os.path.join')
     @patch('os.path.exists')
     @patch('os.symlink')
-    @patch('shutil.copytree')
-    @patch('shutil.rmtree')
+    @patch.object(nutils, 'sync_tree')
     @patch('subprocess.check_call')
-    def test_git_post_install_upstart(self, check_call, rmtree, copytree,
+    def test_git_post_install_upstart(self, check_call, sync_tree,
                                       symlink, exists, join):
         projects_yaml = openstack_origin_git
         join.return_value = 'joined-string'
+        sync_tree.return_value = []
         self.git_pip_venv_dir.return_value = '/mnt/openstack-git/venv'
         self.lsb_release.return_value = {'DISTRIB_RELEASE': '15.04'}
         nutils.git_post_install(projects_yaml)
+        rendered = nutils.resource_map().keys()
         expected = [
-            call('joined-string', '/etc/neutron'),
-            call('joined-string', '/etc/neutron/plugins'),
-            call('joined-string', '/etc/neutron/rootwrap.d'),
+            call('joined-string', '/etc/neutron', delete=False,
+                 keep=rendered),
+            call('joined-string', '/etc/neutron/plugins', delete=True,
+                 keep=rendered),
+            call('joined-string', '/etc/neutron/rootwrap.d', delete=True,
+                 keep=rendered),
         ]
-        copytree.assert_has_calls(expected)
+        sync_tree.assert_has_calls(expected)
         expected = [
             call('joined-string', '/usr/local/bin/neutron-rootwrap'),
             call('joined-string', '/usr/local/bin/neutron-db-manage'),
@@ -561,10 +744,10 @@ class TestNeutronAPIUtils(CharmTestCase):
         }
         expected = [
             call('git/neutron_sudoers', '/etc/sudoers.d/neutron_sudoers', {},
-                 perms=0o440),
+                 perms=0o440, skip_unchanged=True),
             call('git/upstart/neutron-server.upstart',
                  '/etc/init/neutron-server.conf',
-                 neutron_api_context, perms=0o644),
+                 neutron_api_context, perms=0o644, skip_unchanged=True),
         ]
         self.assertEquals(self.render.call_args_list, expected)
         expected = [
@@ -576,24 +759,155 @@ class TestNeutronAPIUtils(CharmTestCase):
     @patch('os.path.join')
     @patch('os.path.exists')
     @patch('os.symlink')
-    @patch('shutil.copytree')
-    @patch('shutil.rmtree')
+    @patch.object(nutils, 'sync_tree')
     @patch('subprocess.check_call')
-    def test_git_post_install_systemd(self, check_call, rmtree, copytree,
+    def test_git_post_install_systemd(self, check_call, sync_tree,
                                       symlink, exists, join, listdir):
         projects_yaml = openstack_origin_git
         join.return_value = 'joined-string'
+        sync_tree.return_value = []
         self.git_pip_venv_dir.return_value = '/mnt/openstack-git/venv'
         self.lsb_release.return_value = {'DISTRIB_RELEASE': '15.10'}
         nutils.git_post_install(projects_yaml)
         expected = [
             call('git/neutron_sudoers', '/etc/sudoers.d/neutron_sudoers',
-                 {}, perms=288),
+                 {}, perms=288, skip_unchanged=True),
             call('git/neutron-server.init.in.template', 'joined-string',
-                 {'daemon_path': 'joined-string'}, perms=420)
+                 {'daemon_path': 'joined-string'}, perms=420,
+                 skip_unchanged=True)
         ]
         self.assertEquals(self.render.call_args_list, expected)
 
+    @patch('os.path.join')
+    @patch('os.path.exists')
+    @patch('os.symlink')
+    @patch.object(nutils, 'pip_install')
+    @patch.object(nutils, 'sync_tree')
+    def test_git_post_install_unchanged(self, sync_tree, pip_install,
+                                        symlink, exists, join):
+        join.return_value = 'joined-string'
+        sync_tree.return_value = []
+        self.lsb_release.return_value = {'DISTRIB_RELEASE': '15.04'}
+        nutils.git_post_install(openstack_origin_git, [])
+        self.assertFalse(pip_install.called)
+        self.assertFalse(self.service_restart.called)
+        self.assertFalse(self.git_restart_done.called)
+
+    @patch('os.path.join')
+    @patch('os.path.exists')
+    @patch('os.symlink')
+    @patch.object(nutils, 'sync_tree')
+    def test_git_post_install_restart_pending(self, sync_tree, symlink,
+                                              exists, join):
+        join.return_value = 'joined-string'
+        sync_tree.return_value = []
+        self.lsb_release.return_value = {'DISTRIB_RELEASE': '15.04'}
+        self.git_restart_pending.return_value = ['neutron']
+        nutils.git_post_install(openstack_origin_git, [])
+        self.service_restart.assert_called_with('neutron-server')
+        self.git_restart_done.assert_called_with()
+
+    @patch('os.path.join')
+    @patch('os.path.exists')
+    @patch('os.symlink')
+    @patch.object(nutils, 'sync_tree')
+    def test_git_post_install_restart_fails(self, sync_tree, symlink,
+                                            exists, join):
+        join.return_value = 'joined-string'
+        sync_tree.return_value = []
+        self.lsb_release.return_value = {'DISTRIB_RELEASE': '15.04'}
+        self.service_restart.side_effect = CalledProcessError(1, 'restart')
+        self.assertRaises(CalledProcessError, nutils.git_post_install,
+                          openstack_origin_git, ['neutron'])
+        self.assertFalse(self.git_restart_done.called)
+
+    @patch('os.path.join')
+    @patch('os.path.exists')
+    @patch('os.symlink')
+    @patch.object(nutils, 'pip_install')
+    @patch.object(nutils, 'sync_tree')
+    def test_git_post_install_config_changed(self, sync_tree, pip_install,
+                                             symlink, exists, join):
+        join.return_value = 'joined-string'
+        sync_tree.side_effect = [['/etc/neutron/policy.json'], [], []]
+        self.lsb_release.return_value = {'DISTRIB_RELEASE': '15.04'}
+        nutils.git_post_install(openstack_origin_git, [])
+        self.assertFalse(pip_install.called)
+        self.service_restart.assert_called_with('neutron-server')
+
+    def test_sync_tree(self):
+        src = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src)
+        dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest)
+        os.makedirs(os.path.join(src, 'plugins'))
+        for path, content in [('neutron.conf', 'new'),
+                              ('policy.json', 'same'),
+                              ('plugins/ml2.ini', 'ml2')]:
+            with open(os.path.join(src, path), 'w') as f:
+                f.write(content)
+        for path, content in [('neutron.conf', 'old'),
+                              ('policy.json', 'same'),
+                              ('local.conf', 'local')]:
+            with open(os.path.join(dest, path), 'w') as f:
+                f.write(content)
+        self.assertEqual(sorted(nutils.sync_tree(src, dest)),
+                         [os.path.join(dest, 'neutron.conf'),
+                          os.path.join(dest, 'plugins/ml2.ini')])
+        with open(os.path.join(dest, 'neutron.conf')) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertTrue(os.path.exists(os.path.join(dest, 'local.conf')))
+        self.assertEqual(nutils.sync_tree(src, dest), [])
+
+    def test_sync_tree_delete(self):
+        src = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src)
+        dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest)
+        os.makedirs(os.path.join(src, 'ml2'))
+        with open(os.path.join(src, 'ml2/ml2_conf_sriov.ini'), 'w') as f:
+            f.write('sriov')
+        for path in ['ml2/ml2_conf.ini', 'ml2/ml2_conf_old.ini',
+                     'cisco/cisco_plugins.ini', 'cisco/n1kv/n1kv.ini']:
+            if not os.path.isdir(os.path.dirname(os.path.join(dest, path))):
+                os.makedirs(os.path.dirname(os.path.join(dest, path)))
+            with open(os.path.join(dest, path), 'w') as f:
+                f.write('old')
+        rendered = [os.path.join(dest, 'ml2/ml2_conf.ini')]
+        self.assertEqual(
+            sorted(nutils.sync_tree(src, dest, delete=True, keep=rendered)),
+            [os.path.join(dest, 'cisco/cisco_plugins.ini'),
+             os.path.join(dest, 'cisco/n1kv/n1kv.ini'),
+             os.path.join(dest, 'ml2/ml2_conf_old.ini'),
+             os.path.join(dest, 'ml2/ml2_conf_sriov.ini')])
+        self.assertEqual(sorted(os.listdir(dest)), ['ml2'])
+        self.assertEqual(sorted(os.listdir(os.path.join(dest, 'ml2'))),
+                         ['ml2_conf.ini', 'ml2_conf_sriov.ini'])
+        self.assertEqual(
+            nutils.sync_tree(src, dest, delete=True, keep=rendered), [])
+
+    def test_sync_tree_keeps_rendered(self):
+        src = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src)
+        dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest)
+        os.makedirs(os.path.join(src, 'ml2'))
+        os.makedirs(os.path.join(dest, 'ml2'))
+        with open(os.path.join(src, 'ml2/ml2_conf.ini'), 'w') as f:
+            f.write('stock')
+        with open(os.path.join(src, 'ml2/ml2_conf_sriov.ini'), 'w') as f:
+            f.write('sriov')
+        rendered = os.path.join(dest, 'ml2/ml2_conf.ini')
+        with open(rendered, 'w') as f:
+            f.write('rendered')
+        for delete in (False, True):
+            self.assertEqual(
+                nutils.sync_tree(src, dest, delete=delete, keep=[rendered]),
+                [] if delete else
+                [os.path.join(dest, 'ml2/ml2_conf_sriov.ini')])
+            with open(rendered) as f:
+                self.assertEqual(f.read(), 'rendered')
+
     def test_stamp_neutron_database(self):
         nutils.stamp_neutron_database('icehouse')
         cmd = ['neutron-db-manage',
@@ -612,6 +926,371 @@ class TestNeutronAPIUtils(CharmTestCase):
                'head']
         self.subprocess.check_output.assert_called_with(cmd)
 
+    def test_migrate_neutron_database_phase(self):
+        nutils.migrate_neutron_database('expand')
+        cmd = ['neutron-db-manage',
+               '--config-file', '/etc/neutron/neutron.conf',
+               '--config-file', '/etc/neutron/plugins/ml2/ml2_conf.ini',
+               'upgrade',
+               '--expand']
+        self.subprocess.check_output.assert_called_with(cmd)
+
+    def _alembic_tree(self, extra=None):
+        site = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, site)
+        scripts = {
+            'neutron/db/migration/alembic_migrations/versions/a.py':
+                "revision = 'aaa'\ndown_revision = None\n",
+            'neutron/db/migration/alembic_migrations/versions/mitaka/'
+            'expand/b.py':
+                "revision = 'bbb'\ndown_revision = 'aaa'\n",
+            'neutron/db/migration/alembic_migrations/versions/mitaka/'
+            'contract/c.py':
+                "revision = 'ccc'\ndown_revision = 'aaa'\n",
+            'neutron_lbaas/db/migration/alembic_migrations/versions/d.py':
+                "revision = 'ddd'\ndown_revision = ('x', \"y\")\n",
+        }
+        scripts.update(extra or {})
+        for path, script in scripts.items():
+            path = os.path.join(site, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(script)
+        return site
+
+    @patch.object(nutils, 'git_install_requested')
+    def test_alembic_heads(self, git_requested):
+        git_requested.return_value = False
+        self.glob.glob.side_effect = glob.glob
+        with patch.object(nutils, 'SITE_PACKAGES', self._alembic_tree()):
+            self.assertEqual(nutils.alembic_heads(),
+                             ['neutron:bbb', 'neutron:ccc',
+                              'neutron_lbaas:ddd'])
+
+    @patch.object(nutils, 'git_install_requested')
+    def test_alembic_heads_merge(self, git_requested):
+        git_requested.return_value = False
+        self.glob.glob.side_effect = glob.glob
+        versions = 'neutron/db/migration/alembic_migrations/versions/'
+        site = self._alembic_tree({
+            versions + 'newton/expand/e.py':
+                '"""merge\n\nrevision = \'zzz\'\n"""\n'
+                'from alembic import op\n\n'
+                '# revision identifiers, used by Alembic.\n'
+                'revision = \'eee\'\n'
+                'down_revision = (\n'
+                '    \'bbb\',\n'
+                '    \'ccc\',\n'
+                ')\n',
+            versions + 'broken.py': 'revision = (\n',
+            versions + 'README': "revision = 'fff'\n",
+        })
+        with patch.object(nutils, 'SITE_PACKAGES', site):
+            self.assertEqual(nutils.alembic_heads(),
+                             ['neutron:eee', 'neutron_lbaas:ddd'])
+
+    def test_alembic_revision(self):
+        self.assertEqual(
+            nutils._alembic_revision("revision = 'b'\ndown_revision = 'a'"),
+            ('b', set(['a'])))
+        self.assertEqual(
+            nutils._alembic_revision("revision = 'c'\n"
+                                     "down_revision = ('a', 'b')"),
+            ('c', set(['a', 'b'])))
+        self.assertEqual(
+            nutils._alembic_revision("revision = 'a'\ndown_revision = None"),
+            ('a', set()))
+        self.assertEqual(nutils._alembic_revision("down_revision = 'a'"),
+                         None)
+        self.assertEqual(nutils._alembic_revision("revision = ("), None)
+
+    def _shared_db(self):
+        self.patch('relation_ids').side_effect = \
+            lambda rel_name: {'shared-db': ['shared-db:1']}.get(rel_name, [])
+        self.patch('related_units').return_value = ['mysql/0']
+        self.patch('relation_get').return_value = {'db_host': '10.0.0.1',
+                                                   'password': 'secret'}
+        self.test_config.set('database', 'neutron')
+        self.test_config.set('database-user', 'neutron')
+
+    @patch.object(nutils, 'db_alembic_versions')
+    @patch.object(nutils, 'leader_set')
+    @patch.object(nutils, 'leader_get')
+    @patch.object(nutils, 'alembic_heads')
+    def test_neutron_db_migrated(self, heads, leader_get, leader_set,
+                                 db_versions):
+        self._shared_db()
+        settings = {}
+        leader_get.side_effect = settings.get
+        leader_set.side_effect = settings.update
+        heads.return_value = ['neutron:bbb', 'neutron:ccc']
+        db_versions.return_value = ['bbb', 'ccc']
+        self.assertFalse(nutils.neutron_db_migrated())
+        self.assertFalse(db_versions.called)
+        nutils.record_neutron_db_migration()
+        self.assertTrue(nutils.neutron_db_migrated())
+        heads.return_value = ['neutron:bbb', 'neutron:eee']
+        self.assertFalse(nutils.neutron_db_migrated())
+        heads.return_value = []
+        self.assertFalse(nutils.neutron_db_migrated())
+
+    @patch.object(nutils, 'db_alembic_versions')
+    @patch.object(nutils, 'leader_set')
+    @patch.object(nutils, 'leader_get')
+    @patch.object(nutils, 'alembic_heads')
+    def test_neutron_db_migrated_restored(self, heads, leader_get, leader_set,
+                                          db_versions):
+        self._shared_db()
+        settings = {}
+        leader_get.side_effect = settings.get
+        leader_set.side_effect = settings.update
+        heads.return_value = ['neutron:bbb', 'neutron:ccc']
+        nutils.record_neutron_db_migration()
+        db_versions.return_value = ['aaa']
+        self.assertFalse(nutils.neutron_db_migrated())
+        db_versions.return_value = []
+        self.assertFalse(nutils.neutron_db_migrated())
+        db_versions.return_value = None
+        self.assertFalse(nutils.neutron_db_migrated())
+
+    def _mysqldb(self, tables):
+        driver = MagicMock()
+        driver.Error = Exception
+        cursor = driver.connect.return_value.cursor.return_value
+        results = []
+
+        def execute(query, params=None):
+            if 'information_schema' in query:
+                results[:] = [(table,) for table in sorted(tables)]
+            else:
+                results[:] = [(v,) for v in tables[query.split()[-1]]]
+
+        cursor.execute.side_effect = execute
+        cursor.fetchall.side_effect = lambda: list(results)
+        patcher = patch.dict(sys.modules, {'MySQLdb': driver})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return driver
+
+    def test_db_alembic_versions(self):
+        self._shared_db()
+        driver = self._mysqldb({'alembic_version': ['ccc', 'bbb'],
+                                'alembic_version_lbaas': ['ddd']})
+        self.assertEqual(nutils.db_alembic_versions(), ['bbb', 'ccc', 'ddd'])
+        driver.connect.assert_called_with(host='10.0.0.1', user='neutron',
+                                          passwd='secret', db='neutron')
+        self.assertTrue(driver.connect.return_value.close.called)
+
+    def test_db_alembic_versions_fresh(self):
+        self._shared_db()
+        self._mysqldb({})
+        self.assertEqual(nutils.db_alembic_versions(), [])
+
+    def test_db_alembic_versions_unavailable(self):
+        self._shared_db()
+        driver = self._mysqldb({})
+        driver.connect.side_effect = Exception('refused')
+        self.assertEqual(nutils.db_alembic_versions(), None)
+        nutils.relation_ids.side_effect = None
+        nutils.relation_ids.return_value = []
+        self.assertEqual(nutils.db_alembic_versions(), None)
+
+    def test_online_migration_enabled(self):
+        self.os_release.return_value = 'mitaka'
+        self.assertFalse(nutils.online_migration_enabled())
+        self.test_config.set('database-migration-mode', 'online')
+        self.assertTrue(nutils.online_migration_enabled())
+        self.os_release.return_value = 'kilo'
+        self.assertFalse(nutils.online_migration_enabled())
+
+    def _online_migration(self, leader_settings, acks, peers):
+        self.test_config.set('database-migration-mode', 'online')
+        self.os_release.return_value = 'mitaka'
+        self.local_unit = self.patch('local_unit')
+        self.local_unit.return_value = 'neutron-api/0'
+        leader_get = self.patch('leader_get')
+        leader_get.side_effect = leader_settings.get
+        leader_set = self.patch('leader_set')
+        leader_set.side_effect = leader_settings.update
+        self.patch('relation_ids').return_value = ['cluster:1']
+        self.patch('related_units').return_value = peers
+        self.patch('relation_get').side_effect = \
+            lambda attribute, rid, unit: acks.get(unit)
+        self.relation_set = self.patch('relation_set')
+        self.status_set = self.patch('status_set')
+        self.patch('is_unit_paused_set').return_value = False
+        self.kv = {}
+        kv = self._kv(None)
+        kv.get.side_effect = self.kv.get
+        kv.set.side_effect = self.kv.__setitem__
+
+    def test_start_online_migration(self):
+        settings = {}
+        self._online_migration(settings, {}, ['neutron-api/1',
+                                              'neutron-api/2'])
+        self.assertTrue(nutils.start_online_migration())
+        self.assertEqual(
+            self.subprocess.check_output.call_args[0][0][-2:],
+            ['upgrade', '--expand'])
+        self.service_restart.assert_called_once_with('neutron-server')
+        self.relation_set.assert_called_with(
+            relation_id='cluster:1',
+            relation_settings={'db-migration-restarted': 'mitaka'})
+        self.assertEqual(settings, {'db-migration-expanded': 'mitaka',
+                                    'db-migration-restart': 'neutron-api/1'})
+        self.status_set.assert_called_with(
+            'maintenance', 'Rolling restart for mitaka database migration: '
+            '1 of 3 units restarted')
+
+    def test_start_online_migration_done(self):
+        self._online_migration({'db-migration': 'mitaka'}, {}, [])
+        self.assertFalse(nutils.start_online_migration())
+        self.assertFalse(self.subprocess.check_output.called)
+
+    def test_progress_online_migration_next_unit(self):
+        settings = {'db-migration-expanded': 'mitaka',
+                    'db-migration-restart': 'neutron-api/1'}
+        self._online_migration(settings, {'neutron-api/0': 'mitaka',
+                                          'neutron-api/1': 'mitaka'},
+                               ['neutron-api/1', 'neutron-api/2'])
+        self.kv['db-migration-restarted'] = 'mitaka'
+        nutils.progress_online_migration()
+        self.assertEqual(settings['db-migration-restart'], 'neutron-api/2')
+        self.assertFalse(self.service_restart.called)
+        self.assertFalse(self.subprocess.check_output.called)
+
+    def test_progress_online_migration_contract(self):
+        settings = {'db-migration-expanded': 'mitaka',
+                    'db-migration-restart': 'neutron-api/1'}
+        self._online_migration(settings, {'neutron-api/0': 'mitaka',
+                                          'neutron-api/1': 'mitaka'},
+                               ['neutron-api/1'])
+        self.kv['db-migration-restarted'] = 'mitaka'
+        nutils.progress_online_migration()
+        self.assertFalse(self.service_restart.called)
+        self.assertEqual(
+            self.subprocess.check_output.call_args[0][0][-2:],
+            ['upgrade', '--contract'])
+        self.assertEqual(settings, {'db-migration': 'mitaka',
+                                    'db-migration-expanded': 'mitaka',
+                                    'db-migration-restart': None})
+        self.assertEqual(nutils.db_migration_pending(), None)
+
+    def test_progress_online_migration_not_upgraded(self):
+        settings = {'db-migration-expanded': 'mitaka',
+                    'db-migration-restart': 'neutron-api/1'}
+        self._online_migration(settings, {'neutron-api/0': 'mitaka',
+                                          'neutron-api/1': 'liberty'},
+                               ['neutron-api/1'])
+        self.kv['db-migration-restarted'] = 'mitaka'
+        nutils.progress_online_migration()
+        self.assertEqual(settings['db-migration-restart'], 'neutron-api/1')
+        self.assertFalse(self.subprocess.check_output.called)
+        self.assertFalse(self.service_restart.called)
+
+    def test_restart_for_online_migration(self):
+        settings = {'db-migration-expanded': 'mitaka',
+                    'db-migration-restart': 'neutron-api/1'}
+        self._online_migration(settings, {}, [])
+        nutils.restart_for_online_migration()
+        self.assertFalse(self.service_restart.called)
+        self.local_unit.return_value = 'neutron-api/1'
+        nutils.restart_for_online_migration()
+        self.service_restart.assert_called_once_with('neutron-server')
+        self.relation_set.assert_called_with(
+            relation_id='cluster:1',
+            relation_settings={'db-migration-restarted': 'mitaka'})
+        self.assertEqual(self.kv['db-migration-restarted'], 'mitaka')
+        nutils.restart_for_online_migration()
+        self.assertEqual(self.service_restart.call_count, 1)
+
+    @patch.object(charmhelpers.contrib.openstack.utils,
+                  'get_os_codename_install_source')
+    @patch.object(nutils, 'git_install_requested')
+    def test_online_migration_peer_upgraded_after_token(self, git_requested,
+                                                        gsrc):
+        # action-managed-upgrade: the leader is upgraded and expands the
+        # schema, the peer gets the restart token before it is upgraded.
+        git_requested.return_value = False
+        gsrc.return_value = 'mitaka'
+        self.get_os_codename_install_source.return_value = 'mitaka'
+        self.config.side_effect = self.test_config.get
+        settings = {}
+        acks = {}
+        self._online_migration(settings, acks, ['neutron-api/1'])
+        releases = {'neutron-api/0': 'mitaka', 'neutron-api/1': 'liberty'}
+        kvs = {'neutron-api/0': {}, 'neutron-api/1': {}}
+
+        def unit():
+            return self.local_unit.return_value
+
+        self.os_release.side_effect = lambda *args, **kwargs: releases[unit()]
+        nutils.unitdata.kv().get.side_effect = \
+            lambda key, default=None: kvs[unit()].get(key, default)
+        nutils.unitdata.kv().set.side_effect = \
+            lambda key, value: kvs[unit()].__setitem__(key, value)
+        self.relation_set.side_effect = \
+            lambda relation_id, relation_settings: acks.update(
+                {unit(): relation_settings['db-migration-restarted']})
+
+        self.assertTrue(nutils.start_online_migration())
+        self.assertEqual(settings['db-migration-restart'], 'neutron-api/1')
+        # leader-settings-changed on the peer, still on liberty
+        self.local_unit.return_value = 'neutron-api/1'
+        nutils.restart_for_online_migration()
+        self.assertEqual(acks['neutron-api/1'], 'liberty')
+        self.local_unit.return_value = 'neutron-api/0'
+        nutils.progress_online_migration()
+        self.assertEqual(self.subprocess.check_output.call_count, 1)
+        # the peer is upgraded, which does not change leader settings
+        self.local_unit.return_value = 'neutron-api/1'
+        self.is_elected_leader.return_value = False
+        releases['neutron-api/1'] = 'mitaka'
+        nutils.do_openstack_upgrade(MagicMock())
+        self.assertEqual(acks['neutron-api/1'], 'mitaka')
+        self.assertEqual(self.service_restart.call_count, 2)
+        # cluster-relation-changed on the leader
+        self.local_unit.return_value = 'neutron-api/0'
+        nutils.progress_online_migration()
+        self.assertEqual(
+            self.subprocess.check_output.call_args[0][0][-2:],
+            ['upgrade', '--contract'])
+        self.assertEqual(settings['db-migration'], 'mitaka')
+
+    def test_restart_for_online_migration_not_upgraded(self):
+        settings = {'db-migration-expanded': 'mitaka',
+                    'db-migration-restart': 'neutron-api/1'}
+        self._online_migration(settings, {}, [])
+        self.local_unit.return_value = 'neutron-api/1'
+        self.os_release.side_effect = \
+            lambda package: 'liberty' if package == 'neutron-server' \
+            else 'mitaka'
+        nutils.restart_for_online_migration()
+        self.assertFalse(self.service_restart.called)
+        self.relation_set.assert_called_with(
+            relation_id='cluster:1',
+            relation_settings={'db-migration-restarted': 'liberty'})
+        self.assertEqual(self.kv, {})
+
+    @patch.object(nutils, 'db_alembic_versions')
+    @patch.object(nutils, 'leader_get')
+    def test_neutron_db_initialised(self, leader_get, db_versions):
+        db_versions.return_value = ['aaa']
+        self.assertTrue(nutils.neutron_db_initialised())
+        db_versions.return_value = []
+        leader_get.return_value = 'mitaka'
+        self.assertFalse(nutils.neutron_db_initialised())
+        db_versions.return_value = None
+        settings = {}
+        leader_get.side_effect = settings.get
+        self.assertFalse(nutils.neutron_db_initialised())
+        settings['db-migration-heads'] = 'abc'
+        self.assertTrue(nutils.neutron_db_initialised())
+        settings.clear()
+        settings['db-migration'] = 'mitaka'
+        self.assertTrue(nutils.neutron_db_initialised())
+
     def test_manage_plugin_true(self):
         self.test_config.set('manage-neutron-plugin-legacy-mode', True)
         manage = nutils.manage_plugin()
@@ -654,6 +1333,172 @@ class TestNeutronAPIUtils(CharmTestCase):
         rmtree.assert_any_call('/var/lib/etcd/two')
         self.service_start.assert_called_once_with('etcd')
 
+    @patch.object(nutils, 'resource_map')
+    @patch.object(nutils, 'file_hash')
+    @patch.object(nutils.neutron_api_context, 'subordinate_digest')
+    def test_write_subordinate_configs(self, subordinate_digest, file_hash,
+                                       resource_map):
+        kv = self._kv(None)
+        configs = MagicMock()
+        resource_map.return_value = {'/etc/neutron/neutron.conf': {}}
+        file_hash.return_value = 'hash1'
+        subordinate_digest.return_value = 'digest1'
+        nutils.write_subordinate_configs(configs)
+        configs.write_all.assert_called_once_with()
+        digest = {'relation': 'digest1',
+                  'configs': {'/etc/neutron/neutron.conf': 'hash1'}}
+        kv.set.assert_called_with(nutils.SUBORDINATE_DIGEST_KEY, digest)
+        kv.flush.assert_called_with()
+        kv.get.return_value = digest
+        configs.reset_mock()
+        nutils.write_subordinate_configs(configs)
+        self.assertFalse(configs.write_all.called)
+
+    @patch.object(nutils, 'resource_map')
+    @patch.object(nutils, 'file_hash')
+    @patch.object(nutils.neutron_api_context, 'subordinate_digest')
+    def test_write_subordinate_configs_written_elsewhere(
+            self, subordinate_digest, file_hash, resource_map):
+        configs = MagicMock()
+        resource_map.return_value = {'/etc/neutron/neutron.conf': {}}
+        subordinate_digest.return_value = 'digest1'
+        self._kv({'relation': 'digest1',
+                  'configs': {'/etc/neutron/neutron.conf': 'hash1'}})
+        file_hash.return_value = 'hash2'
+        nutils.write_subordinate_configs(configs)
+        configs.write_all.assert_called_once_with()
+
+    def _kv(self, value):
+        kv = MagicMock()
+        kv.get.return_value = value
+        patcher = patch.object(nutils.unitdata, 'kv', return_value=kv)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return kv
+
+    @patch.object(nutils, 'is_unit_paused_set')
+    @patch.object(nutils, 'force_etcd_restart')
+    def test_update_etcd_cluster_changed(self, force_etcd_restart,
+                                         is_unit_paused_set):
+        is_unit_paused_set.return_value = False
+        kv = self._kv('etcd0=http://10.0.0.1:2380')
+        nutils.update_etcd('etcd0=http://10.0.0.2:2380')
+        force_etcd_restart.assert_called_once_with()
+        kv.set.assert_called_with(nutils.ETCD_CLUSTER_KEY,
+                                  'etcd0=http://10.0.0.2:2380')
+        self.assertFalse(self.service_restart.called)
+
+    @patch.object(nutils, 'service_running')
+    @patch.object(nutils, 'is_unit_paused_set')
+    @patch.object(nutils, 'force_etcd_restart')
+    def test_update_etcd_cluster_unchanged(self, force_etcd_restart,
+                                           is_unit_paused_set,
+                                           service_running):
+        is_unit_paused_set.return_value = False
+        service_running.return_value = True
+        kv = self._kv('etcd0=http://10.0.0.1:2380')
+        nutils.update_etcd('etcd0=http://10.0.0.1:2380')
+        self.assertFalse(force_etcd_restart.called)
+        self.assertFalse(kv.set.called)
+        self.assertFalse(self.service_restart.called)
+        self.assertFalse(self.service_start.called)
+        nutils.update_etcd('etcd0=http://10.0.0.1:2380', restart=True)
+        self.assertFalse(force_etcd_restart.called)
+        self.service_restart.assert_called_once_with('etcd')
+
+    @patch.object(nutils, 'service_reload')
+    @patch.object(nutils, 'service_running')
+    def test_reload_haproxy(self, service_running, service_reload):
+        service_running.return_value = True
+        nutils.reload_haproxy()
+        self.subprocess.check_output.assert_called_once_with(
+            ['haproxy', '-c', '-q', '-f', '/etc/haproxy/haproxy.cfg'],
+            stderr=self.subprocess.STDOUT)
+        service_reload.assert_called_once_with('haproxy')
+        self.assertFalse(self.service_start.called)
+
+    @patch.object(nutils, 'service_reload')
+    @patch.object(nutils, 'service_running')
+    def test_reload_haproxy_not_running(self, service_running,
+                                        service_reload):
+        service_running.return_value = False
+        nutils.reload_haproxy()
+        self.service_start.assert_called_once_with('haproxy')
+        self.assertFalse(service_reload.called)
+
+    @patch.object(nutils, 'service_reload')
+    @patch.object(nutils, 'service_running')
+    def test_reload_haproxy_invalid_config(self, service_running,
+                                           service_reload):
+        self.subprocess.CalledProcessError = CalledProcessError
+        self.subprocess.check_output.side_effect = CalledProcessError(
+            1, 'haproxy', output='[ALERT] parsing error')
+        nutils.reload_haproxy()
+        self.assertFalse(service_running.called)
+        self.assertFalse(service_reload.called)
+        self.assertFalse(self.service_start.called)
+        self.assertFalse(self.service_stop.called)
+
+    def test_restart_functions(self):
+        self.assertEqual(nutils.restart_functions(),
+                         {'haproxy': nutils.reload_haproxy})
+
+    def test_config_dependencies_complete(self):
+        options = load_config()
+        self.assertEqual(sorted(options), sorted(nutils.CONFIG_DEPENDENCIES))
+
+    @patch.object(nutils, 'config')
+    @patch.object(nutils, 'hook_name')
+    def test_config_changed_targets(self, hook_name, config):
+        hook_name.return_value = 'config-changed'
+        config.return_value.option_types.return_value = load_config()
+        config.return_value.changed_since_applied.return_value = frozenset(
+            ['haproxy-mode', 'quota-port', 'nagios_context', 'charm-key'])
+        self.assertEqual(nutils.config_changed_targets(),
+                         set(['haproxy', 'neutron-server', 'nrpe']))
+
+    @patch.object(nutils, 'config')
+    @patch.object(nutils, 'hook_name')
+    def test_config_changed_targets_nothing_changed(self, hook_name, config):
+        hook_name.return_value = 'config-changed'
+        config.return_value.changed_since_applied.return_value = frozenset()
+        self.assertEqual(nutils.config_changed_targets(), None)
+
+    @patch.object(nutils, 'config')
+    @patch.object(nutils, 'hook_name')
+    def test_config_changed_targets_never_applied(self, hook_name, config):
+        hook_name.return_value = 'config-changed'
+        config.return_value.changed_since_applied.return_value = None
+        self.assertEqual(nutils.config_changed_targets(), None)
+
+    @patch.object(nutils, 'config')
+    @patch.object(nutils, 'hook_name')
+    def test_config_changed_targets_unmapped(self, hook_name, config):
+        hook_name.return_value = 'config-changed'
+        config.return_value.option_types.return_value = {'new-option': 'int'}
+        config.return_value.changed_since_applied.return_value = frozenset(
+            ['new-option'])
+        self.assertEqual(nutils.config_changed_targets(), None)
+
+    @patch.object(nutils, 'hook_name')
+    def test_config_changed_targets_other_hook(self, hook_name):
+        hook_name.return_value = 'upgrade-charm'
+        self.assertEqual(nutils.config_changed_targets(), None)
+
+    def test_config_files_for(self):
+        configs = MagicMock()
+        configs.templates = OrderedDict([
+            (nutils.NEUTRON_CONF, None),
+            (nutils.NEUTRON_DEFAULT, None),
+            (nutils.APACHE_24_CONF, None),
+            (nutils.HAPROXY_CONF, None),
+        ])
+        self.assertEqual(nutils.config_files_for(['haproxy'], configs),
+                         [nutils.HAPROXY_CONF])
+        self.assertEqual(
+            nutils.config_files_for(['neutron-server', 'nrpe'], configs),
+            [nutils.NEUTRON_CONF, nutils.NEUTRON_DEFAULT])
+
     def _test_is_api_ready(self, tgt):
         fake_config = MagicMock()
         with patch.object(nutils, 'incomplete_relation_data') as ird:
@@ -0,0 +1,268 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+from mock import patch
+
+import charmhelpers.fetch
+import charmhelpers.contrib.openstack.utils as os_utils
+from charmhelpers.core import unitdata
+
+# The fetch handlers install their tools with apt when imported.
+with patch.object(charmhelpers.fetch, 'filter_installed_packages',
+                  return_value=[]):
+    import charmhelpers.fetch.bzrurl  # noqa
+    import charmhelpers.fetch.giturl  # noqa
+
+
+def git(*args):
+    subprocess.check_call(('git', '-c', 'user.name=test',
+                           '-c', 'user.email=test@example.com') + args)
+
+
+class GitCloneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.dest = os.path.join(self.tmpdir, 'dest')
+        _m = patch.object(os_utils, 'juju_log')
+        _m.start()
+        self.addCleanup(_m.stop)
+
+    def repository(self, name):
+        path = os.path.join(self.tmpdir, 'src', name)
+        os.makedirs(path)
+        git('init', '-q', path)
+        git('-C', path, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+        with open(os.path.join(path, 'setup.py'), 'w') as f:
+            f.write('# {}\n'.format(name))
+        git('-C', path, 'add', 'setup.py')
+        git('-C', path, 'commit', '-q', '-m', name)
+        return {'name': name, 'repository': 'file://' + path,
+                'branch': 'master'}
+
+    def test_clone_all_keeps_order(self):
+        names = ['requirements', 'oslo', 'neutron', 'neutron-fwaas',
+                 'neutron-lbaas', 'keystone']
+        repositories = [self.repository(name) for name in names]
+        repo_dirs = os_utils._git_clone_all(repositories, self.dest)
+        self.assertEqual(repo_dirs,
+                         [os.path.join(self.dest, name) for name in names])
+        for name, repo_dir in zip(names, repo_dirs):
+            with open(os.path.join(repo_dir, 'setup.py')) as f:
+                self.assertEqual(f.read(), '# {}\n'.format(name))
+            self.assertEqual(os_utils._git_head(repo_dir),
+                             subprocess.check_output(
+                                 ['git', '-C', os.path.join(
+                                     self.tmpdir, 'src', name),
+                                  'rev-parse', 'HEAD']).strip())
+
+    def test_clone_all_propagates_errors(self):
+        repositories = [self.repository('requirements'),
+                        {'name': 'missing', 'branch': 'master',
+                         'repository': 'file://' + os.path.join(
+                             self.tmpdir, 'src', 'missing')},
+                        self.repository('neutron')]
+        self.assertRaises(charmhelpers.fetch.UnhandledSource,
+                          os_utils._git_clone_all, repositories, self.dest)
+
+    def test_clone_all_pulls_existing(self):
+        repository = self.repository('neutron')
+        os_utils._git_clone_all([repository], self.dest)
+        src = repository['repository'][len('file://'):]
+        git('-C', src, 'commit', '-q', '--allow-empty', '-m', 'second')
+        repo_dir, = os_utils._git_clone_all([repository], self.dest)
+        self.assertEqual(os_utils._git_head(repo_dir),
+                         os_utils._git_head(src))
+
+    @patch.object(os_utils, 'pip_install')
+    def test_clone_and_install_single(self, pip_install):
+        repository = self.repository('neutron')
+        repo_dir = os_utils._git_clone_and_install_single(
+            repository['repository'], 'master', '1', self.dest, None,
+            update_requirements=False)
+        self.assertEqual(repo_dir, os.path.join(self.dest, 'neutron'))
+        self.assertTrue(os.path.isfile(os.path.join(repo_dir, 'setup.py')))
+        pip_install.assert_called_with(
+            repo_dir, venv=os.path.join(self.dest, 'venv'),
+            constraints=None)
+
+
+class GitRestartPendingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.kv = unitdata.Storage(os.path.join(self.tmpdir, 'state.db'))
+        self.addCleanup(self.kv.close)
+        _m = patch.object(os_utils.unitdata, 'kv', return_value=self.kv)
+        _m.start()
+        self.addCleanup(_m.stop)
+
+    def test_pending_until_done(self):
+        self.assertEqual(os_utils.git_restart_pending(), [])
+        self.kv.set(os_utils.GIT_RESTART_PENDING_KEY, ['neutron'])
+        self.kv.flush()
+        self.assertEqual(os_utils.git_restart_pending(), ['neutron'])
+        os_utils.git_restart_done()
+        self.kv.flush(False)
+        self.assertEqual(os_utils.git_restart_pending(), [])
+
+    @patch.object(os_utils, '_git_yaml_load')
+    def test_unpack_marks_all_pending(self, _git_yaml_load):
+        _git_yaml_load.return_value = {'repositories': [
+            {'name': 'requirements'}, {'name': 'neutron'}]}
+        self.kv.set(os_utils.GIT_INSTALL_KEY, {'neutron': {}})
+        venv = os.path.join(self.tmpdir, 'venv')
+        os.makedirs(os.path.join(venv, 'bin'))
+        tarball = os.path.join(self.tmpdir, 'venv.tar.gz')
+        with tarfile.open(tarball, 'w:gz') as tar:
+            tar.add(venv, arcname='venv')
+            info = tarfile.TarInfo(os_utils.GIT_VENV_PATH_FILE)
+            info.size = len(venv)
+            tar.addfile(info, io.BytesIO(venv.encode('UTF-8')))
+        with patch.object(os_utils, 'git_pip_venv_dir', return_value=venv):
+            os_utils.git_unpack_venv('projects', tarball)
+        self.assertIsNone(self.kv.get(os_utils.GIT_INSTALL_KEY))
+        self.assertEqual(os_utils.git_restart_pending(),
+                         ['neutron', 'requirements'])
+
+
+class GitVenvPackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.kv = unitdata.Storage(os.path.join(self.tmpdir, 'state.db'))
+        self.addCleanup(self.kv.close)
+        _m = patch.object(os_utils.unitdata, 'kv', return_value=self.kv)
+        _m.start()
+        self.addCleanup(_m.stop)
+        _m = patch.object(os_utils, '_git_yaml_load')
+        _m.start().return_value = {'repositories': [{'name': 'neutron'}]}
+        self.addCleanup(_m.stop)
+        _m = patch.object(os_utils, 'juju_log')
+        _m.start()
+        self.addCleanup(_m.stop)
+        self.tarball = os.path.join(self.tmpdir, 'venv.tar.gz')
+
+    def write(self, path, content):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def pack(self):
+        build = os.path.join(self.tmpdir, 'build')
+        venv = os.path.join(build, 'venv')
+        self.write(os.path.join(venv, 'bin/activate'),
+                   'VIRTUAL_ENV="{}"\n'.format(venv))
+        self.write(os.path.join(venv, 'bin/neutron-server'),
+                   '#!{}/bin/python\n'.format(venv))
+        self.write(os.path.join(venv, 'lib/python2.7/site-packages/x.py'),
+                   'x = 1\n')
+        self.write(os.path.join(build, 'neutron/etc/neutron.conf'),
+                   '[DEFAULT]\n')
+        system = os.path.join(self.tmpdir, 'system/os.py')
+        self.write(system, 'sep = "/"\n')
+        os.symlink('lib', os.path.join(venv, 'lib64'))
+        os.makedirs(os.path.join(venv, 'local'))
+        os.symlink(os.path.join(venv, 'lib'),
+                   os.path.join(venv, 'local/lib'))
+        os.symlink(system, os.path.join(venv, 'lib/python2.7/os.py'))
+        with patch.object(os_utils, 'git_pip_venv_dir', return_value=venv):
+            with patch.object(os_utils, 'git_src_dir',
+                              return_value=os.path.join(build, 'neutron')):
+                os_utils.git_pack_venv('projects', self.tarball, 'neutron')
+
+    def unpack(self):
+        venv = os.path.join(self.tmpdir, 'unit/venv')
+        with patch.object(os_utils, 'git_pip_venv_dir', return_value=venv):
+            os_utils.git_unpack_venv('projects', self.tarball)
+        return venv
+
+    def test_round_trip(self):
+        self.pack()
+        with tarfile.open(self.tarball) as tar:
+            for member in tar.getmembers():
+                if member.issym():
+                    self.assertFalse(os.path.isabs(member.linkname))
+        venv = self.unpack()
+        with open(os.path.join(venv, 'bin/activate')) as f:
+            self.assertEqual(f.read(), 'VIRTUAL_ENV="{}"\n'.format(venv))
+        with open(os.path.join(venv, 'bin/neutron-server')) as f:
+            self.assertEqual(f.read(), '#!{}/bin/python\n'.format(venv))
+        self.assertEqual(os.readlink(os.path.join(venv, 'lib64')), 'lib')
+        self.assertEqual(os.readlink(os.path.join(venv, 'local/lib')),
+                         '../lib')
+        self.assertTrue(os.path.isfile(
+            os.path.join(venv, 'local/lib/python2.7/site-packages/x.py')))
+        os_py = os.path.join(venv, 'lib/python2.7/os.py')
+        self.assertFalse(os.path.islink(os_py))
+        with open(os_py) as f:
+            self.assertEqual(f.read(), 'sep = "/"\n')
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.tmpdir, 'unit/neutron/etc/neutron.conf')))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir, 'unit', os_utils.GIT_VENV_PATH_FILE)))
+
+    def test_unpack_replaces_venv(self):
+        self.pack()
+        venv = self.unpack()
+        self.write(os.path.join(venv, 'stale.py'), '')
+        self.unpack()
+        self.assertFalse(os.path.exists(os.path.join(venv, 'stale.py')))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmpdir,
+                                                        'unit'))),
+                         ['neutron', 'venv'])
+
+    def assertRejected(self, member):
+        with tarfile.open(self.tarball, 'w:gz') as tar:
+            info = tarfile.TarInfo('venv')
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+            tar.addfile(member)
+        self.assertRaises(ValueError, self.unpack)
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'unit')), [])
+
+    def link(self, name, linkname, type=tarfile.SYMTYPE):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.linkname = linkname
+        return info
+
+    def test_rejects_unsafe_path(self):
+        self.assertRejected(tarfile.TarInfo('../evil'))
+
+    def test_rejects_absolute_symlink(self):
+        self.assertRejected(self.link('venv/evil', '/etc/passwd'))
+
+    def test_rejects_escaping_symlink(self):
+        self.assertRejected(self.link('venv/lib/evil', '../../../etc'))
+
+    def test_rejects_absolute_hardlink(self):
+        self.assertRejected(self.link('venv/evil', '/etc/shadow',
+                                      tarfile.LNKTYPE))
+
+    def test_rejects_escaping_hardlink(self):
+        self.assertRejected(self.link('venv/evil', 'venv/../../shadow',
+                                      tarfile.LNKTYPE))
@@ -0,0 +1,162 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from mock import MagicMock, patch
+
+import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.profiling as profiling
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [1000.0]
+        _m = patch.object(profiling.time, 'time', side_effect=self.clock)
+        _m.start()
+        self.addCleanup(_m.stop)
+        self.kv = MagicMock()
+        self.kv.get.return_value = []
+        _m = patch.object(profiling.unitdata, 'kv', return_value=self.kv)
+        _m.start()
+        self.addCleanup(_m.stop)
+        self.addCleanup(profiling.finish, save=False)
+
+    def clock(self):
+        return self.now[0]
+
+    def tick(self, seconds):
+        self.now[0] += seconds
+
+    def test_disabled(self):
+        calls = []
+
+        @profiling.profiled('work')
+        def work():
+            calls.append(1)
+            return 'done'
+
+        self.assertFalse(profiling.enabled())
+        self.assertEqual(work(), 'done')
+        with profiling.phase('block'):
+            pass
+        self.assertEqual(calls, [1])
+        self.assertEqual(dict(profiling._phases), {})
+        self.assertEqual(profiling.finish(), None)
+        self.assertFalse(self.kv.set.called)
+
+    def test_timing(self):
+        @profiling.profiled('work')
+        def work():
+            self.tick(2)
+
+        profiling.start('config-changed')
+        self.assertTrue(profiling.enabled())
+        work()
+        work()
+        with profiling.phase('block'):
+            self.tick(0.5)
+        self.tick(1)
+        entry = profiling.finish()
+        self.assertEqual(entry['hook'], 'config-changed')
+        self.assertEqual(entry['duration'], 5.5)
+        self.assertEqual(entry['phases'], {
+            'work': {'count': 2, 'seconds': 4.0},
+            'block': {'count': 1, 'seconds': 0.5},
+        })
+        self.assertFalse(profiling.enabled())
+        self.kv.set.assert_called_with(profiling.LEDGER_KEY, [entry])
+        self.kv.flush.assert_called_with()
+
+    def test_phase_timed_on_error(self):
+        profiling.start('install')
+
+        def fail():
+            with profiling.phase('block'):
+                self.tick(1)
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(profiling.finish(save=False)['phases'],
+                         {'block': {'count': 1, 'seconds': 1.0}})
+        self.assertFalse(self.kv.set.called)
+        self.assertFalse(self.kv.flush.called)
+
+    def test_ledger_bounded(self):
+        self.kv.get.return_value = [{'hook': str(i)}
+                                    for i in range(profiling.LEDGER_SIZE)]
+        profiling.start('install')
+        entry = profiling.finish()
+        entries = self.kv.set.call_args[0][1]
+        self.assertEqual(len(entries), profiling.LEDGER_SIZE)
+        self.assertEqual(entries[0], {'hook': '1'})
+        self.assertEqual(entries[-1], entry)
+
+    def test_summary(self):
+        entries = [
+            {'hook': 'install', 'duration': 10.0,
+             'phases': {'apt': {'count': 1, 'seconds': 6.0}}},
+            {'hook': 'install', 'duration': 20.0,
+             'phases': {'apt': {'count': 2, 'seconds': 8.0}}},
+            {'hook': 'start', 'duration': 1.0, 'phases': {}},
+        ]
+        self.assertEqual(profiling.summary(entries), {
+            'install': {'runs': 2, 'mean': 15.0, 'max': 20.0,
+                        'phases': {'apt': 7.0}},
+            'start': {'runs': 1, 'mean': 1.0, 'max': 1.0, 'phases': {}},
+        })
+
+
+class HooksProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        for name in ['unitdata', 'log']:
+            _m = patch.object(hookenv, name)
+            _m.start()
+            self.addCleanup(_m.stop)
+        self.start = self.patch_profiling('start')
+        self.finish = self.patch_profiling('finish')
+        self.finish.return_value = {'hook': 'install', 'duration': 1.0,
+                                    'phases': {}}
+
+    def patch_profiling(self, name):
+        _m = patch.object(profiling, name)
+        self.addCleanup(_m.stop)
+        return _m.start()
+
+    def hooks(self, profile, fail=False):
+        hooks = hookenv.Hooks(profile=profile)
+
+        @hooks.hook('install')
+        def install():
+            if fail:
+                raise ValueError()
+        return hooks
+
+    def test_profile_enabled(self):
+        self.hooks(lambda: True).execute(['hooks/install'])
+        self.start.assert_called_with('install')
+        self.finish.assert_called_with(save=True)
+
+    def test_profile_disabled(self):
+        self.hooks(lambda: False).execute(['hooks/install'])
+        self.hooks(None).execute(['hooks/install'])
+        self.assertFalse(self.start.called)
+        self.assertFalse(self.finish.called)
+
+    def test_profile_hook_failed(self):
+        hooks = self.hooks(lambda: True, fail=True)
+        self.assertRaises(ValueError, hooks.execute, ['hooks/install'])
+        self.finish.assert_called_with(save=False)
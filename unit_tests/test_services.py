@@ -0,0 +1,125 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import grp
+import os
+import pwd
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from charmhelpers.core.services import base
+from charmhelpers.core.services import helpers
+
+
+class Versioned(dict):
+    version = 1
+
+
+class ServiceManagerDigestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.charm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.charm_dir)
+        os.mkdir(os.path.join(self.charm_dir, 'templates'))
+        for name, value in (('charm_dir', self.charm_dir),
+                            ('hook_name', 'config-changed')):
+            _m = patch.object(base.hookenv, name, return_value=value)
+            _m.start()
+            self.addCleanup(_m.stop)
+        _m = patch.object(base.hookenv, 'log')
+        _m.start()
+        self.addCleanup(_m.stop)
+        self.fired = []
+
+    def callback(self, service_name):
+        self.fired.append(service_name)
+
+    def reconfigure(self, **service):
+        definition = {'service': 'foo', 'data_ready': self.callback,
+                      'start': [], 'stop': []}
+        definition.update(service)
+        manager = base.ServiceManager([definition])
+        manager.reconfigure_services()
+        return manager
+
+    def test_unchanged_skipped(self):
+        self.reconfigure(required_data=[{'a': 1, 'b': 2}], ports=[80])
+        manager = self.reconfigure(required_data=[{'b': 2, 'a': 1}],
+                                   ports=[80])
+        self.assertEqual(self.fired, ['foo'])
+        self.assertEqual(manager.skipped, ['foo'])
+
+    def test_changed_fires(self):
+        self.reconfigure(required_data=[{'a': 1}])
+        self.reconfigure(required_data=[{'a': 2}])
+        self.reconfigure(required_data=[{'a': 2}], ports=[80])
+        self.assertEqual(self.fired, ['foo', 'foo', 'foo'])
+
+    def test_undigestable_never_skipped(self):
+        self.assertEqual(base._digest({'a': object()}), None)
+        self.reconfigure(required_data=[{'a': object()}])
+        manager = self.reconfigure(required_data=[{'a': object()}])
+        self.assertEqual(self.fired, ['foo', 'foo'])
+        self.assertEqual(manager.skipped, [])
+
+    def test_version(self):
+        self.reconfigure(required_data=[Versioned(a=1)])
+        self.reconfigure(required_data=[Versioned(a=2)])
+        self.assertEqual(self.fired, ['foo'])
+
+    def test_forced(self):
+        self.reconfigure(required_data=[{'a': 1}])
+        manager = base.ServiceManager([{
+            'service': 'foo', 'required_data': [{'a': 1}],
+            'data_ready': self.callback, 'start': []}])
+        manager.reconfigure_services('foo')
+        self.assertEqual(self.fired, ['foo', 'foo'])
+
+    def test_template_changes_fire(self):
+        source = os.path.join(self.charm_dir, 'templates', 'foo.conf')
+        target = os.path.join(self.charm_dir, 'foo.conf')
+        with open(source, 'w') as fp:
+            fp.write('a = {{ a }}\n')
+        template = helpers.TemplateCallback(
+            'foo.conf', target,
+            owner=pwd.getpwuid(os.getuid()).pw_name,
+            group=grp.getgrgid(os.getgid()).gr_name)
+
+        def reconfigure():
+            self.reconfigure(required_data=[{'a': 1}],
+                             data_ready=[template, self.callback])
+
+        reconfigure()
+        reconfigure()
+        self.assertEqual(self.fired, ['foo'])
+        with open(target) as fp:
+            self.assertEqual(fp.read(), 'a = 1')
+        with open(source, 'w') as fp:
+            fp.write('a = {{ a }} \n')
+        reconfigure()
+        self.assertEqual(len(self.fired), 2)
+        os.unlink(target)
+        reconfigure()
+        self.assertEqual(len(self.fired), 3)
+        self.assertTrue(os.path.exists(target))
+        reconfigure()
+        self.assertEqual(len(self.fired), 3)
+
+    def test_template_loader_not_digested(self):
+        template = helpers.TemplateCallback('foo.conf', '/tmp/foo.conf',
+                                            template_loader=object())
+        self.assertEqual(template.digest(), None)
@@ -0,0 +1,127 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import grp
+import os
+import pwd
+import shutil
+import stat
+import tempfile
+
+from mock import patch
+from test_utils import CharmTestCase
+
+import charmhelpers.core.templating as templating
+
+TO_PATCH = [
+    'host',
+]
+
+
+class TemplatingTest(CharmTestCase):
+
+    def setUp(self):
+        super(TemplatingTest, self).setUp(templating, TO_PATCH)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.templates_dir = os.path.join(self.tmpdir, 'templates')
+        os.mkdir(self.templates_dir)
+        with open(os.path.join(self.templates_dir, 'test.conf'), 'w') as f:
+            f.write('a = {{ a }}\n')
+        self.charm_dir = os.path.join(self.tmpdir, 'charm')
+        os.mkdir(self.charm_dir)
+        _m = patch.object(templating.hookenv, 'charm_dir')
+        _m.start().return_value = self.charm_dir
+        self.addCleanup(_m.stop)
+        templating._environments.clear()
+        self.addCleanup(templating._environments.clear)
+        self.target = os.path.join(self.tmpdir, 'test.conf')
+        self.owner = pwd.getpwuid(os.getuid()).pw_name
+        self.group = grp.getgrgid(os.getgid()).gr_name
+
+    def render(self, **kwargs):
+        return templating.render('test.conf', self.target, {'a': 1},
+                                 owner=self.owner, group=self.group,
+                                 perms=0o640,
+                                 templates_dir=self.templates_dir, **kwargs)
+
+    def write_target(self, content='a = 1', perms=0o640):
+        with open(self.target, 'w') as f:
+            f.write(content)
+        os.chmod(self.target, perms)
+
+    def test_environment_reused(self):
+        self.assertEqual(self.render(), 'a = 1')
+        env = templating._environments[self.templates_dir]
+        self.render()
+        self.assertEqual(templating._environments,
+                         {self.templates_dir: env})
+        other = os.path.join(self.tmpdir, 'other')
+        shutil.copytree(self.templates_dir, other)
+        templating.render('test.conf', None, {'a': 1}, templates_dir=other)
+        self.assertIsNot(templating._environments[other], env)
+
+    def test_skip_unchanged(self):
+        self.write_target()
+        self.render(skip_unchanged=True)
+        self.assertFalse(self.host.write_file.called)
+
+    def test_skip_unchanged_not_requested(self):
+        self.write_target()
+        self.render()
+        self.host.write_file.assert_called_once_with(
+            self.target, b'a = 1', self.owner, self.group, 0o640)
+
+    def test_skip_unchanged_content_differs(self):
+        self.write_target('a = 2')
+        self.render(skip_unchanged=True)
+        self.assertTrue(self.host.write_file.called)
+
+    def test_skip_unchanged_mode_differs(self):
+        self.write_target(perms=0o644)
+        self.render(skip_unchanged=True)
+        self.assertTrue(self.host.write_file.called)
+
+    @patch.object(templating.pwd, 'getpwnam')
+    def test_skip_unchanged_owner_differs(self, getpwnam):
+        getpwnam.return_value.pw_uid = os.getuid() + 1
+        self.write_target()
+        self.render(skip_unchanged=True)
+        self.assertTrue(self.host.write_file.called)
+
+    @patch.object(templating.grp, 'getgrnam')
+    def test_skip_unchanged_group_differs(self, getgrnam):
+        getgrnam.return_value.gr_gid = os.getgid() + 1
+        self.write_target()
+        self.render(skip_unchanged=True)
+        self.assertTrue(self.host.write_file.called)
+
+    def test_skip_unchanged_missing_target(self):
+        self.render(skip_unchanged=True)
+        self.assertTrue(self.host.write_file.called)
+
+    def test_bytecode_cache_in_charm_dir(self):
+        self.render()
+        cache_dir = os.path.join(self.charm_dir, templating.BYTECODE_CACHE_DIR)
+        self.assertEqual(stat.S_IMODE(os.stat(cache_dir).st_mode), 0o700)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        env = templating._environments[self.templates_dir]
+        self.assertEqual(env.bytecode_cache.directory, cache_dir)
+
+    def test_no_bytecode_cache_without_charm_dir(self):
+        templating.hookenv.charm_dir.return_value = None
+        templating.render('test.conf', None, {'a': 1},
+                          templates_dir=self.templates_dir)
+        env = templating._environments[self.templates_dir]
+        self.assertIsNone(env.bytecode_cache)
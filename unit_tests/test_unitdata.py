@@ -0,0 +1,299 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+import six
+from mock import MagicMock, patch
+
+from charmhelpers.cli import cmdline
+from charmhelpers.cli import unitdata as cli_unitdata
+from charmhelpers.core import unitdata
+
+
+class StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'unit-state.db')
+        self.kv = unitdata.Storage(self.path)
+        self.addCleanup(self.kv.close)
+
+    def committed(self, key):
+        """Return the value of key as seen by another connection."""
+        other = unitdata.Storage(self.path)
+        try:
+            return other.get(key)
+        finally:
+            other.close()
+
+    def test_wal(self):
+        self.kv.cursor.execute('pragma journal_mode')
+        self.assertEqual(self.kv.cursor.fetchone()[0], 'wal')
+
+    def test_set_upsert(self):
+        self.kv.set('a', 1)
+        self.kv.set('a', 2)
+        self.kv.set('a', 2)
+        self.kv.flush()
+        self.assertEqual(self.committed('a'), 2)
+        self.kv.cursor.execute('select count(*) from kv')
+        self.assertEqual(self.kv.cursor.fetchone()[0], 1)
+
+    def test_set_many(self):
+        self.kv.set('a', 1)
+        changed = self.kv.set_many({'a': 1, 'b': [1, 2], 'c': {'d': 3}})
+        self.assertEqual(sorted(changed), ['b', 'c'])
+        self.assertEqual(self.kv.set_many([('b', [1, 2])]), [])
+        self.kv.flush()
+        self.assertEqual(self.committed('b'), [1, 2])
+        self.assertEqual(self.committed('c'), {'d': 3})
+
+    def test_set_many_records_revisions(self):
+        with self.kv.hook_scope('install') as revision:
+            self.kv.set_many({'a': 1})
+        self.assertEqual([(r[0], r[1]) for r in self.kv.gethistory('a')],
+                         [(revision, 'a')])
+
+    def test_rollback(self):
+        self.kv.set('a', 1)
+        self.kv.flush()
+        self.kv.set('a', 2)
+        self.kv.flush(False)
+        self.assertEqual(self.kv.get('a'), 1)
+
+    def test_deferred_commit(self):
+        self.kv.defer_commits()
+        self.kv.set('a', 1)
+        self.kv.flush()
+        self.assertEqual(self.committed('a'), None)
+        self.kv.commit_deferred()
+        self.assertEqual(self.committed('a'), 1)
+
+    def test_deferred_durable_flush(self):
+        self.kv.defer_commits()
+        self.kv.set('a', 1)
+        self.kv.flush(durable=True)
+        self.assertEqual(self.committed('a'), 1)
+        self.kv.set('b', 1)
+        self.kv.commit_deferred(False)
+        self.assertEqual(self.committed('a'), 1)
+        self.assertEqual(self.committed('b'), None)
+
+    def test_deferred_failure_commits_last_flush(self):
+        self.kv.defer_commits()
+        self.kv.set('a', 1)
+        self.kv.flush()
+        self.kv.set('a', 2)
+        self.kv.set('b', 1)
+        self.kv.commit_deferred(False)
+        self.assertEqual(self.committed('a'), 1)
+        self.assertEqual(self.committed('b'), None)
+        self.assertEqual(self.kv.get('a'), 1)
+        self.assertEqual(self.kv.get('b'), None)
+
+    def test_deferred_failure_without_flush(self):
+        self.kv.defer_commits()
+        self.kv.set('a', 1)
+        self.kv.commit_deferred(False)
+        self.assertEqual(self.committed('a'), None)
+        self.assertEqual(self.kv.get('a'), None)
+
+    def test_deferred_rollback_to_flush(self):
+        self.kv.defer_commits()
+        self.kv.set('a', 1)
+        self.kv.flush()
+        self.kv.set('a', 2)
+        self.kv.flush(False)
+        self.assertEqual(self.kv.get('a'), 1)
+        self.kv.set('b', 1)
+        self.kv.flush()
+        self.kv.commit_deferred(False)
+        self.assertEqual(self.committed('a'), 1)
+        self.assertEqual(self.committed('b'), 1)
+
+    def test_deferred_hook_scope_failure(self):
+        self.kv.defer_commits()
+        with self.kv.hook_scope('install'):
+            self.kv.set('a', 1)
+        try:
+            with self.kv.hook_scope('config-changed'):
+                self.kv.set('a', 2)
+                raise ValueError('boom')
+        except ValueError:
+            pass
+        self.kv.commit_deferred(False)
+        self.assertEqual(self.committed('a'), 1)
+
+    def test_close_commits_last_flush(self):
+        self.kv.defer_commits()
+        self.kv.set('a', 1)
+        self.kv.flush()
+        self.kv.set('b', 1)
+        self.kv.close()
+        self.assertEqual(self.committed('a'), 1)
+        self.assertEqual(self.committed('b'), None)
+
+    def test_getrange_ignores_case(self):
+        self.kv.update({'config.a': 1, 'Config.b': 2, 'CONFIG.c': 3,
+                        'configX': 4, 'other': 5})
+        self.assertEqual(self.kv.getrange('config.', strip=True),
+                         {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(sorted(self.kv.getrange('CONFIG')),
+                         ['CONFIG.c', 'Config.b', 'config.a', 'configX'])
+
+    def test_getrange_wildcards_are_literal(self):
+        self.kv.update({'a_b.1': 1, 'axb.2': 2, 'a%b.3': 3, 'a\\b.4': 4})
+        self.assertEqual(list(self.kv.getrange('a_b')), ['a_b.1'])
+        self.assertEqual(list(self.kv.getrange('a%')), ['a%b.3'])
+        self.assertEqual(list(self.kv.getrange('a\\')), ['a\\b.4'])
+
+    def test_getrange_last_character(self):
+        prefix = u'x' + six.unichr(sys.maxunicode)
+        self.kv.update({prefix + u'y': 1, u'x': 2, u'y': 3})
+        self.assertEqual(list(self.kv.getrange(prefix)), [prefix + u'y'])
+
+    def test_getrange_all(self):
+        self.kv.update({'a': 1, 'b': 2})
+        self.assertEqual(self.kv.getrange(''), {'a': 1, 'b': 2})
+
+    def test_unsetrange_prefix(self):
+        self.kv.update({'rels.a': 1, 'RELS.b': 2, 'relsx': 3})
+        self.kv.unsetrange(prefix='rels.')
+        self.assertEqual(self.kv.get('rels.a'), None)
+        self.assertEqual(self.kv.get('RELS.b'), None)
+        self.assertEqual(self.kv.get('relsx'), 3)
+
+    def broken_cursor(self):
+        cursor = self.kv.cursor
+        self.kv.cursor = MagicMock()
+        self.kv.cursor.execute.side_effect = sqlite3.OperationalError
+        self.kv.cursor.executemany.side_effect = sqlite3.OperationalError
+        self.addCleanup(setattr, self.kv, 'cursor', cursor)
+        return cursor
+
+    def test_get_cached(self):
+        self.kv.update({'c.d': 2})
+        self.kv._cache.clear()
+        self.kv.set('a', {'b': 1})
+        self.kv.getrange('c.')
+        self.kv.get('e')
+        self.broken_cursor()
+        self.assertEqual(self.kv.get('a'), {'b': 1})
+        self.assertEqual(self.kv.get('c.d'), 2)
+        self.assertEqual(self.kv.get('e'), None)
+
+    def test_get_returns_copies(self):
+        self.kv.set('a', {'b': 1})
+        self.kv.get('a')['b'] = 2
+        self.assertEqual(self.kv.get('a'), {'b': 1})
+
+    def test_failed_set_not_cached(self):
+        self.kv.set('a', 1)
+        cursor = self.broken_cursor()
+        self.assertRaises(sqlite3.OperationalError, self.kv.set, 'a', 2)
+        self.assertRaises(sqlite3.OperationalError, self.kv.set_many,
+                          {'a': 3})
+        self.kv.cursor = cursor
+        self.assertEqual(self.kv.get('a'), 1)
+        self.kv.set('a', 2)
+        self.assertEqual(self.kv.get('a'), 2)
+
+
+class CompactTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'unit-state.db')
+
+    def storage(self, hooks, **kwargs):
+        kv = unitdata.Storage(self.path, history_days=0, **kwargs)
+        self.addCleanup(kv.close)
+        for i in range(hooks):
+            with kv.hook_scope('hook-%d' % i):
+                kv.set('a', i)
+        return kv
+
+    def hooks(self, kv):
+        kv.cursor.execute('select hook from hooks order by version')
+        return [row[0] for row in kv.cursor.fetchall()]
+
+    def test_compact(self):
+        kv = self.storage(5, history_hooks=2)
+        self.assertEqual(kv.compact(), 3)
+        self.assertEqual(self.hooks(kv), ['hook-3', 'hook-4'])
+        self.assertEqual([r[3] for r in kv.gethistory('a')],
+                         ['hook-3', 'hook-4'])
+        self.assertEqual(kv.get('a'), 4)
+
+    def test_compact_unlimited(self):
+        kv = self.storage(5, history_hooks=0)
+        self.assertEqual(kv.compact(), 0)
+        self.assertEqual(len(self.hooks(kv)), 5)
+
+    def test_commit_deferred_compacts_batch(self):
+        kv = self.storage(60, history_hooks=1)
+        kv.defer_commits()
+        kv.commit_deferred()
+        self.assertEqual(len(self.hooks(kv)), 10)
+        kv.defer_commits()
+        kv.commit_deferred()
+        self.assertEqual(self.hooks(kv), ['hook-59'])
+
+    def test_failed_hook_skips_compaction(self):
+        kv = self.storage(5, history_hooks=1)
+        kv.defer_commits()
+        kv.commit_deferred(False)
+        self.assertEqual(len(self.hooks(kv)), 5)
+
+    def test_vacuum(self):
+        kv = self.storage(200, history_hooks=1)
+        kv.compact()
+        kv.flush()
+        size = os.path.getsize(self.path)
+        kv.vacuum()
+        kv.cursor.execute('pragma wal_checkpoint(truncate)')
+        self.assertLess(os.path.getsize(self.path), size)
+
+    def parse(self, *args):
+        return cmdline.argument_parser.parse_args(
+            ('unitdata-compact',) + args)
+
+    def test_cli_arguments(self):
+        arguments = self.parse()
+        self.assertEqual(arguments.func, cli_unitdata.compact)
+        self.assertEqual((arguments.hooks, arguments.days,
+                          arguments.vacuum), (None, None, True))
+        arguments = self.parse('--hooks', '10', '--days', '1.5',
+                               '--no-vacuum')
+        self.assertEqual((arguments.hooks, arguments.days,
+                          arguments.vacuum), (10, 1.5, False))
+
+    @patch.object(unitdata.Storage, 'vacuum')
+    def test_cli_compact(self, vacuum):
+        self.storage(5, history_hooks=0)
+        with patch.dict('os.environ', {'UNIT_STATE_DB': self.path}):
+            self.assertEqual(cli_unitdata.compact(hooks=2, days=0),
+                             'Removed history of 3 hooks')
+            self.assertTrue(vacuum.called)
+            vacuum.reset_mock()
+            cli_unitdata.compact(hooks=2, days=0, vacuum=False)
+            self.assertFalse(vacuum.called)